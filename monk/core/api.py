@@ -50,6 +50,15 @@ def exits():
     _initialized = False
     return True
 
+def flush(force=True):
+    crane.flush_storage(force)
+    
+def report_cache(user):
+    crane.report_cache(user)
+
+def user_model_bytes():
+    return crane.model_bytes_by_user()
+    
 def reloads(config=None):
     if config:
         exits()
@@ -170,6 +179,16 @@ def load_user(userName, password=''):
         return None
     return _user
 
+def get_user_partition(userName):
+    _user = crane.userStore.load_or_create({'name':userName, 'creator':DEFAULT_CREATOR})
+    if _user is None:
+        return None
+    return _user.partition
+
+def load_user_partitions():
+    users = crane.userStore.load_all({'creator':DEFAULT_CREATOR}, {'name':True, 'partition':True})
+    return {user['name'] : user.get('partition', -1) for user in users or []}
+    
 def save_user(userName, password=''):
     _user = load_user(userName, password)
     if _user:
@@ -253,6 +272,11 @@ def create_turtle(turtleScript):
 def load_turtle(turtleName, userName):
     return crane.turtleStore.load_or_create({'name':turtleName, 'creator':userName})
 
+def warm_up_user(userName):
+    """ Loads all turtles of the user into the caches, returns the number of turtles """
+    turtles = crane.turtleStore.load_all({'creator':userName}, {'name':True}) or []
+    return len(filter(None, [load_turtle(_turtle['name'], userName) for _turtle in turtles]))
+
 def save_turtle(turtleName, userName):
     _turtle = load_turtle(turtleName, userName)
     if not _turtle:
@@ -374,7 +398,27 @@ def predict(turtleName, userName, entity, fields=None):
     else:
         logger.warning('can not find turtle by {0}@{1} to predict'.format(userName, turtleName))
         return 0
-        
+
+def predict_all(turtleName, userName, entities, fields=None):
+    """ Predicts each entity, given either by id or inline as a generic dict
+    (with '_features' as [[index, value], ...]), inline entities are not stored.
+    Returns None if the turtle is not found"""
+    _turtle = load_turtle(turtleName, userName)
+    if not _turtle:
+        logger.warning('can not find turtle by {0}@{1} to predict'.format(userName, turtleName))
+        return None
+    crane.entityStore.set_collection_name(_turtle.entityCollectionName)
+    results = []
+    for ent in entities:
+        if isinstance(ent, dict):
+            ent = dict(ent)
+            ent.setdefault(base.MONKObject.MONK_TYPE, entity.Entity.__name__)
+            ent = base.monkFactory.decode(ent)
+        else:
+            ent = crane.entityStore.load_or_create(UUID(ent))
+        results.append(_turtle.predict(ent, fields) if ent else None)
+    return results
+
 def reset(turtleName, userName):
     _turtle = load_turtle(turtleName, userName)
     if _turtle:
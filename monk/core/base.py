@@ -5,11 +5,18 @@ The project object
 @author: xm
 """
 import logging
+import sys
 import constants as cons
 from datetime import datetime
 from bson.objectid import ObjectId
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
 logger = logging.getLogger("monk.base")
 
+def vector2binary(v):
+    """ Stores a FlexibleVector as a compact BSON binary, 
+    FlexibleVector(generic=...) accepts both the binary and the old list format"""
+    return Binary(v.encode(), USER_DEFINED_SUBTYPE)
+
 class MONKObject(object):
     ID              = '_id' # for mongodb
     MONK_TYPE       = 'monkType'
@@ -69,6 +76,17 @@ class MONKObject(object):
 
     def _allattr(self, exclusive=[]):
         return set(self.__dict__.keys()).difference(exclusive)
+    
+    def _memorySize(self):
+        """ Estimated bytes held by the object, vectors report their own size
+        and other attributes are counted shallowly"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.__dict__)
+        for v in self.__dict__.itervalues():
+            try:
+                size += v._memorySize()
+            except AttributeError:
+                size += sys.getsizeof(v)
+        return size
         
     def generic(self):
         """ A shallow copy of the __dict__, 
@@ -82,10 +100,16 @@ class MONKObject(object):
     
     def save(self):
         if self.store:
-            self.store.update_one_in_fields(self, self.generic())
+            self.store.save_one(self)
         else:
             logger.warning('no store for abstract MONKObject')
     
+    def set_dirty(self):
+        """ Marks changes that are only in memory, the object is saved
+        before being evicted from the cache"""
+        if self.store:
+            self.store.set_dirty(self)
+    
     def signature(self):
         return {self.NAME:self.name, self.CREATOR:self.creator}
         
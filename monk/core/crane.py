@@ -6,10 +6,14 @@ The persistent storage manager that talks to different databases
 @author: xm
 """
 
-from pymongo import MongoClient
-#TODO: using cache
-#from monk.utils.cache import lru_cache
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+import collections
+from monk.utils.cache import create_cache
+from monk.utils.utils import metricValue
 import logging
+import threading
+import time
 import base
 import constants as cons
 from bson.objectid import ObjectId
@@ -52,8 +56,11 @@ class MongoClientPool(object):
 
 class Crane(object):
     mongoClientPool = MongoClientPool()
+    MISSING_TTL = 60 # seconds to remember a (name, creator) that is not in the store
+    MAX_MISSING = 10000 # (name, creator) misses remembered at most
 
-    def __init__(self, connectionString=None, database=None, collectionName=None):
+    def __init__(self, connectionString=None, database=None, collectionName=None, cachePolicy=None,
+                 writeBehind=None):
         if connectionString is None or database is None or collectionName is None:
             return
         
@@ -64,49 +71,252 @@ class Crane(object):
         #self._database = client[database]
         self._database = self.mongoClientPool.getDataBase(connectionString, database)
         self._coll = self._database[collectionName]
-        self._cache = {}
+        self._dirty = {} # _id -> the collection of the changes only in memory
+        self._cache = create_cache(cachePolicy, self.__size_of, self.__on_evict)
+        # write-behind buffer, one coalesced update per (collection name, _id),
+        # flushed when maxPending documents or interval seconds are reached
+        self._writeBehind = bool(writeBehind)
+        self._maxPending = (writeBehind or {}).get('maxPending', 1000)
+        self._flushInterval = (writeBehind or {}).get('interval', 1.0)
+        self._pending = collections.OrderedDict()
+        self._upserts = set()
+        self._oldest = 0
+        self._lock = threading.RLock()
+        # (collection, name, creator) -> _id for the cached objects, its reverse,
+        # and the time of known misses from the oldest to the newest
+        self._identities = {}
+        self._identityKeys = {}
+        self._missing = collections.OrderedDict()
 
     # cache related operation
+    def __size_of(self, obj):
+        return obj._memorySize()
+    
+    def __on_evict(self, key, obj):
+        # write back the changes that are only in memory, to the collection 
+        # the object was changed in, whichever is the current one now
+        collectionName = self._dirty.pop(key, None)
+        if collectionName is not None:
+            currentCollectionName = self._currentCollectionName
+            self.set_collection_name(collectionName)
+            try:
+                obj.save()
+            finally:
+                self.set_collection_name(currentCollectionName)
+        self.__forget_id(key)
+            
     def __get_one(self, key):
-        if key in self._cache:
-            return self._cache[key]
-        else:
-            return None
+        return self._cache.get(key)
 
     def __get_all(self, keys):
-        objs = [self._cache[key] for key in keys if key in self._cache]
-        rems = [key for key in keys if key not in self._cache]
+        objs = [self._cache.get(key) for key in keys]
+        rems = [key for key, obj in zip(keys, objs) if obj is None]
+        objs = [obj for obj in objs if obj is not None]
         return objs, rems
 
     def __put_one(self, obj):
-        self._cache[obj._id] = obj
+        self._cache.put(obj._id, obj)
+        try:
+            self._missing.pop(self.__identity(obj.name, obj.creator), None)
+        except AttributeError:
+            pass
 
     def __put_all(self, objs):
         map(self.__put_one, objs)
 
     def __erase_one(self, obj):
         try:
-            del self._cache[obj._id]
+            self._cache.erase(obj._id)
+            self._dirty.pop(obj._id, None)
         except:
             pass
 
     def __erase_all(self, objs):
         map(self.__erase_one, objs)
 
+    # identity index related operation
+    def __identity(self, name, creator):
+        return (self._currentCollectionName, name, creator)
+    
+    def __index_identity(self, key, objId):
+        oldId = self._identities.get(key)
+        if oldId is not None and oldId != objId:
+            self._identityKeys.pop(oldId, None)
+        self._identities[key] = objId
+        self._identityKeys[objId] = key
+        self._missing.pop(key, None)
+    
+    def __forget_id(self, objId):
+        key = self._identityKeys.pop(objId, None)
+        if key is not None and self._identities.get(key) == objId:
+            del self._identities[key]
+    
+    def __remember_missing(self, key):
+        self._missing.pop(key, None)
+        now = time.time()
+        self._missing[key] = now
+        # drop the expired misses, then the oldest ones above the cap
+        while self._missing:
+            oldest, missed = next(self._missing.iteritems())
+            if now - missed <= self.MISSING_TTL and len(self._missing) <= self.MAX_MISSING:
+                break
+            del self._missing[oldest]
+    
+    def __known_missing(self, key):
+        missed = self._missing.get(key)
+        if missed is None:
+            return False
+        if time.time() - missed > self.MISSING_TTL:
+            del self._missing[key]
+            return False
+        return True
+    
+    def ensure_identity_index(self):
+        try:
+            self._coll.create_index([('name', 1), ('creator', 1)], background=True)
+        except Exception as e:
+            logger.warning(e.message)
+            logger.warning('can not create (name, creator) index on {0}'.format(self._currentCollectionName))
+            
     def _reload(self):
-        for key in self._cache:
-            self._cache[key] = base.monkFactory.decode(self._cache[key].generic())
+        for key in self._cache.keys():
+            self._cache.put(key, base.monkFactory.decode(self._cache.get(key).generic()))
+    
+    def set_dirty(self, obj):
+        if obj._id in self._cache:
+            self._dirty.setdefault(obj._id, self._currentCollectionName)
+            self._cache.resize(obj._id)
+    
+    def bytes_by_creator(self):
+        """ Estimated bytes of the cached objects of each creator """
+        result = collections.defaultdict(int)
+        for key, obj in self._cache.items():
+            result[obj.creator] += obj._memorySize()
+        return result
+    
+    def cache_stats(self, reset=False):
+        result = self._cache.stats(reset)
+        result['dirty'] = len(self._dirty)
+        return result
             
+    # write-behind related operation
+    def __buffer(self, objId, op, fields, upsert=False):
+        # the update goes to the current collection whenever it is flushed
+        key = (self._currentCollectionName, objId)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending and self.__conflicts(pending, op, fields):
+                if not self.__flush_keys([key]):
+                    logger.warning('can not buffer {0} on {1} for {2}'.format(op, fields.keys(), objId))
+                    return False
+                pending = None
+            if pending is None:
+                if not self._pending:
+                    self._oldest = time.time()
+                pending = self._pending[key] = {}
+            if op == '$push':
+                pushes = pending.setdefault(op, {})
+                for field, value in fields.iteritems():
+                    if isinstance(value, dict) and '$each' in value:
+                        values = value['$each']
+                    else:
+                        values = [value]
+                    pushes.setdefault(field, {'$each':[]})['$each'].extend(values)
+            else:
+                pending.setdefault(op, {}).update(fields)
+            if upsert:
+                self._upserts.add(key)
+        return True
+    
+    def __written(self):
+        if not self._writeBehind:
+            return self.flush()
+        return self.flush(force=False)
+    
+    def __conflicts(self, pending, op, fields):
+        # mongodb rejects one update touching the same path twice, 
+        # except repeated $set and $push that are coalesced
+        for pop, pfields in pending.iteritems():
+            for pfield in pfields:
+                for field in fields:
+                    if pfield == field:
+                        if pop != op or op == '$pull':
+                            return True
+                    elif pfield.startswith(field + '.') or field.startswith(pfield + '.'):
+                        return True
+        return False
+    
+    def __flush_keys(self, keys):
+        # one bulk write per collection, updates rejected by mongodb are logged 
+        # and dropped, the others are kept for the next flush when the write fails
+        collectionUpdates = collections.OrderedDict()
+        for key in keys:
+            collectionUpdates.setdefault(key[0], []).append((key, self._pending.pop(key), key in self._upserts))
+        self._upserts.difference_update(keys)
+        written = True
+        for collectionName, updates in collectionUpdates.iteritems():
+            try:
+                self._database[collectionName].bulk_write(
+                    [UpdateOne({'_id':key[1]}, update, upsert=upsert) for key, update, upsert in updates],
+                    ordered=False)
+            except BulkWriteError as e:
+                lost = [updates[error['index']][0][1] for error in e.details.get('writeErrors', [])]
+                logger.warning('{0} updates rejected by {1}, lost the changes of {2}'.format(
+                               len(lost), collectionName, lost))
+                written = False
+            except Exception as e:
+                logger.warning(e.message)
+                logger.warning('can not write {0} pending updates to {1}, retry at the next flush'.format(
+                               len(updates), collectionName))
+                self.__requeue(updates)
+                written = False
+        return written
+    
+    def __requeue(self, updates):
+        for key, update, upsert in updates:
+            self._pending[key] = update
+            if upsert:
+                self._upserts.add(key)
+        
+    def flush(self, force=True):
+        """ Writes the pending updates in one bulk write, 
+        unless force is False and neither threshold is reached """
+        with self._lock:
+            if not self._pending:
+                return True
+            if not force and len(self._pending) < self._maxPending and \
+               time.time() - self._oldest < self._flushInterval:
+                return True
+            return self.__flush_keys(list(self._pending))
+    
+    def __flush_ids(self, objIds):
+        # a read by _id only sees the pending updates of these documents
+        with self._lock:
+            keys = [(self._currentCollectionName, objId) for objId in objIds]
+            keys = [key for key in keys if key in self._pending]
+            if not keys:
+                return True
+            return self.__flush_keys(keys)
+    
+    def __flush_collection(self):
+        # a query may match any document of the current collection
+        with self._lock:
+            keys = [key for key in self._pending if key[0] == self._currentCollectionName]
+            if not keys:
+                return True
+            return self.__flush_keys(keys)
+    
     def set_collection_name(self, collectionName):
-        if collectionName:
+        # pending updates remember their collection, no need to flush
+        if collectionName and collectionName != self._currentCollectionName:
             self._coll = self._database[collectionName]
             self._currentCollectionName = collectionName
     
     def reset_collection_name(self):
-        self._coll = self._database[self._defaultCollectionName]
-        self._currentCollectionName = self._defaultCollectionName
+        self.set_collection_name(self._defaultCollectionName)
     
     def convert_to_MONKObject(self, monkType):
+        self.__flush_collection()
         objs = self._coll.find()
         rets = []
         for obj in objs:
@@ -123,8 +333,11 @@ class Crane(object):
         if not isinstance(obj, ObjectId):
             return False
         
+        self.__flush_ids([obj])
         self._coll.remove(obj)
-        self.__erase_one(obj)
+        self._cache.erase(obj)
+        self._dirty.pop(obj, None)
+        self.__forget_id(obj)
         return True
         
     def load_or_create(self, obj, tosave=False):
@@ -134,17 +347,49 @@ class Crane(object):
         if isinstance(obj, ObjectId):
             return self.load_one_by_id(obj)
         else:
-            objId = self.load_one_in_id({'name':obj.get('name', cons.DEFAULT_EMPTY),
-                                         'creator':obj.get('creator', cons.DEFAULT_CREATOR)})
-            if objId:
-                return self.load_one_by_id(objId['_id'])
+            query = {'name':obj.get('name', cons.DEFAULT_EMPTY),
+                     'creator':obj.get('creator', cons.DEFAULT_CREATOR)}
+            key = self.__identity(query['name'], query['creator'])
+            found = None
+            if key in self._identities:
+                found = self.load_one_by_id(self._identities[key])
+                if not found:
+                    # created but never saved, and evicted since
+                    self.__forget_id(self._identities[key])
+            if not found and not self.__known_missing(key):
+                found = self.__load_one_by_query(query)
+            if found:
+                self.__index_identity(key, found._id)
+                return found
             elif 'monkType' in obj:
                 obj = self.create_one(obj)
-                if tosave:
-                    obj.save()
+                if obj:
+                    self.__index_identity(key, obj._id)
+                    if tosave:
+                        obj.save()
                 return obj
             else:
+                self.__remember_missing(key)
                 return None
+    
+    def __load_one_by_query(self, query):
+        # the whole document in one round trip, the cached object wins
+        self.__flush_collection()
+        try:
+            obj = self._coll.find_one(query)
+        except Exception as e:
+            logger.warning(e.message)
+            logger.warning('can not load document by query {0}'.format(query))
+            return None
+        if not obj:
+            return None
+        cached = self.__get_one(obj['_id'])
+        if cached:
+            return cached
+        obj = base.monkFactory.decode(obj)
+        if obj:
+            self.__put_one(obj)
+        return obj
 
     def load_or_create_all(self, objs, tosave=False):
         if not objs:
@@ -156,6 +401,7 @@ class Crane(object):
             return [self.load_or_create(obj, tosave) for obj in objs]
             
     def exists_field(self, obj, field):
+        self.__flush_ids([obj._id])
         query = {'_id':obj._id, field:{'$exists':True}}
         if self._coll.find_one(query, {'_id':1}):
             return True
@@ -163,6 +409,7 @@ class Crane(object):
             return False
             
     def exists_fields(self, obj, fields):
+        self.__flush_ids([obj._id])
         query = {field:{'$exists':True} for field in fields}
         query['_id'] = obj._id
         if self._coll.find_one(query,{'_id':1}):
@@ -171,6 +418,7 @@ class Crane(object):
             return False
             
     def remove_field(self, obj, field):
+        self.__flush_ids([obj._id])
         try:
             self._coll.update({'_id':obj._id}, {'$unset':{field:1}})
         except Exception as e:
@@ -180,6 +428,7 @@ class Crane(object):
         return True
 
     def remove_fields(self, obj, fields):
+        self.__flush_ids([obj._id])
         try:
             self._coll.update({'_id':obj._id}, {'$unset':fields})
         except Exception as e:
@@ -189,47 +438,35 @@ class Crane(object):
         return True
      
     def push_one_in_fields(self, obj, fields):
-        try:
-            self._coll.update({'_id':obj._id}, {'$push':fields})
-        except Exception as e:
-            logger.warning(e.message)
-            logger.warning('can not push document {0} in fields {1}'.format(obj._id, fields))
+        if not self.__buffer(obj._id, '$push', fields):
             return False
-        return True
+        return self.__written()
     
     def pull_one_in_fields(self, obj, fields):
-        try:
-            self._coll.update({'_id':obj._id}, {'$pull':fields})
-        except Exception as e:
-            logger.warning(e.message)
-            logger.warning('can not pull fields {0} from document {1}'.format(fields, obj._id))
+        if not self.__buffer(obj._id, '$pull', fields):
             return False
-        return True
+        return self.__written()
     
     def update_in_fields(self, query, fields):
         obj = self.load_one_in_id(query)
-        try:
-            self._coll.update({'_id':obj['_id']}, {'$set':fields}, upsert=True)
-        except Exception as e:
-            logger.warning(e.message)
-            logger.warning('can not update document {0} in fields {1}'.format(obj, fields))
+        if not obj:
+            logger.warning('can not update document {0} in fields {1}'.format(query, fields))
             return False
-        return True
+        if not self.__buffer(obj['_id'], '$set', fields, upsert=True):
+            return False
+        return self.__written()
         
     def update_one_in_fields(self, obj, fields):
         # fields are in flat form
         # 'f1.f2':'v' is ok, 'f1.f3' won't be erased
         # 'f1':{'f2':'v'} is NOT, 'f1':{'f3':vv} will be erased
-        try:
-            self._coll.update({'_id':obj._id}, {'$set':fields}, upsert=True)
-        except Exception as e:
-            logger.warning(e.message)
-            logger.warning('can not update document {0} in fields {1}'.format(obj._id, fields))
+        if not self.__buffer(obj._id, '$set', fields, upsert=True):
             return False
-        return True
+        return self.__written()
     
     def load_one_in_fields(self, obj, fields):
         # fields is a list
+        self.__flush_ids([obj._id])
         try:
             return self._coll.find_one({'_id':obj._id}, fields)
         except Exception as e:
@@ -238,8 +475,15 @@ class Crane(object):
             return None
     
     def save_one(self, obj):
+        self._dirty.pop(obj._id, None)
         self.update_one_in_fields(obj, obj.generic())
     
+    def update_all_in_fields(self, objs, fields):
+        # one bulk write for all objects, fields[i] goes to objs[i]
+        buffered = all([self.__buffer(obj._id, '$set', field, upsert=True)
+                        for obj, field in zip(objs, fields)])
+        return self.__written() and buffered
+        
     def save_all(self, objs):
         [self.update_one_in_fields(obj, obj.generic()) for obj in objs]
         
@@ -257,6 +501,7 @@ class Crane(object):
     def load_one_by_id(self, objId):
         obj = self.__get_one(objId)
         if not obj and objId:
+            self.__flush_ids([objId])
             try:
                 obj = self._coll.find_one({'_id': objId})
                 obj = base.monkFactory.decode(obj)
@@ -271,6 +516,7 @@ class Crane(object):
     def load_all_by_ids(self, objIds):
         objs, rems = self.__get_all(objIds)
         if rems:
+            self.__flush_ids(rems)
             try:
                 remainObjs = map(base.monkFactory.decode, 
                                  self._coll.find({'_id': {'$in':rems}}))
@@ -283,6 +529,7 @@ class Crane(object):
         return objs
 
     def load_one_in_id(self, query):
+        self.__flush_collection()
         try:
             return self._coll.find_one(query, {'_id': 1})
         except Exception as e:
@@ -291,6 +538,7 @@ class Crane(object):
             return None
 
     def load_all_in_ids(self, query, skip=0, num=0):
+        self.__flush_collection()
         try:
             return list(self._coll.find(query, {'_id': 1}, skip=skip, limit=num))
         except Exception as e:
@@ -299,6 +547,7 @@ class Crane(object):
             return []
 
     def load_one(self, query, fields):
+        self.__flush_collection()
         try:
             return self._coll.find_one(query, fields)
         except Exception as e:
@@ -307,6 +556,7 @@ class Crane(object):
             return None
 
     def load_all(self, query, fields, skip=0, num=0):
+        self.__flush_collection()
         try:
             return list(self._coll.find(query, fields, skip=skip, limit=num))
         except Exception as e:
@@ -315,6 +565,7 @@ class Crane(object):
             return None
 
     def has_name_user(self, name, user):
+        self.__flush_collection()
         if self._coll.find_one({'name': name, 'creator':user}):
             return True
         else:
@@ -331,7 +582,34 @@ workerStore  = Crane()
 engineStore  = Crane()
 
 
+def _stores():
+    return [('entity', entityStore), ('user', userStore), ('engine', engineStore),
+            ('panda', pandaStore), ('mantis', mantisStore), ('turtle', turtleStore),
+            ('tigress', tigressStore)]
+    
+def report_cache(user):
+    # hits, misses and evictions since the last report, with the current sizes
+    for name, store in _stores():
+        if hasattr(store, '_cache'):
+            for k, v in store.cache_stats(reset=True).iteritems():
+                metricValue('cache.{0}.{1}'.format(name, k), user, v)
+    
+def model_bytes_by_user():
+    # bytes of the cached models, the entities are shared by users
+    result = collections.defaultdict(int)
+    for store in [turtleStore, pandaStore, mantisStore, tigressStore]:
+        if hasattr(store, '_cache'):
+            for creator, size in store.bytes_by_creator().iteritems():
+                result[creator] += size
+    return result
+    
+def flush_storage(force=True):
+    for name, store in _stores():
+        if hasattr(store, '_pending'):
+            store.flush(force)
+    
 def exit_storage():
+    flush_storage()
     Crane.mongoClientPool.exists()
     
 def initialize_storage(config):
@@ -339,37 +617,56 @@ def initialize_storage(config):
     global mantisStore, turtleStore, tigressStore
     global userStore, engineStore
     
+    cachePolicies = getattr(config, 'cachePolicies', {})
+    writeBehind = getattr(config, 'writeBehind', None)
     uidStore     = UID(config.uidConnectionString,
                        config.uidDataBaseName)
 
     entityStore  = Crane(config.dataConnectionString,
                          config.dataDataBaseName,
-                         config.entityCollectionName)
+                         config.entityCollectionName,
+                         cachePolicies.get('entity'),
+                         writeBehind)
 
     userStore    = Crane(config.modelConnectionString,
                          config.modelDataBaseName,
-                         config.userCollectionName)
+                         config.userCollectionName,
+                         cachePolicies.get('user'),
+                         writeBehind)
                          
     engineStore  = Crane(config.sysConnectionString,
                          config.sysDataBaseName,
-                         config.engineCollectionName)
+                         config.engineCollectionName,
+                         cachePolicies.get('engine'),
+                         writeBehind)
 
     pandaStore   = Crane(config.modelConnectionString,
                          config.modelDataBaseName,
-                         config.pandaCollectionName)
+                         config.pandaCollectionName,
+                         cachePolicies.get('panda'),
+                         writeBehind)
 
     mantisStore  = Crane(config.modelConnectionString,
                          config.modelDataBaseName,
-                         config.mantisCollectionName)
+                         config.mantisCollectionName,
+                         cachePolicies.get('mantis'),
+                         writeBehind)
                          
     turtleStore  = Crane(config.modelConnectionString,
                          config.modelDataBaseName,
-                         config.turtleCollectionName)
+                         config.turtleCollectionName,
+                         cachePolicies.get('turtle'),
+                         writeBehind)
 
     tigressStore = Crane(config.modelConnectionString,
                          config.modelDataBaseName,
-                         config.tigressCollectionName)
+                         config.tigressCollectionName,
+                         cachePolicies.get('tigress'),
+                         writeBehind)
 
+    for store in [userStore, engineStore, pandaStore, mantisStore, turtleStore, tigressStore]:
+        store.ensure_identity_index()
+        
     # TODO: test if these are necessary and remove them
     from panda import Panda
     Panda.store = pandaStore
@@ -23,6 +23,7 @@ class Engine(base.MONKObject):
     FUSERS      = 'users'
     FSTARTTIME  = 'starttime'
     FENDTIME    = 'endtime'
+    FTAKEN      = 'takenPartitions'
     
     store = crane.engineStore
     
@@ -35,6 +36,7 @@ class Engine(base.MONKObject):
         self.starttime = datetime.datetime.now()
         self.endtime = datetime.datetime.now()
         self.users = []
+        self.takenPartitions = [] # partitions of failed engines consumed by this one
         
     def __restore__(self):
         super(Engine, self).__restore__()
@@ -50,7 +52,7 @@ class Engine(base.MONKObject):
         return None
     
     def is_active(self):
-        if not self.status:
+        if self.status != cons.STATUS_ACTIVE:
             return False
         currTime = time.mktime(datetime.datetime.now().timetuple())
         lastTime = time.mktime(self.lastModified.timetuple())
@@ -64,5 +66,10 @@ class Engine(base.MONKObject):
     def add_user(self, userName):
         self.users.append(userName)
         self.store.push_one_in_fields(self, {self.FUSERS:userName})
+    
+    def remove_user(self, userName):
+        if userName in self.users:
+            self.users.remove(userName)
+            self.store.pull_one_in_fields(self, {self.FUSERS:userName})
         
 base.register(Engine)
\ No newline at end of file
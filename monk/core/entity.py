@@ -25,7 +25,7 @@ class Entity(base.MONKObject):
         
     def generic(self):
         result = super(Entity, self).generic()
-        result[self.FEATURES] = self._features.generic()
+        result[self.FEATURES] = base.vector2binary(self._features)
         return result
     
     def clone(self, userName):
@@ -33,7 +33,7 @@ class Entity(base.MONKObject):
         return None
         
     def save(self):
-        fields = {self.FEATURES:self._features.generic(),
+        fields = {self.FEATURES:base.vector2binary(self._features),
                   self.RAWS:self._raws}
         crane.entityStore.update_one_in_fields(self, fields)
         
@@ -57,9 +57,10 @@ class Entity(base.MONKObject):
             self._raws[rawKey.replace('.', '\uff0e').replace('$', '\uff04')] = rawValue
 
     def set_value(self, key, value):
+        # the features are encoded once, on save or when the entity leaves the cache
         if value != 0 and key not in self._features:
             self._features[key] = value
-            crane.entityStore.push_one_in_fields(self, {self.FEATURES:(key,value)})
+            self.set_dirty()
         return value
         
 base.register(Entity)
@@ -8,9 +8,11 @@ solving machine learning problems
 import base, crane
 from constants import EPS
 from monk.math.svm_solver_dual import SVMDual
-from monk.math.flexible_vector import FlexibleVector
+from monk.math.flexible_vector import FlexibleVector, dualUpdate, primalUpdate
 from bson.objectid import ObjectId
-from monk.utils.utils import metricValue, metricAbs, metricRelAbs
+from monk.utils.utils import metricValue, metricRelNorms, monitoring
+from math import sqrt
+import numpy as np
 import logging
 
 logger = logging.getLogger("monk.mantis")
@@ -24,6 +26,8 @@ class Mantis(base.MONKObject):
     FDUALS = 'mu'
     FQ     = 'q'
     FDQ    = 'dq'
+    FALPHAS = 'alphas'
+    FWARM_START = 'warmStart'
     FMAX_NUM_ITERS = 'maxNumIters'
     FMAX_NUM_INSTANCES = 'maxNumInstances'
     store = crane.mantisStore
@@ -40,6 +44,8 @@ class Mantis(base.MONKObject):
         self.mu = []
         self.q  = []
         self.dq = []
+        self.alphas = []
+        self.warmStart = False
         
     def __restore__(self):
         super(Mantis, self).__restore__()
@@ -49,6 +55,7 @@ class Mantis(base.MONKObject):
             self.mu = FlexibleVector(generic=self.mu)
             self.q  = FlexibleVector(generic=self.q)
             self.dq = FlexibleVector(generic=self.dq)
+            self.alphas = FlexibleVector(generic=self.alphas)
             self.data = {ObjectId(k) : v for k,v in self.data.iteritems()}
             return True
         except Exception as e:
@@ -65,6 +72,8 @@ class Mantis(base.MONKObject):
             index, y, c = self.data[ent._id]
             self.solver.setData(ent._features, y, c, index)
         self.solver.num_instances = len(ents)
+        if self.warmStart:
+            self.restore_alphas()
         keys = self.panda.weights.getKeys()
         self.q.addKeys(keys)
         self.dq.addKeys(keys)
@@ -73,9 +82,12 @@ class Mantis(base.MONKObject):
         result = super(Mantis, self).generic()
         # every mantis should have a panda
         result[self.FPANDA] = self.panda._id
-        result[self.FDUALS] = self.mu.generic()
-        result[self.FQ]     = self.q.generic()
-        result[self.FDQ]    = self.dq.generic()
+        result[self.FDUALS] = base.vector2binary(self.mu)
+        result[self.FQ]     = base.vector2binary(self.q)
+        result[self.FDQ]    = base.vector2binary(self.dq)
+        if self.warmStart and self.solver is not None:
+            self.save_alphas()
+        result[self.FALPHAS] = base.vector2binary(self.alphas)
         result[self.FDATA]  = {str(k) : v for k,v in self.data.iteritems()}
         try:
             del result['solver']
@@ -88,66 +100,69 @@ class Mantis(base.MONKObject):
         obj.mu = FlexibleVector()
         obj.dq = FlexibleVector()
         obj.q  = self.panda.z.clone()
+        obj.alphas = FlexibleVector()
         obj.panda = panda
         obj.solver = SVMDual(panda.weights, self.eps, self.rho, self.gamma,
                              self.maxNumIters, self.maxNumInstances)
         obj.data = {}
         return obj
     
-    def train(self, leader):
+    def consensus(self, leader):
+        """ The consensus z to train against, read from the leader's panda if any """
+        if leader:
+            z = crane.pandaStore.load_one({'name':self.panda.name,
+                                           'creator':leader},
+                                          {'z':True}).get('z',[])
+            return FlexibleVector(generic=z)
+        return self.panda.z
+        
+    def train(self, leader, tosave=True, z=None):
+        """ z is the checked out consensus, given when training off the calling 
+        thread so that only tosave touches the stores """
         if not self.data:
             logger.debug('no data, skip training')
-            return
+            return False
             
         logger.debug('gamma in mantis {0}'.format(self.gamma))
 
         # check out z
-        if leader:
-            z = crane.pandaStore.load_one({'name':self.panda.name,
-                                           'creator':leader},
-                                          {'z':True}).get('z',[])
-            z = FlexibleVector(generic=z)
-        else:
-            z = self.panda.z
+        if z is None:
+            z = self.consensus(leader)
         
         if z is None:
             logger.debug('no consensus checked out')
-            return
+            return False
             
         #metricAbs(metricLog, self, '|z|', z)
         #metricAbs(metricLog, self, '|q|', self.q)
-        metricRelAbs(self, 'z~q', self.q, z)
         
-        # update mu
-        self.dq.clear()
-        self.dq.add(self.mu, -1)
-        self.mu.add(self.q, 1)
-        self.mu.add(z, -1)
-        self.dq.add(self.mu, 1)
-        metricAbs(self, 'mu', self.mu)
+        # update mu, dq = q - z and mu += dq
+        d2, q2, z2, mu2 = dualUpdate(self.mu, self.dq, self.q, z)
+        metricRelNorms('{0}.z~q'.format(self.name), self.creator, d2, q2, z2)
+        metricValue('{0}.mu'.format(self.name), self.creator, sqrt(mu2))
         #metricAbs(metricLog, self, '|dmu|', self.dq)
         #metricValue(metricLog, self, 'sup(mu)', 2 * self.solver.num_instances * self.solver.maxxnorm() * z.norm())
         
-        # update w
-        self.solver.setModel0(z, self.mu)
+        # update w, warm start from the last alphas when asked
+        if self.warmStart:
+            self.solver.setModel(z, self.mu)
+        else:
+            self.solver.setModel0(z, self.mu)
         #loss = self.solver.status()
         #metricValue(metricLog, self, 'loss', loss)
         #metricRelAbs(metricLog, self, '|q~w|', self.q, self.panda.weights)
         #logger.debug('q = {0}'.format(self.q))
         #logger.debug('w = {0}'.format(self.panda.weights))
-        self.solver.trainModel()
-        loss = self.solver.status()
-        metricValue(self, 'loss', loss)
-        metricValue(self, 'x', self.solver.maxxnorm())
+        iterations = self.solver.trainModel()
+        metricValue('{0}.iterations'.format(self.name), self.creator, iterations)
+        if monitoring('{0}.loss'.format(self.name)):
+            metricValue('{0}.loss'.format(self.name), self.creator, self.solver.status())
+        if monitoring('{0}.x'.format(self.name)):
+            metricValue('{0}.x'.format(self.name), self.creator, self.solver.maxxnorm())
         
-        # update q
+        # update q = r * z + (1 - r) * w - r * mu, and dq by the change of q
         r = self.rho / float(self.rho + self.gamma)
-        self.dq.add(self.q, -1)
-        self.q.clear()
-        self.q.add(z, r)
-        self.q.add(self.panda.weights, 1 - r)
-        self.q.add(self.mu, -r)
-        self.dq.add(self.q, 1)
+        d2, q2, w2 = primalUpdate(self.q, self.dq, z, self.panda.weights, self.mu, r)
         
         if z is not self.panda.z:
             del z
@@ -158,11 +173,13 @@ class Mantis(base.MONKObject):
         # measure convergence
         #metricAbs(self, '|dq|', self.dq)
         #metricAbs(self, '|q|', self.q)
-        metricRelAbs(self, 'q~w', self.q, self.panda.weights)
+        metricRelNorms('{0}.q~w'.format(self.name), self.creator, d2, q2, w2)
 
         # commit changes
-        self.panda.update_fields({self.panda.FWEIGHTS:self.panda.weights.generic()})
-        self.commit()
+        if tosave:
+            self.panda.update_fields(self.panda.weights_fields())
+            self.commit()
+        return True
     
     def checkout(self, leader):
         pass
@@ -185,17 +202,35 @@ class Mantis(base.MONKObject):
             logger.debug('m = {0}'.format(m))
             logger.debug('update z {0}'.format(self.panda.z))
             logger.debug('relative difference of z {0}'.format(rd))
-            metricValue(self, 'rz', rd)
+            metricValue('{0}.rz'.format(self.name), self.creator, rd)
             #self.panda.update_fields({self.panda.FCONSENSUS:self.panda.z.generic()})
         
         if fdq is not self.dq:
             del fdq
         return True
         
+    def commit_fields(self):
+        fields = {self.FDUALS : base.vector2binary(self.mu),
+                  self.FQ     : base.vector2binary(self.q),
+                  self.FDQ    : base.vector2binary(self.dq)}
+        if self.warmStart:
+            self.save_alphas()
+            fields[self.FALPHAS] = base.vector2binary(self.alphas)
+        return fields
+        
+    def save_alphas(self):
+        alphas = self.solver.getAlphas()
+        self.alphas = FlexibleVector.from_arrays(np.arange(len(alphas)), alphas)
+    
+    def restore_alphas(self):
+        indices, values = self.alphas.to_arrays(copy=True)
+        alphas = np.zeros(self.solver.num_instances, dtype=np.float32)
+        valid = indices < len(alphas)
+        alphas[indices[valid]] = values[valid]
+        self.solver.setAlphas(alphas)
+        
     def commit(self):
-        self.update_fields({self.FDUALS : self.mu.generic(),
-                            self.FQ     : self.q.generic(),
-                            self.FDQ    : self.dq.generic()})
+        self.update_fields(self.commit_fields())
     
     def add_data(self, entity, y, c):
         da = self.data
@@ -211,6 +246,7 @@ class Mantis(base.MONKObject):
             olduuid, (ind, oldy, oldc)  = da.popitem()
         self.solver.setData(entity._features, y, c, ind)
         da[uuid] = (ind, y, c)
+        self.set_dirty()
         
     def reset(self):
         self.mu.clear()
@@ -219,8 +255,8 @@ class Mantis(base.MONKObject):
         logger.debug('mu {0}'.format(self.mu))
         logger.debug('q  {0}'.format(self.q))
         logger.debug('dq {0}'.format(self.dq))
-        self.commit()
         self.solver.initialize()
+        self.commit()
         
     def reset_data(self):
         self.data = {}
@@ -235,5 +271,9 @@ class Mantis(base.MONKObject):
             logger.debug('gamma is {0}'.format(self.gamma))
             logger.debug('gamma of solver is {0}'.format(self.solver.gamma))
             self.update_fields({self.FGAMMA : self.gamma})
+        elif (para == 'warmStart'):
+            self.warmStart = bool(value)
+            logger.debug('warmStart is {0}'.format(self.warmStart))
+            self.update_fields({self.FWARM_START : self.warmStart})
     
 base.register(Mantis)
@@ -30,8 +30,8 @@ class Panda(base.MONKObject):
     def add_features(self, uids):
         pass
     
-    def train(self):
-        pass
+    def train(self, leader, tosave=True):
+        return False
     
     def checkout(self):
         pass
@@ -112,8 +112,8 @@ class LinearPanda(Panda):
         result = super(LinearPanda, self).generic()
         if self.mantis_loaded():
             result[self.FMANTIS] = self.mantis.signature()
-        result[self.FWEIGHTS]   = self.weights.generic()
-        result[self.FCONSENSUS] = self.z.generic()
+        result[self.FWEIGHTS]   = base.vector2binary(self.weights)
+        result[self.FCONSENSUS] = base.vector2binary(self.z)
         return result
 
     def clone(self, userName):
@@ -182,6 +182,7 @@ class LinearPanda(Panda):
     def add_features(self, uids):
         self.weights.addKeys(uids)
         self.z.addKeys(uids)
+        self.set_dirty()
     
     def pull_model(self):
         genericW = self.store.load_one_in_fields(self, [self.FWEIGHTS, self.FCONSENSUS])
@@ -189,15 +190,18 @@ class LinearPanda(Panda):
         self.z.update(genericW.get(self.FCONSENSUS, []))
     
     def push_model(self):
-        self.update_fields({self.FWEIGHTS:self.weights.generic(),
-                            self.FCONSENSUS:self.z.generic()})
+        self.update_fields({self.FWEIGHTS:base.vector2binary(self.weights),
+                            self.FCONSENSUS:base.vector2binary(self.z)})
     
-    def train(self, leader):
+    def weights_fields(self):
+        return {self.FWEIGHTS:base.vector2binary(self.weights)}
+        
+    def train(self, leader, tosave=True):
         try:
-            self.mantis.train(leader)
+            return self.mantis.train(leader, tosave)
         except:
             self.load_mantis()
-            self.mantis.train(leader)
+            return self.mantis.train(leader, tosave)
     
     def checkout(self, leader):
         try:
@@ -238,7 +242,8 @@ class LinearPanda(Panda):
             self.mantis.reset()
         except:
             crane.mantisStore.update_in_fields({Mantis.NAME:self.name, Mantis.CREATOR:self.creator}, 
-                                               {Mantis.FDUALS : [], Mantis.FQ : [], Mantis.FDQ : []})
+                                               {Mantis.FDUALS : [], Mantis.FQ : [], Mantis.FDQ : [],
+                                                Mantis.FALPHAS : []})
 
     def reset_data(self):        
         logger.debug('resetting data in mantis')
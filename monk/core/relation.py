@@ -29,7 +29,7 @@ class Relation(Entity):
         return result
 
     def save(self):
-        fields = {self.FEATURES: self._features.generic(),
+        fields = {self.FEATURES: base.vector2binary(self._features),
                   self.RAWS: self._raws,
                   self.ARGUMENTS: [x._id for x in self._arguments]}
         crane.entityStore.update_one_in_fields(self, fields)
@@ -8,9 +8,12 @@ import base
 import constants as cons
 import crane
 from relation import MatchingRelation
+from panda import LinearPanda
 from monk.utils.utils import binary2decimal, translate, monitor_accuracy
-from monk.math.cmath import sign0
+from monk.math.cmath import sign0, sigmoid
+from monk.math.flexible_vector import FlexibleMatrix
 #from itertools import izip
+from multiprocessing.pool import ThreadPool
 import logging
 import nltk
 from nltk.stem import PorterStemmer
@@ -21,6 +24,14 @@ metricLog = logging.getLogger("metric")
 stopwords_english = set(stopwords.words('english'))
 symbols = {'\'', '\"', '[', ']','{','}','(',')','.','$', '#'}
 
+# thread pools shared by turtles, keyed by the number of workers
+trainPools = {}
+
+def get_train_pool(numWorkers):
+    if numWorkers not in trainPools:
+        trainPools[numWorkers] = ThreadPool(numWorkers)
+    return trainPools[numWorkers]
+
 class Turtle(base.MONKObject):
     FPANDAS               = 'pandas'
     FTIGRESS              = 'tigress'
@@ -33,6 +44,7 @@ class Turtle(base.MONKObject):
     FPARTIALBARRIER       = 'pPartialBarrier'
     FMERGECLOCK           = 'pMergeClock'
     FTRAINCLOCK           = 'pTrainClock'
+    FTRAINWORKERS         = 'pTrainWorkers'
     FENTITYCOLLECTIONNAME = 'entityCollectionName'
     FREQUIRES             = 'requires'
     FREQUIRES_UIDS        = 'uids'
@@ -59,6 +71,9 @@ class Turtle(base.MONKObject):
         self.pPartialBarrier = 50
         self.pMergeClock = 0
         self.pTrainClock = 0
+        self.pTrainWorkers = 1
+        self.weightMatrix = None
+        self.chainedPandas = False
         
     def __restore__(self):
         super(Turtle, self).__restore__()
@@ -74,6 +89,8 @@ class Turtle(base.MONKObject):
         self.pandaUids = set((p.uid for p in self.pandas))
         self.invertedMapping = {tuple(v): k for k, v in self.mapping.iteritems()}
         self.followers = set(self.followers)
+        self.weightMatrix = None
+        self.chainedPandas = False
         
         if self.FREQUIRES_UIDS in self.requires:
             uids = self.requires[self.FREQUIRES_UIDS]
@@ -101,10 +118,14 @@ class Turtle(base.MONKObject):
         del result['invertedMapping']
         del result['pandaUids']
         del result['mergeQueue']
+        del result['weightMatrix']
+        del result['chainedPandas']
         return result
     
     def clone(self, userName):
         obj = super(Turtle, self).clone(userName)
+        obj.weightMatrix = None
+        obj.chainedPandas = False
         obj.pandaUids = set(self.pandaUids)
         obj.tigress   = self.tigress.clone(userName)
         obj.pandas    = [p.clone(userName) for p in self.pandas]
@@ -184,6 +205,7 @@ class Turtle(base.MONKObject):
         
     def add_panda(self, panda):
         if not self.has_panda(panda):
+            self.weightMatrix = None
             self.pandas.append(panda)
             self.pandaUids.add(panda.uid)
             crane.pandaStore.push_one_in_fields(self, {'pandas':panda._id})
@@ -194,6 +216,7 @@ class Turtle(base.MONKObject):
     
     def delete_panda(self, panda):
         if self.has_panda(panda):
+            self.weightMatrix = None
             self.pandas.remove(panda)
             self.pandaUids.remove(panda.uid)
             crane.pandaStore.pull_one_in_fields(self, {'pandas':panda._id})
@@ -202,14 +225,42 @@ class Turtle(base.MONKObject):
             logger.info('panda {0} is not in the turtle {1}'.format(panda.name, self.name))
             return False
 
+    def has_chained_pandas(self):
+        """ Whether a panda uses the output of an earlier panda as a feature """
+        uids = []
+        for panda in self.pandas:
+            if any(uid in panda.weights for uid in uids):
+                return True
+            uids.append(panda.uid)
+        return False
+        
+    def predict_pandas(self, entity):
+        """ Scores all pandas on the entity in one pass over its features,
+        the same as [panda.predict(entity) for panda in self.pandas]. Pandas 
+        using the outputs of the earlier pandas are scored one by one, as the
+        outputs are only known after the earlier pandas are scored."""
+        if not all(isinstance(panda, LinearPanda) for panda in self.pandas):
+            return [panda.predict(entity) for panda in self.pandas]
+        if self.weightMatrix is None:
+            self.chainedPandas = self.has_chained_pandas()
+            self.weightMatrix = FlexibleMatrix([panda.weights for panda in self.pandas])
+        if self.chainedPandas:
+            return [panda.predict(entity) for panda in self.pandas]
+        values = self.weightMatrix.dot(entity._features)
+        scores = []
+        for panda, value in zip(self.pandas, values):
+            entity[panda.uid] = sigmoid(value)
+            scores.append(entity[panda.uid])
+        return scores
+        
     def predict(self, entity, fields=None):
-        scores = [panda.predict(entity) for panda in self.pandas]
+        scores = self.predict_pandas(entity)
         predicted = self.invertedMapping[tuple(map(sign0, scores))]
         self.tigress.measure(entity, predicted)
         return predicted
         
     def test_data(self, entity):
-        test = [panda.predict(entity) for panda in self.pandas]
+        test = self.predict_pandas(entity)
         logger.info('turtle {0} value is {1}'.format(self.creator, test[0]))
         return test    
 
@@ -224,7 +275,25 @@ class Turtle(base.MONKObject):
             logger.info("turtle {0} does not have active superviser".format(self.name))
     
     def train(self):
-        [panda.train(self.leader) for panda in self.pandas]
+        # the weights change in place, drop the snapshot even if training fails
+        self.weightMatrix = None
+        if self.pTrainWorkers > 1 and len(self.pandas) > 1:
+            # the solvers release the GIL, so pandas train concurrently on threads,
+            # and the models are committed in one bulk write per store. The stores
+            # are not thread safe, the mantises and the consensus are loaded here
+            # and the threads only touch the models in memory
+            leader = self.leader
+            learners = [panda for panda in self.pandas if isinstance(panda, LinearPanda)]
+            [panda.load_mantis() for panda in learners]
+            jobs = [(panda.mantis, panda.mantis.consensus(leader)) for panda in learners]
+            pool = get_train_pool(self.pTrainWorkers)
+            trained = pool.map(lambda (mantis, z): mantis.train(leader, False, z), jobs)
+            trained = [panda for panda, t in zip(learners, trained) if t]
+            crane.pandaStore.update_all_in_fields(trained, [panda.weights_fields() for panda in trained])
+            crane.mantisStore.update_all_in_fields([panda.mantis for panda in trained],
+                                                   [panda.mantis.commit_fields() for panda in trained])
+        else:
+            [panda.train(self.leader) for panda in self.pandas]
         self.pTrainClock += 1
         self.update_fields({self.FTRAINCLOCK:self.pTrainClock})
         logger.debug('training clock {0}'.format(self.pTrainClock))
@@ -244,7 +313,7 @@ class Turtle(base.MONKObject):
             for follower in self.mergeQueue:
                 [panda.merge(follower) for panda in self.pandas]               
             self.mergeQueue.clear()
-            [panda.update_fields({panda.FCONSENSUS:panda.z.generic()}) for panda in self.pandas]
+            [panda.update_fields({panda.FCONSENSUS:base.vector2binary(panda.z)}) for panda in self.pandas]
             self.pMergeClock += 1
             self.update_fields({self.FMERGECLOCK:self.pMergeClock})
             logger.debug('merge clock {0}'.format(self.pMergeClock))
@@ -252,6 +321,7 @@ class Turtle(base.MONKObject):
         return False
     
     def reset(self):
+        self.weightMatrix = None
         [panda.reset() for panda in self.pandas]
         self.pTrainClock = 0
         self.pMergeClock = 0
@@ -270,17 +340,17 @@ class SingleTurtle(Turtle):
         score = panda.predict(entity)
         if sign0(score) > 0:
             self.tigress.measure(entity, panda.name)
-            monitor_accuracy(panda.name, self.creator, score, 'True')
+            monitor_accuracy(panda.name, score, 1, self.creator)
             return panda.name
         else:
             self.tigress.measure(entity, cons.DEFAULT_NONE)
-            monitor_accuracy(panda.name, self.creator, score, 'False')
+            monitor_accuracy(panda.name, score, 0, self.creator)
             return cons.DEFAULT_NONE
         
 class MultiLabelTurtle(Turtle):
 
     def predict(self, entity, fields=None):
-        predicted = [panda.name for panda in self.pandas if panda.predict(entity) > 0]
+        predicted = [panda.name for panda, score in zip(self.pandas, self.predict_pandas(entity)) if score > 0]
         self.tigress.measure(entity, predicted)
         return predicted
         
@@ -332,7 +402,7 @@ class RankingTurtle(Turtle):
         for target in targets:
             relation.set_argument(1, target)
             relation.compute()
-            rank = self.invertedMapping[[sign0(panda.predict(relation)) for panda in self.pandas]]
+            rank = self.invertedMapping[tuple(map(sign0, self.predict_pandas(relation)))]
             results.append((rank, target))
         results.sort(reverse=True)
         return results[:self.beamSize]
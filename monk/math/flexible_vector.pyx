@@ -26,11 +26,18 @@ from __future__ import division
 
 cimport cython
 from libc.stdlib cimport malloc, free, rand, calloc, realloc, RAND_MAX
-from libc.string cimport memset
+from libc.string cimport memset, memmove
 from libc.math cimport sqrt
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.buffer cimport PyBUF_FORMAT, PyBUF_ND, PyBUF_WRITABLE
+import numpy as np
 
 cdef int MAX_HEIGHT = 32
 cdef long MAX_CAPACITY = 2 << 16
+cdef unsigned char ENCODING_VERSION = 1
+DEF NUM_LINK_CLASSES = 33 # pointer arrays of heights 0 to MAX_HEIGHT
+cdef long long MIN_SLAB_SIZE = 512
+cdef long long MAX_SLAB_SIZE = 1 << 16
 
 cdef struct SkipNodeA:
     int height
@@ -42,6 +49,25 @@ cdef struct SkipNodeA:
 
 ctypedef SkipNodeA* SkipNodeA_t
 
+# a slab arena holds the node headers and the pointer arrays of one vector,
+# freed blocks are recycled by size and all slabs are freed with the vector
+cdef struct Slab:
+    Slab* next
+    long long size
+
+cdef struct Arena:
+    Slab* slabs
+    char* cursor
+    char* end
+    long long nextSize
+    void* freeNodes
+    void* freeLinks[NUM_LINK_CLASSES]
+    long long numSlabs
+    long long reserved # bytes of the slabs
+    long long inUse # bytes of the live blocks
+    long long freeBytes # bytes of the blocks on the free lists
+    long long recycled # blocks served from the free lists
+
 ctypedef float (*funcA)(float)
 
 # utitily inline math function
@@ -77,10 +103,97 @@ cdef inline _MEM_CHECK(void* p):
     if p == NULL:
         raise MemoryError()
 
-cdef inline long long _SIZE_OF(SkipNodeA* sn):
-    return cython.sizeof(SkipNodeA) +\
-           cython.sizeof(SkipNodeA_t) * sn.height +\
-           sn.capacity * cython.sizeof(float)
+# arena functions
+cdef inline size_t _ALIGN(size_t size):
+    return (size + 7) & ~(<size_t>7)
+
+cdef void* _arenaBump(Arena* arena, size_t size):
+    # carves size bytes out of the current slab, a new slab twice as large as 
+    # the last one (up to MAX_SLAB_SIZE) is taken when it runs out
+    cdef Slab* slab
+    cdef long long slabSize
+    cdef void* p
+    if arena.cursor == NULL or arena.cursor + size > arena.end:
+        slabSize = _MAX(arena.nextSize, MIN_SLAB_SIZE)
+        while slabSize < <long long>(size + _ALIGN(cython.sizeof(Slab))):
+            slabSize *= 2
+        slab = <Slab*>malloc(slabSize)
+        if slab == NULL:
+            return NULL
+        slab.next = arena.slabs
+        slab.size = slabSize
+        arena.slabs = slab
+        arena.cursor = <char*>slab + _ALIGN(cython.sizeof(Slab))
+        arena.end = <char*>slab + slabSize
+        arena.nextSize = _MIN(slabSize * 2, MAX_SLAB_SIZE)
+        arena.numSlabs += 1
+        arena.reserved += slabSize
+    p = arena.cursor
+    arena.cursor += size
+    return p
+
+cdef inline void* _arenaAlloc(Arena* arena, void** freeList, size_t size):
+    cdef void* p = freeList[0]
+    if p != NULL:
+        freeList[0] = (<void**>p)[0]
+        arena.recycled += 1
+        arena.freeBytes -= size
+    else:
+        p = _arenaBump(arena, size)
+        if p == NULL:
+            return NULL
+    arena.inUse += size
+    return p
+
+cdef inline void _arenaFree(Arena* arena, void** freeList, void* p, size_t size):
+    (<void**>p)[0] = freeList[0]
+    freeList[0] = p
+    arena.inUse -= size
+    arena.freeBytes += size
+
+cdef void _arenaRelease(Arena* arena):
+    cdef Slab* slab = arena.slabs
+    cdef Slab* nextSlab
+    while slab != NULL:
+        nextSlab = slab.next
+        free(slab)
+        slab = nextSlab
+    memset(arena, 0, cython.sizeof(Arena))
+
+cdef inline SkipNodeA* _arenaNode(Arena* arena):
+    return <SkipNodeA*>_arenaAlloc(arena, &arena.freeNodes, _ALIGN(cython.sizeof(SkipNodeA)))
+
+# binary encoding functions
+cdef inline unsigned char* _writeVarint(unsigned char* p, unsigned long long v):
+    while v >= 0x80:
+        p[0] = (v & 0x7f) | 0x80
+        v >>= 7
+        p += 1
+    p[0] = v
+    return p + 1
+
+cdef inline const unsigned char* _readVarint(const unsigned char* p, const unsigned char* end, unsigned long long* v):
+    cdef unsigned long long result = 0
+    cdef int shift = 0
+    while p < end and shift < 64:
+        result |= <unsigned long long>(p[0] & 0x7f) << shift
+        if p[0] < 0x80:
+            v[0] = result
+            return p + 1
+        shift += 7
+        p += 1
+    return NULL
+
+cdef inline void _writeFloat(unsigned char* p, float v):
+    cdef unsigned int bits = (<unsigned int*>&v)[0]
+    p[0] = bits & 0xff
+    p[1] = (bits >> 8) & 0xff
+    p[2] = (bits >> 16) & 0xff
+    p[3] = (bits >> 24) & 0xff
+
+cdef inline float _readFloat(const unsigned char* p):
+    cdef unsigned int bits = p[0] | (p[1] << 8) | (p[2] << 16) | (<unsigned int>p[3] << 24)
+    return (<float*>&bits)[0]
 
 # SkipNodeA functions
 cdef bint _setValue(SkipNodeA* sn, long long index, float value):
@@ -112,19 +225,19 @@ cdef float _getValue(SkipNodeA* sn, long long index):
     else:
         return 0
 
-cdef SkipNodeA** _newSkipNodeS(int num, SkipNodeA* target):
-    cdef SkipNodeA** p = <SkipNodeA**>malloc(cython.sizeof(SkipNodeA_t) * num)
+cdef SkipNodeA** _newSkipNodeS(Arena* arena, int num, SkipNodeA* target):
+    cdef SkipNodeA** p = <SkipNodeA**>_arenaAlloc(arena, &arena.freeLinks[num], cython.sizeof(SkipNodeA_t) * num)
     _MEM_CHECK(p)
     cdef int i
     for i in xrange(num):
         p[i] = target
     return p
 
-cdef SkipNodeA* _newSkipNodeV(int height, long long index, long length, float* values):
+cdef SkipNodeA* _newSkipNodeV(Arena* arena, int height, long long index, long length, float* values):
     #height > 0
     #length > 1
     cdef long i
-    cdef SkipNodeA* sn = <SkipNodeA*>malloc(cython.sizeof(SkipNodeA))
+    cdef SkipNodeA* sn = _arenaNode(arena)
     _MEM_CHECK(sn)
     sn.height   = height
     sn.index    = index
@@ -134,12 +247,12 @@ cdef SkipNodeA* _newSkipNodeV(int height, long long index, long length, float* v
     _MEM_CHECK(sn.values)
     for i in xrange(length):
         sn.values[i] = values[i]
-    sn.nextA = _newSkipNodeS(height, NULL)
+    sn.nextA = _newSkipNodeS(arena, height, NULL)
     return sn
     
-cdef SkipNodeA* _newSkipNodeA(int height, long long index, float value):
+cdef SkipNodeA* _newSkipNodeA(Arena* arena, int height, long long index, float value):
     #height > 0
-    cdef SkipNodeA* sn = <SkipNodeA*>malloc(cython.sizeof(SkipNodeA))
+    cdef SkipNodeA* sn = _arenaNode(arena)
     _MEM_CHECK(sn)
     sn.height   = height
     sn.index    = index
@@ -148,12 +261,12 @@ cdef SkipNodeA* _newSkipNodeA(int height, long long index, float value):
     sn.values = <float*>calloc(sn.capacity, cython.sizeof(float))
     _MEM_CHECK(sn.values)
     sn.values[0] = value
-    sn.nextA = _newSkipNodeS(height, NULL)
+    sn.nextA = _newSkipNodeS(arena, height, NULL)
     return sn
 
-cdef SkipNodeA* _copySkipNodeA(SkipNodeA* other, float w):
+cdef SkipNodeA* _copySkipNodeA(Arena* arena, SkipNodeA* other, float w):
     cdef long i
-    cdef SkipNodeA* sn = <SkipNodeA*>malloc(cython.sizeof(SkipNodeA))
+    cdef SkipNodeA* sn = _arenaNode(arena)
     _MEM_CHECK(sn)
     sn.height = other.height
     sn.index = other.index
@@ -163,24 +276,43 @@ cdef SkipNodeA* _copySkipNodeA(SkipNodeA* other, float w):
     _MEM_CHECK(sn.values)
     for i in xrange(sn.length):
         sn.values[i] = other.values[i] * w
-    sn.nextA = _newSkipNodeS(sn.height, NULL)
+    sn.nextA = _newSkipNodeS(arena, sn.height, NULL)
     return sn
     
-cdef void _delSkipNodeA(SkipNodeA* sn):
+cdef void _delSkipNodeA(Arena* arena, SkipNodeA* sn):
     if (sn != NULL):
         if (sn.values != NULL):
             free(sn.values)
         if (sn.nextA != NULL):
-            free(sn.nextA)
-        free(sn)
+            _arenaFree(arena, &arena.freeLinks[sn.height], sn.nextA, cython.sizeof(SkipNodeA_t) * sn.height)
+        _arenaFree(arena, &arena.freeNodes, sn, _ALIGN(cython.sizeof(SkipNodeA)))
 
-cdef void _delSkipList(SkipNodeA* head):
+cdef void _delSkipList(Arena* arena, SkipNodeA* head):
+    # only the values are freed node by node, the rest goes with the slabs
     cdef SkipNodeA* currA = head
-    cdef SkipNodeA* nextA = head
     while(currA != NULL):
-        nextA = currA.nextA[0]
-        _delSkipNodeA(currA)
-        currA = nextA
+        if currA.values != NULL:
+            free(currA.values)
+        currA = currA.nextA[0]
+    _arenaRelease(arena)
+
+# cursor functions for walking a skip list alongside another one
+cdef struct Cursor:
+    SkipNodeA* node
+
+cdef inline float* _seek(Cursor* cursor, long long index):
+    # cursors only move forward, so indices must be visited in increasing order
+    while cursor.node != NULL and cursor.node.index + cursor.node.length <= index:
+        cursor.node = cursor.node.nextA[0]
+    if cursor.node != NULL and cursor.node.index <= index:
+        return cursor.node.values + (index - cursor.node.index)
+    return NULL
+
+cdef inline float _seekValue(Cursor* cursor, long long index):
+    cdef float* v = _seek(cursor, index)
+    if v == NULL:
+        return 0
+    return v[0]
 
 cdef class FlexibleVector(object):
     cdef int __index #used as back index holder
@@ -189,21 +321,22 @@ cdef class FlexibleVector(object):
     cdef long queries
     cdef SkipNodeA* head
     cdef SkipNodeA** found
+    cdef Arena arena
     
     def __init__(self, *arguments, **keywords):
         self.__index = -1
         self.queryLength = 1
         self.queries = 1
         self.height = 0
-        self.head   = _newSkipNodeA(MAX_HEIGHT, -1, -1)
-        self.found  = _newSkipNodeS(MAX_HEIGHT, self.head)
+        self.head   = _newSkipNodeA(&self.arena, MAX_HEIGHT, -1, -1)
+        self.found  = _newSkipNodeS(&self.arena, MAX_HEIGHT, self.head)
         if "generic" in keywords:
             self.update(keywords["generic"])
         
     def __dealloc__(self):
-        _delSkipList(self.head)
-        if self.found != NULL:
-            free(self.found)
+        _delSkipList(&self.arena, self.head)
+        self.head = NULL
+        self.found = NULL
         
     def __setitem__(self, key, value):
         self.upsert(key, value)
@@ -278,13 +411,23 @@ cdef class FlexibleVector(object):
     cpdef getIndex(self):
         return self.__index
         
-    def _memorySize(self):
-        cdef long long size = _SIZE_OF(self.head) + MAX_HEIGHT * cython.sizeof(SkipNodeA_t)
-        cdef SkipNodeA* currA = self.head.nextA[0]
+    def _memorySize(self, bint stats=False):
+        """ Bytes held by the slabs of the arena and by the values of the nodes,
+        with stats a dict of the allocator counters as well """
+        cdef long long values = 0
+        cdef SkipNodeA* currA = self.head
         while currA != NULL:
-            size += _SIZE_OF(currA)
+            values += currA.capacity * cython.sizeof(float)
             currA = currA.nextA[0]
-        return size
+        if not stats:
+            return self.arena.reserved + values
+        return {'total':self.arena.reserved + values,
+                'values':values,
+                'slabs':self.arena.numSlabs,
+                'reserved':self.arena.reserved,
+                'inUse':self.arena.inUse,
+                'free':self.arena.freeBytes,
+                'recycled':self.arena.recycled}
     
     def _numOfNodes(self):
         cdef long long size = 0
@@ -322,24 +465,220 @@ cdef class FlexibleVector(object):
             currA = currA.nextA[0]
         
     cpdef copyUpdate(self, FlexibleVector other):
+        # keeps the keys of self with zero values
+        if other is self:
+            return
+        self.clear()
+        self.add(other, 1)
+        
+    def update(self, f):
+        # bulk-insertion can not handle more than 2^32 entries although indices can exceed 2^32
+        if isinstance(f, bytes):
+            self._updateBinary(f)
+            return
+        cdef long i
+        cdef long n = len(f)
+        cdef long long* indices = <long long*>malloc(n * sizeof(long long))
+        cdef float* values = <float*>malloc(n * cython.sizeof(float))
+        if n > 0 and (indices == NULL or values == NULL):
+            free(indices)
+            free(values)
+            raise MemoryError()
+        try:
+            for i in xrange(n):
+                indices[i] = f[i][0]
+                values[i] = f[i][1]
+            self._updateArrays(indices, values, n)
+        finally:
+            free(indices)
+            free(values)
+    
+    cdef _updateArrays(self, long long* indices, float* values, long n):
+        cdef long i
+        if self.head.nextA[0] == NULL:
+            # an empty vector is built segment by segment when indices are sorted,
+            # which is always the case for data coming from generic() or encode()
+            for i in xrange(1, n):
+                if indices[i] <= indices[i - 1]:
+                    break
+            else:
+                self._appendRuns(indices, values, n)
+                return
+        for i in xrange(n):
+            self.upsert(indices[i], values[i])
+    
+    cdef _appendRuns(self, long long* indices, float* values, long n):
+        # indices must be strictly increasing and beyond the last index of self
+        cdef SkipNodeA* currA
+        cdef int height
+        cdef long s = 0
+        cdef long e
+        for height in xrange(MAX_HEIGHT):
+            self.found[height] = self.head
+        currA = self.head
+        for height in reversed(xrange(self.height)):
+            while currA.nextA[height] != NULL:
+                currA = currA.nextA[height]
+            self.found[height] = currA
+        while s < n:
+            e = s + 1
+            while e < n and indices[e] == indices[e - 1] + 1:
+                e += 1
+            currA = _newSkipNodeV(&self.arena, self.randomHeight(), indices[s], e - s, values + s)
+            for height in xrange(currA.height):
+                self.found[height].nextA[height] = currA
+                self.found[height] = currA
+            s = e
+    
+    @classmethod
+    def from_arrays(cls, indices, values):
+        """ Build a vector from sorted indices and their values in one pass.
+        Adjacent indices are packed into the same segment."""
+        cdef long long[::1] idx = np.ascontiguousarray(indices, dtype=np.int64)
+        cdef float[::1] val = np.ascontiguousarray(values, dtype=np.float32)
+        cdef long n = idx.shape[0]
+        cdef long i
+        if val.shape[0] != n:
+            raise ValueError('indices and values have different lengths {0} != {1}'.format(n, val.shape[0]))
+        for i in xrange(1, n):
+            if idx[i] <= idx[i - 1]:
+                raise ValueError('indices are not strictly increasing at position {0}'.format(i))
+        cdef FlexibleVector c = cls()
+        if n > 0:
+            c._appendRuns(&idx[0], &val[0], n)
+        return c
+    
+    def to_arrays(self, bint copy = True):
+        """ Return (indices, values) as int64 and float32 numpy arrays.
+        When the vector is a single segment and copy is False, values is a 
+        read-only view on the segment buffer, only valid until the next change 
+        of the vector, so read it right away and do not keep it."""
+        cdef long long size = 0
+        cdef long long k = 0
+        cdef long i
         cdef SkipNodeA* currA = self.head.nextA[0]
+        while currA != NULL:
+            size += currA.length
+            currA = currA.nextA[0]
+        indices = np.empty(size, dtype=np.int64)
+        cdef long long[::1] idx = indices
+        currA = self.head.nextA[0]
+        if not copy and currA != NULL and currA.nextA[0] == NULL:
+            for i in xrange(currA.length):
+                idx[i] = currA.index + i
+            return indices, np.asarray(_SegmentView.wrap(self, currA.values, currA.length))
+        values = np.empty(size, dtype=np.float32)
+        cdef float[::1] val = values
+        while currA != NULL:
+            for i in xrange(currA.length):
+                idx[k] = currA.index + i
+                val[k] = currA.values[i]
+                k += 1
+            currA = currA.nextA[0]
+        return indices, values
+            
+    def setValues(self, values):
+        """ Overwrite the values in key order, the inverse of to_arrays"""
+        cdef float[::1] val = np.ascontiguousarray(values, dtype=np.float32)
+        cdef long long k = 0
         cdef long i
+        cdef SkipNodeA* currA = self.head.nextA[0]
+        while currA != NULL:
+            k += currA.length
+            currA = currA.nextA[0]
+        if k != val.shape[0]:
+            raise ValueError('expecting {0} values but got {1}'.format(k, val.shape[0]))
+        k = 0
+        currA = self.head.nextA[0]
         while currA != NULL:
             for i in xrange(currA.length):
-                currA.values[i] = 0
+                currA.values[i] = val[k]
+                k += 1
             currA = currA.nextA[0]
-        currA = other.head.nextA[0]
+    
+    def encode(self):
+        """ Encode the non-zero entries in the compact binary format:
+        a version byte, the varint count, the varint index deltas
+        (the first index zigzagged), then the float32 values in little endian."""
+        cdef long long n = 0
+        cdef long i
+        cdef SkipNodeA* currA = self.head.nextA[0]
         while currA != NULL:
             for i in xrange(currA.length):
-                self.upsert(i + currA.index, currA.values[i])
+                if currA.values[i] != 0:
+                    n += 1
             currA = currA.nextA[0]
-        
-    def update(self, list f):
-        # bulk-insertion can not handle more than 2^32 entries although indices can exceed 2^32
+        # indices take at most 10 bytes each, values are staged at the tail
+        cdef unsigned char* buf = <unsigned char*>malloc(11 + n * 14)
+        _MEM_CHECK(buf)
+        cdef unsigned char* p = buf
+        cdef unsigned char* values = buf + 11 + n * 10
+        cdef unsigned char* pv = values
+        cdef long long index
+        cdef long long last = 0
+        cdef bint first = True
+        p[0] = ENCODING_VERSION
+        p = _writeVarint(p + 1, n)
+        currA = self.head.nextA[0]
+        while currA != NULL:
+            for i in xrange(currA.length):
+                if currA.values[i] == 0:
+                    continue
+                index = currA.index + i
+                if first:
+                    p = _writeVarint(p, (index << 1) ^ (index >> 63))
+                    first = False
+                else:
+                    p = _writeVarint(p, index - last)
+                last = index
+                _writeFloat(pv, currA.values[i])
+                pv += 4
+            currA = currA.nextA[0]
+        memmove(p, values, n * 4)
+        p += n * 4
+        try:
+            return PyBytes_FromStringAndSize(<char*>buf, p - buf)
+        finally:
+            free(buf)
+    
+    cdef _updateBinary(self, data):
+        # bson Binary is a subclass of bytes
+        cdef bytes raw = <bytes>data
+        cdef const unsigned char* p = raw
+        cdef const unsigned char* end = p + len(raw)
+        cdef unsigned long long n, delta
         cdef long i
-        for i in xrange(len(f)):
-            self.upsert(f[i][0], f[i][1])
-            
+        if p == end:
+            return
+        if p[0] != ENCODING_VERSION:
+            raise ValueError('unknown encoding version {0}'.format(p[0]))
+        p = _readVarint(p + 1, end, &n)
+        if p == NULL or <unsigned long long>(end - p) < n * 4:
+            raise ValueError('corrupted encoding')
+        cdef long long* indices = <long long*>malloc(n * sizeof(long long))
+        cdef float* values = <float*>malloc(n * cython.sizeof(float))
+        if n > 0 and (indices == NULL or values == NULL):
+            free(indices)
+            free(values)
+            raise MemoryError()
+        try:
+            for i in xrange(n):
+                p = _readVarint(p, end, &delta)
+                if p == NULL:
+                    raise ValueError('corrupted encoding')
+                if i == 0:
+                    indices[i] = <long long>(delta >> 1) ^ -<long long>(delta & 1)
+                else:
+                    indices[i] = indices[i - 1] + <long long>delta
+            if <unsigned long long>(end - p) != n * 4:
+                raise ValueError('corrupted encoding')
+            for i in xrange(n):
+                values[i] = _readFloat(p + 4 * i)
+            self._updateArrays(indices, values, n)
+        finally:
+            free(indices)
+            free(values)
+    
     def addKeys(self, list f):
         cdef long sz = len(f)
         cdef long i
@@ -364,11 +703,8 @@ cdef class FlexibleVector(object):
     def clone(self):
         cdef FlexibleVector c = FlexibleVector()
         cdef SkipNodeA* currA = self.head.nextA[0]
-        cdef int height
-        cdef long i
         while currA != NULL:
-            for i in xrange(currA.length):
-                c[currA.index + i] = currA.values[i]
+            c._link(_copySkipNodeA(&c.arena, currA, 1))
             currA = currA.nextA[0]
         return c
     
@@ -459,13 +795,14 @@ cdef class FlexibleVector(object):
         cdef int height
         if self.updateList(index):
             currA = self.found[0].nextA[0]
-            if currA.index > index:
+            if currA.index > index or currA.index + currA.length <= index:
+                # not a key, including the append position found by updateList
                 return
             
             if currA.length == 1:
                 for height in xrange(currA.height):
                     self.found[height].nextA[height] = currA.nextA[height]
-                _delSkipNodeA(currA)
+                _delSkipNodeA(&self.arena, currA)
                 self.redueHeight()
             else:
                 if currA.index == index:
@@ -481,7 +818,7 @@ cdef class FlexibleVector(object):
                     # split the node into two
                     newHeight = self.randomHeight()
                     delta = index + 1 - currA.index
-                    split = _newSkipNodeV(newHeight, index + 1, currA.length - delta, currA.values + delta)
+                    split = _newSkipNodeV(&self.arena, newHeight, index + 1, currA.length - delta, currA.values + delta)
                     currA.length = index - currA.index
                     currA.values[currA.length] = 0
                     for height in xrange(newHeight):
@@ -516,7 +853,7 @@ cdef class FlexibleVector(object):
 
         # insert a new node
         newHeight = self.randomHeight()
-        candidate = _newSkipNodeA(newHeight, index, value)
+        candidate = _newSkipNodeA(&self.arena, newHeight, index, value)
         for height in xrange(newHeight):
             candidate.nextA[height] = self.found[height].nextA[height]
             self.found[height].nextA[height] = candidate
@@ -547,7 +884,7 @@ cdef class FlexibleVector(object):
                         candidate.nextA[height] = neighbor.nextA[height]
                     else:
                         self.found[height].nextA[height] = neighbor.nextA[height]
-                _delSkipNodeA(neighbor)
+                _delSkipNodeA(&self.arena, neighbor)
                 self.redueHeight()
             
     cpdef scale(self, float w):
@@ -696,90 +1033,86 @@ cdef class FlexibleVector(object):
                 frontier = currA2.index
         return
         
+    cdef inline _link(self, SkipNodeA* sn):
+        # appends sn at the tail tracked by found
+        cdef int height
+        if sn.height > self.height:
+            self.height = sn.height
+        for height in xrange(sn.height):
+            sn.nextA[height] = NULL
+            self.found[height].nextA[height] = sn
+            self.found[height] = sn
+            
     cpdef add(self, FlexibleVector other, float w):
+        # merges the sorted segments of both vectors in one pass,
+        # segments of self covering the same range are updated in place
         cdef SkipNodeA* currA1 = self.head.nextA[0]
         cdef SkipNodeA* currA2 = other.head.nextA[0]
-        cdef SkipNodeA* neighbor
+        cdef SkipNodeA* first1
+        cdef SkipNodeA* first2
+        cdef SkipNodeA* nextA
+        cdef SkipNodeA* merged
+        cdef long long beg, end
+        cdef long num1, i
         cdef int height
-        cdef long i
-        cdef long deltaBeg, deltaEnd
-        cdef long oldLength
+        cdef bint grown
         
         if currA2 == NULL:
             return
+        if other is self:
+            self.scale(1 + w)
+            return
         
-        while currA2 != NULL:
-            self.updateList(currA2.index)
-            currA1 = self.found[0].nextA[0]
-            if currA1 == NULL:
-                break
-            deltaBeg = currA1.index - currA2.index
-            deltaEnd = currA2.length - currA1.length - deltaBeg
-            oldLength = currA1.length
-            # compute the new length and index
-            if deltaBeg > 0:
-                currA1.length += deltaBeg
-                currA1.index = currA2.index
-            if deltaEnd > 0:
-                currA1.length += deltaEnd
-            # increase memory if neccessary
-            if currA1.length > currA1.capacity:
-                currA1.capacity = currA1.length * 2
-                currA1.values = <float*>realloc(currA1.values, currA1.capacity * cython.sizeof(float))
-                _MEM_CHECK(currA1.values)
-            # add
-            if deltaBeg > 0:
-                # move values
-                for i in reversed(xrange(oldLength)):
-                    currA1.values[i + deltaBeg] = currA1.values[i]
-                for i in xrange(deltaBeg):
-                    currA1.values[i] = 0
-                deltaBeg = 0
-            if deltaEnd > 0:
-                # initialize to 0
-                for i in xrange(currA1.length - deltaEnd, currA1.length):
-                    currA1.values[i] = 0
-            for i in xrange(currA2.length):
-                currA1.values[i - deltaBeg] += currA2.values[i] * w
-            
-            if deltaEnd > 0:
-                # merge the neighboring node
-                neighbor = currA1.nextA[0]
-                while neighbor != NULL and neighbor.index <= currA1.index + currA1.length:
-                    deltaEnd = neighbor.index - currA1.index
-                    deltaBeg = _MIN(neighbor.length, currA1.index + currA1.length - neighbor.index)
-                    for i in xrange(deltaBeg):
-                        currA1.values[i + deltaEnd] += neighbor.values[i]
-                        
-                    # copy neighboring values
-                    oldLength = currA1.length
-                    currA1.length += neighbor.length - deltaBeg
-                    if currA1.length > currA1.capacity:
-                        currA1.capacity = currA1.length
-                        currA1.values = <float*>realloc(currA1.values, currA1.capacity * cython.sizeof(float))
-                        _MEM_CHECK(currA1.values)
-                    for i in xrange(neighbor.length - deltaBeg):
-                        currA1.values[oldLength + i] = neighbor.values[i + deltaBeg]
-                    # remove the neighboring node
-                    for height in xrange(neighbor.height):
-                        if self.found[height].nextA[height] == currA1:
-                            currA1.nextA[height] = neighbor.nextA[height]
-                        else:
-                            self.found[height].nextA[height] = neighbor.nextA[height]
-                    _delSkipNodeA(neighbor)
-                    self.redueHeight()
-                    neighbor = currA1.nextA[0]
-            currA2 = currA2.nextA[0]
+        for height in xrange(MAX_HEIGHT):
+            self.head.nextA[height] = NULL
+            self.found[height] = self.head
+        self.height = 0
+        while currA1 != NULL or currA2 != NULL:
+            # find the range of the next merged segment
+            if currA2 == NULL or (currA1 != NULL and currA1.index <= currA2.index):
+                beg = currA1.index
+            else:
+                beg = currA2.index
+            end = beg
+            first1 = currA1
+            first2 = currA2
+            num1 = 0
+            grown = True
+            while grown:
+                grown = False
+                while currA1 != NULL and currA1.index <= end:
+                    end = _MAX(end, currA1.index + currA1.length)
+                    currA1 = currA1.nextA[0]
+                    num1 += 1
+                    grown = True
+                while currA2 != NULL and currA2.index <= end:
+                    end = _MAX(end, currA2.index + currA2.length)
+                    currA2 = currA2.nextA[0]
+                    grown = True
             
-        # copy to the end
-        while currA2 != NULL:
-            currA1 = _copySkipNodeA(currA2, w)
-            if currA1.height > self.height:
-                self.height = currA1.height
-            for height in xrange(currA1.height):
-                self.found[height].nextA[height] = currA1
-                self.found[height] = currA1
-            currA2 = currA2.nextA[0]
+            if num1 == 1 and first1.index == beg and first1.length == end - beg:
+                merged = first1
+            else:
+                merged = _arenaNode(&self.arena)
+                _MEM_CHECK(merged)
+                merged.height = self.randomHeight()
+                merged.index = beg
+                merged.length = end - beg
+                merged.capacity = end - beg
+                merged.values = <float*>calloc(merged.capacity, cython.sizeof(float))
+                _MEM_CHECK(merged.values)
+                merged.nextA = _newSkipNodeS(&self.arena, merged.height, NULL)
+                while first1 != currA1:
+                    nextA = first1.nextA[0]
+                    for i in xrange(first1.length):
+                        merged.values[first1.index - beg + i] = first1.values[i]
+                    _delSkipNodeA(&self.arena, first1)
+                    first1 = nextA
+            while first2 != currA2:
+                for i in xrange(first2.length):
+                    merged.values[first2.index - beg + i] += first2.values[i] * w
+                first2 = first2.nextA[0]
+            self._link(merged)
     
     cpdef difference(self, FlexibleVector other, float tol = 1e-8):
         self.add(other, -1)
@@ -790,6 +1123,309 @@ cdef class FlexibleVector(object):
         self.trim(tol, False)
         self.foreach(_MATCH)
 
+cdef class _SegmentView(object):
+    # exposes the values of one segment read-only through the buffer protocol,
+    # holding a reference to the vector to keep the segment alive, the segment
+    # itself is reallocated or freed by the next change of the vector
+    cdef FlexibleVector owner
+    cdef float* values
+    cdef Py_ssize_t shape[1]
+    cdef Py_ssize_t strides[1]
+    
+    @staticmethod
+    cdef _SegmentView wrap(FlexibleVector owner, float* values, long length):
+        cdef _SegmentView view = _SegmentView.__new__(_SegmentView)
+        view.owner = owner
+        view.values = values
+        view.shape[0] = length
+        view.strides[0] = cython.sizeof(float)
+        return view
+    
+    def __getbuffer__(self, Py_buffer* buffer, int flags):
+        if flags & PyBUF_WRITABLE:
+            raise BufferError('segment views are read-only, use setValues to write')
+        buffer.buf = <char*>self.values
+        buffer.obj = self
+        buffer.len = self.shape[0] * cython.sizeof(float)
+        buffer.readonly = 1
+        buffer.itemsize = cython.sizeof(float)
+        buffer.format = NULL
+        if flags & PyBUF_FORMAT:
+            buffer.format = 'f'
+        buffer.ndim = 1
+        buffer.shape = NULL
+        if flags & PyBUF_ND:
+            buffer.shape = self.shape
+        buffer.strides = self.strides
+        buffer.suboffsets = NULL
+        buffer.internal = NULL
+    
+    def __releasebuffer__(self, Py_buffer* buffer):
+        pass
+
+cdef class FlexibleMatrix(object):
+    """ A stack of FlexibleVectors stored column-wise (CSC), so that the scores 
+    of all rows against one vector are computed in a single merged traversal.
+    It is a snapshot, rebuild it after the rows change."""
+    cdef readonly long numRows
+    cdef long long[::1] columns
+    cdef long long[::1] indptr
+    cdef int[::1] rows
+    cdef float[::1] data
+    
+    def __init__(self, vectors=()):
+        cdef FlexibleVector v
+        indices = []
+        values = []
+        rowIds = []
+        self.numRows = 0
+        for v in vectors:
+            index, value = v.to_arrays(copy=True)
+            nonzero = value != 0
+            indices.append(index[nonzero])
+            values.append(value[nonzero])
+            rowIds.append(np.empty(len(indices[-1]), dtype=np.int32))
+            rowIds[-1].fill(self.numRows)
+            self.numRows += 1
+        if not indices:
+            indices, values, rowIds = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float32)], [np.empty(0, dtype=np.int32)]
+        index = np.concatenate(indices)
+        # stable sort keeps the rows ordered inside each column
+        order = np.argsort(index, kind='mergesort')
+        index = index[order]
+        columns, starts = np.unique(index, return_index=True)
+        self.columns = np.ascontiguousarray(columns, dtype=np.int64)
+        self.indptr = np.append(starts, len(index)).astype(np.int64)
+        self.rows = np.ascontiguousarray(np.concatenate(rowIds)[order])
+        self.data = np.ascontiguousarray(np.concatenate(values)[order])
+    
+    def __len__(self):
+        return self.numRows
+    
+    def _numOfColumns(self):
+        return self.columns.shape[0]
+    
+    def dot(self, FlexibleVector other):
+        """ Returns the dot products of every row with other as a numpy array"""
+        result = np.zeros(self.numRows, dtype=np.float64)
+        cdef double[::1] scores = result
+        cdef long long numCols = self.columns.shape[0]
+        cdef long long c = 0
+        cdef long long lo, hi, mid, k, endIndex
+        cdef float v
+        cdef SkipNodeA* currA = other.head.nextA[0]
+        while currA != NULL and c < numCols:
+            # skip to the first column of this segment by bisection
+            lo = c
+            hi = numCols
+            while lo < hi:
+                mid = (lo + hi) >> 1
+                if self.columns[mid] < currA.index:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            c = lo
+            endIndex = currA.index + currA.length
+            while c < numCols and self.columns[c] < endIndex:
+                v = currA.values[self.columns[c] - currA.index]
+                if v != 0:
+                    for k in xrange(self.indptr[c], self.indptr[c + 1]):
+                        scores[self.rows[k]] += self.data[k] * v
+                c += 1
+            currA = currA.nextA[0]
+        return result
+
+cdef bint _covers(FlexibleVector a, FlexibleVector b):
+    # whether every segment of b lies inside one segment of a
+    cdef SkipNodeA* currA1 = a.head.nextA[0]
+    cdef SkipNodeA* currA2 = b.head.nextA[0]
+    while currA2 != NULL:
+        while currA1 != NULL and currA1.index + currA1.length <= currA2.index:
+            currA1 = currA1.nextA[0]
+        if currA1 == NULL or currA1.index > currA2.index or \
+           currA1.index + currA1.length < currA2.index + currA2.length:
+            return False
+        currA2 = currA2.nextA[0]
+    return True
+
+cdef inline _align(FlexibleVector a, FlexibleVector b):
+    # makes the keys of a include the keys of b
+    if not _covers(a, b):
+        a.add(b, 0)
+
+cpdef axpbypcz(FlexibleVector out, float a, FlexibleVector x, float b, FlexibleVector y, float c, FlexibleVector z):
+    """ out = a * x + b * y + c * z in one pass, out may be one of the inputs"""
+    _align(out, x)
+    _align(out, y)
+    _align(out, z)
+    cdef Cursor cx, cy, cz
+    cx.node = x.head.nextA[0]
+    cy.node = y.head.nextA[0]
+    cz.node = z.head.nextA[0]
+    cdef SkipNodeA* currA = out.head.nextA[0]
+    cdef long long index
+    cdef long i
+    while currA != NULL:
+        for i in xrange(currA.length):
+            index = currA.index + i
+            currA.values[i] = a * _seekValue(&cx, index) + b * _seekValue(&cy, index) + c * _seekValue(&cz, index)
+        currA = currA.nextA[0]
+
+cpdef tuple dualUpdate(FlexibleVector mu, FlexibleVector dq, FlexibleVector q, FlexibleVector z):
+    """ The ADMM dual step in one pass: dq = q - z, mu = mu + dq.
+    Returns |q - z|^2, |q|^2, |z|^2 and |mu|^2 after the update."""
+    _align(mu, q)
+    _align(mu, z)
+    _align(dq, mu)
+    cdef Cursor cmu, cq, cz
+    cmu.node = mu.head.nextA[0]
+    cq.node = q.head.nextA[0]
+    cz.node = z.head.nextA[0]
+    cdef SkipNodeA* currA = dq.head.nextA[0]
+    cdef double d2 = 0, q2 = 0, z2 = 0, mu2 = 0
+    cdef float vq, vz, d
+    cdef float* vmu
+    cdef long long index
+    cdef long i
+    while currA != NULL:
+        for i in xrange(currA.length):
+            index = currA.index + i
+            vq = _seekValue(&cq, index)
+            vz = _seekValue(&cz, index)
+            d = vq - vz
+            currA.values[i] = d
+            vmu = _seek(&cmu, index)
+            if vmu != NULL:
+                vmu[0] += d
+                mu2 += vmu[0] * vmu[0]
+            d2 += d * d
+            q2 += vq * vq
+            z2 += vz * vz
+        currA = currA.nextA[0]
+    return d2, q2, z2, mu2
+
+cpdef tuple primalUpdate(FlexibleVector q, FlexibleVector dq, FlexibleVector z, FlexibleVector w, FlexibleVector mu, float r):
+    """ The ADMM consensus step in one pass: q' = r * z + (1 - r) * w - r * mu, 
+    dq = dq + q' - q, q = q'. Returns |q' - w|^2, |q'|^2 and |w|^2."""
+    _align(q, z)
+    _align(q, w)
+    _align(q, mu)
+    _align(dq, q)
+    cdef Cursor cq, cz, cw, cmu
+    cq.node = q.head.nextA[0]
+    cz.node = z.head.nextA[0]
+    cw.node = w.head.nextA[0]
+    cmu.node = mu.head.nextA[0]
+    cdef SkipNodeA* currA = dq.head.nextA[0]
+    cdef double d2 = 0, q2 = 0, w2 = 0
+    cdef float vw, vq
+    cdef float* pq
+    cdef long long index
+    cdef long i
+    while currA != NULL:
+        for i in xrange(currA.length):
+            index = currA.index + i
+            pq = _seek(&cq, index)
+            if pq == NULL:
+                continue
+            vw = _seekValue(&cw, index)
+            vq = r * _seekValue(&cz, index) + (1 - r) * vw - r * _seekValue(&cmu, index)
+            currA.values[i] += vq - pq[0]
+            pq[0] = vq
+            d2 += (vq - vw) * (vq - vw)
+            q2 += vq * vq
+            w2 += vw * vw
+        currA = currA.nextA[0]
+    return d2, q2, w2
+
+cdef void _merged(FlexibleVector a, FlexibleVector b, double* out):
+    # out = |a - b|^2, |a|^2, |b|^2 and a.b in one merged pass over the runs of
+    # both lists, without materializing the difference
+    cdef SkipNodeA* n1 = a.head.nextA[0]
+    cdef SkipNodeA* n2 = b.head.nextA[0]
+    cdef long i1 = 0, i2 = 0, j, m
+    cdef long long k1, k2
+    cdef double v1, v2, d2 = 0, a2 = 0, b2 = 0, ab = 0
+    while n1 != NULL and n2 != NULL:
+        k1 = n1.index + i1
+        k2 = n2.index + i2
+        if k1 < k2:
+            m = <long>_MIN(n1.length, i1 + k2 - k1)
+            for j in xrange(i1, m):
+                v1 = n1.values[j]
+                a2 += v1 * v1
+                d2 += v1 * v1
+            i1 = m
+        elif k2 < k1:
+            m = <long>_MIN(n2.length, i2 + k1 - k2)
+            for j in xrange(i2, m):
+                v2 = n2.values[j]
+                b2 += v2 * v2
+                d2 += v2 * v2
+            i2 = m
+        else:
+            m = <long>_MIN(n1.length - i1, n2.length - i2)
+            for j in xrange(m):
+                v1 = n1.values[i1 + j]
+                v2 = n2.values[i2 + j]
+                a2 += v1 * v1
+                b2 += v2 * v2
+                ab += v1 * v2
+                d2 += (v1 - v2) * (v1 - v2)
+            i1 += m
+            i2 += m
+        if i1 >= n1.length:
+            n1 = n1.nextA[0]
+            i1 = 0
+        if i2 >= n2.length:
+            n2 = n2.nextA[0]
+            i2 = 0
+    # the keys left in one list only
+    while n1 != NULL:
+        for j in xrange(i1, n1.length):
+            v1 = n1.values[j]
+            a2 += v1 * v1
+            d2 += v1 * v1
+        n1 = n1.nextA[0]
+        i1 = 0
+    while n2 != NULL:
+        for j in xrange(i2, n2.length):
+            v2 = n2.values[j]
+            b2 += v2 * v2
+            d2 += v2 * v2
+        n2 = n2.nextA[0]
+        i2 = 0
+    out[0] = d2
+    out[1] = a2
+    out[2] = b2
+    out[3] = ab
+
+cpdef tuple norms2(FlexibleVector a, FlexibleVector b):
+    """ |a - b|^2, |a|^2, |b|^2 and a.b in one pass """
+    cdef double out[4]
+    _merged(a, b, out)
+    return out[0], out[1], out[2], out[3]
+
+cpdef double distance2(FlexibleVector a, FlexibleVector b):
+    """ |a - b|^2 without building a - b """
+    cdef double out[4]
+    _merged(a, b, out)
+    return out[0]
+
+cpdef double cosine(FlexibleVector a, FlexibleVector b):
+    """ a.b / (|a| |b|), 0 when either is zero """
+    cdef double out[4]
+    _merged(a, b, out)
+    if out[1] <= 0 or out[2] <= 0:
+        return 0.0
+    return out[3] / sqrt(out[1] * out[2])
+
+cpdef double relativeResidual(FlexibleVector a, FlexibleVector b, double eps = 1e-8):
+    """ sqrt((|a - b|^2 + eps) / (|a| |b| + eps)), the convergence of a to b """
+    cdef double out[4]
+    _merged(a, b, out)
+    return sqrt((out[0] + eps) / (sqrt(out[1] * out[2]) + eps))
+
 cpdef FlexibleVector difference(FlexibleVector a, FlexibleVector b, float tol = 1e-8):
     cdef FlexibleVector c = FlexibleVector()
     c.add(a,  1)
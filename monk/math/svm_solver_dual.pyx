@@ -3,7 +3,6 @@
 Created on Sat Feb 01 18:43:29 2014
 Solving a linear svm in dual
 
-@todo: memory pool
 @todo: online normalization
 @author: pacif_000
 """
@@ -13,6 +12,7 @@ from __future__ import division
 cimport cython
 from libc.stdlib cimport malloc, free, calloc, rand
 from monk.math.flexible_vector import FlexibleVector
+import numpy as np
 import logging
 logger = logging.getLogger('monk.svm_solver_dual')
 
@@ -32,18 +32,113 @@ cdef inline int mins(int v1, int v2, int v3):
         else:
             return v1
     
-cdef inline float max(float v1, float v2):
+cdef inline float max(float v1, float v2) nogil:
     if v1 > v2:
         return v1
     else:
         return v2
 
-cdef inline float min(float v1, float v2):
+cdef inline float min(float v1, float v2) nogil:
     if v1 > v2:
         return v2
     else:
         return v1
 
+cdef inline void swap(int* index, int j, int k) nogil:
+    cdef int tmp
+    tmp = index[j]
+    index[j] = index[k]
+    index[k] = tmp
+
+cdef void accumulate(int num_instances, int* y, float* alpha,
+                     long long* indptr, long long* columns, float* values,
+                     float* w) nogil:
+    cdef int j
+    cdef long long p
+    cdef float d
+    for j in range(num_instances):
+        d = alpha[j] * y[j]
+        if d != 0:
+            for p in range(indptr[j], indptr[j + 1]):
+                w[columns[p]] += d * values[p]
+
+cdef int coordinateDescent(int num_instances, int max_num_iters, float eps, float rho0,
+                           int* index, int* y, float* c, float* QD, float* alpha,
+                           long long* indptr, long long* columns, float* values,
+                           float* w) nogil:
+    """ Dual coordinate descent over the packed instances, columns index into w.
+    Returns the number of iterations."""
+    cdef int j, k, s, yj, iteration
+    cdef long long p
+    cdef float d, G, alpha_old
+    cdef int active_size = num_instances
+
+    # PG: projected gradient, for shrinking and stopping
+    cdef float PG
+    cdef float PGmax_old = 1e10
+    cdef float PGmin_old = -1e10
+    cdef float PGmax_new
+    cdef float PGmin_new
+    iteration = 0
+    while iteration < max_num_iters:
+        PGmax_new = -1e10
+        PGmin_new = 1e10
+        for j in range(active_size):
+            k = j + rand() % (active_size - j)
+            swap(index, j, k)
+
+        s = 0
+        while s < active_size:
+            j  = index[s]
+            yj = y[j]
+            
+            G = 0
+            for p in range(indptr[j], indptr[j + 1]):
+                G += w[columns[p]] * values[p]
+            G = G * yj - 1
+            G += alpha[j] * rho0 / c[j]
+            
+            PG = 0
+            if alpha[j] <= 0:
+                if G > PGmax_old:
+                    active_size -= 1
+                    swap(index, s, active_size)
+                    continue
+                elif G < 0:
+                    PG = G
+            else:
+                PG = G
+            
+            PGmax_new = max(PGmax_new, PG)
+            PGmin_new = min(PGmin_new, PG)
+            
+            if PG > 1e-12 or PG < -1e-12:
+                alpha_old = alpha[j]
+                alpha[j] = max(alpha[j] - G / QD[j], 0)
+                d = (alpha[j] - alpha_old) * yj
+                for p in range(indptr[j], indptr[j + 1]):
+                    w[columns[p]] += d * values[p]
+            s += 1
+                    
+        iteration += 1
+
+        if PGmax_new - PGmin_new <= eps:
+            if active_size == num_instances:
+                break
+            else:
+                active_size = num_instances
+                PGmax_old = 1e10
+                PGmin_old = -1e10
+                continue
+            
+        PGmax_old = PGmax_new
+        PGmin_old = PGmin_new
+        if PGmax_old <= 0:
+            PGmax_old = 1e10
+        if PGmin_old >= 0:
+            PGmin_old = -1e10
+    return iteration
+
 cdef class SVMDual(object):
     cpdef public float eps
     cpdef public float lam
@@ -77,36 +172,19 @@ cdef class SVMDual(object):
         self.rho0 = rho * gamma / (2 * (rho + gamma))
         
         self.x     = [None for j in xrange(self.max_num_instances)]
-        self.y     = <int*>calloc(self.max_num_instances, cython.sizeof(int))
+        # one block holds all the arrays of the instances
+        self.y     = <int*>calloc(self.max_num_instances, 2 * cython.sizeof(int) + 3 * cython.sizeof(float))
         _MEM_CHECK(self.y)
-        self.index = <int*>calloc(self.max_num_instances, cython.sizeof(int))
-        _MEM_CHECK(self.index)
-        self.QD    = <float*>calloc(self.max_num_instances, cython.sizeof(float))
-        _MEM_CHECK(self.QD)
-        self.alpha = <float*>calloc(self.max_num_instances, cython.sizeof(float))
-        _MEM_CHECK(self.alpha)
-        self.c     = <float*>calloc(self.max_num_instances, cython.sizeof(float))
-        _MEM_CHECK(self.c)
+        self.index = self.y + self.max_num_instances
+        self.QD    = <float*>(self.index + self.max_num_instances)
+        self.alpha = self.QD + self.max_num_instances
+        self.c     = self.alpha + self.max_num_instances
         for j in xrange(self.max_num_instances):
             self.index[j] = j
             
-    def __del__(self):
+    def __dealloc__(self):
         if self.y != NULL:
             free(self.y)
-        if self.index != NULL:
-            free(self.index)
-        if self.QD != NULL:
-            free(self.QD)
-        if self.alpha != NULL:
-            free(self.alpha)
-        if self.c != NULL:
-            free(self.c)
-
-    cdef inline swap(self, int* index, int j, int k):
-        cdef int tmp
-        tmp = index[j]
-        index[j] = index[k]
-        index[k] = tmp
 
     def initialize(self):
         cdef int j
@@ -152,11 +230,39 @@ cdef class SVMDual(object):
         self.w.addFast(mu, -1)
         
     def setModel(self, z, mu):
-        cdef int j
+        # warm start, w = z - mu + sum_j alpha_j * y_j * x_j
         self.w.copyUpdate(z)
-        for j in xrange(self.num_instances):
-            self.w.addFast(self.x[j], self.y[j] * self.alpha[j])
         self.w.addFast(mu, -1)
+        if self.num_instances <= 0:
+            return
+        wIndices, wValues = self.w.to_arrays(copy=True)
+        indptr, columns, values = self.pack(wIndices)
+        cdef long long[::1] indptrV = indptr
+        cdef long long[::1] columnsV = columns
+        cdef float[::1] valuesV = values
+        cdef float[::1] wV = wValues
+        if columnsV.shape[0] > 0:
+            with nogil:
+                accumulate(self.num_instances, self.y, self.alpha,
+                           &indptrV[0], &columnsV[0], &valuesV[0], &wV[0])
+        self.w.setValues(wValues)
+    
+    def getAlphas(self):
+        cdef int j
+        alphas = np.zeros(self.num_instances, dtype=np.float32)
+        cdef float[::1] alphasV = alphas
+        for j in xrange(self.num_instances):
+            alphasV[j] = self.alpha[j]
+        return alphas
+    
+    def setAlphas(self, alphas):
+        cdef float[::1] alphasV = np.ascontiguousarray(alphas, dtype=np.float32)
+        cdef int j
+        cdef int n = alphasV.shape[0]
+        if n > self.max_num_instances:
+            n = self.max_num_instances
+        for j in xrange(n):
+            self.alpha[j] = max(alphasV[j], 0)
     
     def setGamma(self, gamma):
         self.gamma = gamma
@@ -168,74 +274,57 @@ cdef class SVMDual(object):
         self.rho0 = self.rho * self.gamma / (2 * (self.rho + self.gamma))
         logger.debug('rho = {0}, gamma = {1}, rho0 = {2}'.format(self.rho, self.gamma, self.rho0))
                 
-    def trainModel(self):
-        cdef int j, k, s, iteration
-        cdef float d, G, alpha_old
-        cdef int active_size = self.num_instances
-        cdef int* index = self.index
-        cdef float* alpha = self.alpha
-        cdef float* QD = self.QD
-        cdef int yj
+    def pack(self, wIndices):
+        """ Pack the instances into a CSR store whose columns are positions in
+        wIndices. Keys that are not in w are dropped, as addFast does."""
+        cdef int j
+        cdef int n = self.num_instances
+        indices = [np.empty(0, dtype=np.int64)]
+        values = [np.empty(0, dtype=np.float32)]
+        lengths = np.zeros(n, dtype=np.int64)
+        for j in xrange(n):
+            # the views are only read before any change of x
+            xIndices, xValues = self.x[j].to_arrays(copy=False)
+            indices.append(xIndices)
+            values.append(xValues)
+            lengths[j] = len(xIndices)
+        indices = np.concatenate(indices)
+        values = np.concatenate(values)
+        if len(wIndices) > 0:
+            columns = np.searchsorted(wIndices, indices)
+            np.minimum(columns, len(wIndices) - 1, out=columns)
+            found = wIndices[columns] == indices
+        else:
+            columns = indices
+            found = np.zeros(len(indices), dtype=bool)
+        counts = np.bincount(np.repeat(np.arange(n), lengths)[found], minlength=n)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return indptr, np.ascontiguousarray(columns[found], dtype=np.int64), np.ascontiguousarray(values[found])
     
-        # PG: projected gradient, for shrinking and stopping
-        cdef float PG
-        cdef float PGmax_old = 1e10
-        cdef float PGmin_old = -1e10
-        cdef float PGmax_new
-        cdef float PGmin_new
+    def trainModel(self):
+        cdef int iteration
         logger.debug('rho0 in svm_solver_dual.trainModel {0}'.format(self.rho0))
         logger.debug('num_instances {0}'.format(self.num_instances))
-        iteration = 0
-        while iteration < self.max_num_iters:
-            PGmax_new = -1e10
-            PGmin_new = 1e10
-            for j in xrange(active_size):
-                k = j + rand() % (active_size - j)
-                self.swap(index, j, k)
-
-            for s in xrange(active_size):
-                j  = index[s]
-                yj = self.y[j]
-                xj = self.x[j]
-                
-                G = self.w.dot(xj) * yj - 1
-                G += alpha[j] * self.rho0 / self.c[j]
-                
-                PG = 0
-                if alpha[j] <= 0:
-                    if G > PGmax_old:
-                        active_size -= 1
-                        self.swap(index, s, active_size)
-                        s -= 1
-                        continue
-                    elif G < 0:
-                        PG = G
-                else:
-                    PG = G
-                
-                PGmax_new = max(PGmax_new, PG)
-                PGmin_new = min(PGmin_new, PG)
-                
-                if PG > 1e-12 or PG < -1e-12:
-                    alpha_old = alpha[j]
-                    alpha[j] = max(alpha[j] - G / QD[j], 0)
-                    d = (alpha[j] - alpha_old) * yj
-                    self.w.addFast(xj, d)
-                        
-            iteration += 1
-
-            if PGmax_new - PGmin_new <= self.eps:
-                if active_size == self.num_instances:
-                    break
-                else:
-                    active_size = self.num_instances
-                    PGmax_old = 1e10
-                    PGmin_old = -1e10
-                    continue
-                
-            PGmax_old = PGmax_new
-            PGmin_old = PGmin_new
-            if PGmax_old <= 0:
-                PGmax_old = 1e10
-            if PGmin_old >= 0:
-                PGmin_old = -1e10
+        if self.num_instances <= 0:
+            return 0
+        wIndices, wValues = self.w.to_arrays(copy=True)
+        indptr, columns, values = self.pack(wIndices)
+        cdef long long[::1] indptrV = indptr
+        cdef long long[::1] columnsV = columns
+        cdef float[::1] valuesV = values
+        cdef float[::1] wV = wValues
+        cdef long long* columnsP = NULL
+        cdef float* valuesP = NULL
+        cdef float* wP = NULL
+        if columnsV.shape[0] > 0:
+            columnsP = &columnsV[0]
+            valuesP = &valuesV[0]
+            wP = &wV[0]
+        with nogil:
+            iteration = coordinateDescent(self.num_instances, self.max_num_iters, self.eps, self.rho0,
+                                          self.index, self.y, self.c, self.QD, self.alpha,
+                                          &indptrV[0], columnsP, valuesP, wP)
+        self.w.setValues(wValues)
+        logger.debug('iterations {0}'.format(iteration))
+        return iteration
@@ -9,15 +9,22 @@ import logging
 from kafka.client import KafkaClient
 from kafka.producer.keyed import KeyedProducer
 from producer import FixedProducer, UserProducer
+from codec import create_codec
 from kafka.producer import SimpleProducer
 from kafka.consumer.simple import SimpleConsumer
 from kafka.common import KafkaError
-import simplejson
+from kafka.protocol import CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY
+from Queue import Queue, Empty, Full
+from collections import defaultdict
+import threading
+import time
 import traceback
 
 logger = logging.getLogger('monk.network.broker')
 
 COUNT_DOWN = 10
+CODECS = {None:CODEC_NONE, 'none':CODEC_NONE, 'gzip':CODEC_GZIP, 'snappy':CODEC_SNAPPY}
+
 class KafkaBroker(object):
     USER_PRODUCER = 0
     FIXED_PRODUCER = 1
@@ -29,20 +36,47 @@ class KafkaBroker(object):
     
     def __init__(self, kafkaHost=None, kafkaGroup=None, kafkaTopic=None, 
                  consumerType=NON_CONSUMER, consumerPartitions=[],
-                 producerType=NON_PRODUCER, producerPartitions=[]):
+                 producerType=NON_PRODUCER, producerPartitions=[], producerOptions=None, wireFormat=None):
+        """
+        wireFormat - json (default) or msgpack, consumers read both
+        producerOptions - None sends every message synchronously, otherwise a dict of
+                          bufferSize: messages held in memory before produce blocks
+                          putTimeout: seconds produce blocks on a full buffer before dropping,
+                                      None blocks until there is room
+                          batchSize: messages sent in one request
+                          batchInterval: seconds to wait for a batch to fill
+                          codec: none, gzip or snappy
+        """
         self.kafkaHost = kafkaHost
         self.kafkaGroup = kafkaGroup
         self.kafkaTopic = kafkaTopic
         self.consumerPartitions = consumerPartitions
         self.producerPartitions = producerPartitions
         self.connect(kafkaHost)
+        self.producerOptions = producerOptions or {}
+        self.codec = create_codec(wireFormat)
+        self.sendQueue = None
+        self.sender = None
+        self.senderClient = None
+        self.statsLock = threading.Lock()
+        self.sent = self.dropped = 0
+        self.latency = self.maxLatency = 0.0
+        codec = CODECS[self.producerOptions.get('codec')]
         try:
+            producerClient = self.kafkaClient
+            if producerOptions and producerType != self.NON_PRODUCER:
+                # the client is not thread safe, the sender thread has its own connections
+                self.senderClient = self.kafkaClient.copy()
+                self.senderClient.reinit()
+                producerClient = self.senderClient
             if producerType == self.SIMPLE_PRODUCER:
-                self.producer = SimpleProducer(self.kafkaClient, async=False, req_acks=KeyedProducer.ACK_NOT_REQUIRED)
+                self.producer = SimpleProducer(producerClient, async=False, req_acks=KeyedProducer.ACK_NOT_REQUIRED, codec=codec)
             elif producerType == self.FIXED_PRODUCER:
-                self.producer = FixedProducer(self.kafkaClient, producerPartitions[0], async=False, req_acks=KeyedProducer.ACK_NOT_REQUIRED)
+                self.producer = FixedProducer(producerClient, producerPartitions[0], async=False, req_acks=KeyedProducer.ACK_NOT_REQUIRED, codec=codec)
             elif producerType == self.USER_PRODUCER:
-                self.producer = UserProducer(self.kafkaClient, async=False, req_acks=KeyedProducer.ACK_NOT_REQUIRED)
+                # users are routed on the producing thread, by the metadata of its client
+                self.producer = UserProducer(producerClient, async=False, req_acks=KeyedProducer.ACK_NOT_REQUIRED, codec=codec,
+                                             metadataClient=self.kafkaClient)
             elif producerType == self.NON_PRODUCER:
                 self.producer = None
             else:
@@ -66,8 +100,20 @@ class KafkaBroker(object):
             self.consumer = None
             self.producer = None
             self.kafkaClient = None
+            self.senderClient = None
+        
+        if self.producer and producerOptions:
+            self.sendQueue = Queue(self.producerOptions.get('bufferSize', 10000))
+            self.sender = threading.Thread(target=self._send_loop, name='sender-{}'.format(kafkaTopic))
+            self.sender.daemon = True
+            self.sender.start()
             
     def close(self):
+        if self.sender:
+            # sends what is left in the buffer
+            self.sendQueue.put(None)
+            self.sender.join()
+            self.sender = None
         if self.consumer:
             self.consumer.commit()
             self.consumer.stop()
@@ -75,6 +121,9 @@ class KafkaBroker(object):
         if self.producer:
             self.producer.stop()
             self.producer = None
+        if self.senderClient:
+            self.senderClient.close()
+            self.senderClient = None
         if self.kafkaClient:
             self.kafkaClient.close()
             self.kafkaClient = None
@@ -93,27 +142,49 @@ class KafkaBroker(object):
             
         logger.info('Kafka client connected {}'.format(self.kafkaClient))
         
-    def reconnect(self, countdown=COUNT_DOWN):
+    def reconnect(self, countdown=COUNT_DOWN, client=None):
+        """ Reconnects the client of the calling thread, the sender thread passes its own """
         if countdown == 0:
             logger.error('kafka server can not be connected in {} times'.format(COUNT_DOWN))
             return
-            
+        
+        if client is None:
+            client = self.kafkaClient
         try:
-            self.kafkaClient.reinit()
+            client.reinit()
         except:
-            self.reconnect(countdown - 1)
+            self.reconnect(countdown - 1, client)
+            return
+        # the partitions of the topics may have changed
+        try:
+            self.producer.refresh_partitions()
+        except AttributeError:
+            pass
         
     def produce(self, op, name, **kwargs):
         # TODO: when name is None, the operation is propagated to all partitions 
+        self.produce_many(op, name, [kwargs])
+    
+    def produce_many(self, op, name, kwargsList):
+        """ Produces one task of op for each kwargs, the binary wire format 
+        carries them in one message"""
         if not op or not name:
             logger.warning('op or name must not be empty')
             return
         try:
-            dictMessage = dict(kwargs)
-            dictMessage['op'] = op
-            dictMessage['name'] = name
-            encodedMessage = simplejson.dumps(dictMessage)
-            self.producer.send(self.kafkaTopic, name, encodedMessage)
+            dictMessages = []
+            for kwargs in kwargsList:
+                dictMessage = dict(kwargs)
+                dictMessage['op'] = op
+                dictMessage['name'] = name
+                dictMessages.append(dictMessage)
+            if self.sendQueue:
+                # the route is found here, the sender thread never touches the stores
+                partition = self._partition(name)
+                for dictMessage in dictMessages:
+                    self._enqueue(partition, name, dictMessage)
+            else:
+                self.producer.send(self.kafkaTopic, name, *self._encode(dictMessages))
         except KafkaError as e:
             logger.warning('Exception {}'.format(e))
             logger.debug(traceback.format_exc())
@@ -122,6 +193,91 @@ class KafkaBroker(object):
             logger.warning('Exception {}'.format(e))
             logger.debug(traceback.format_exc())
 
+    def _encode(self, dictMessages):
+        if self.codec.envelope:
+            return [self.codec.encode(dictMessages)]
+        return [self.codec.encode([dictMessage]) for dictMessage in dictMessages]
+    
+    def _partition(self, name):
+        # None for producers that pick the partition by themselves
+        partition_of = getattr(self.producer, 'partition_of', None)
+        if partition_of is None:
+            return None
+        return partition_of(self.kafkaTopic, name)
+    
+    def _enqueue(self, partition, name, dictMessage):
+        # backpressure, blocks for putTimeout on a full buffer and then drops
+        try:
+            self.sendQueue.put((partition, name, dictMessage, time.time()),
+                               timeout=self.producerOptions.get('putTimeout', 0.01))
+        except Full:
+            with self.statsLock:
+                self.dropped += 1
+            logger.debug('send buffer of {} is full, message dropped'.format(self.kafkaTopic))
+    
+    def _send_loop(self):
+        batchSize = self.producerOptions.get('batchSize', 100)
+        batchInterval = self.producerOptions.get('batchInterval', 0.05)
+        running = True
+        while running:
+            batch = []
+            deadline = time.time() + batchInterval
+            while len(batch) < batchSize:
+                try:
+                    item = self.sendQueue.get(timeout=max(0, deadline - time.time()))
+                except Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            if batch:
+                self._send_batch(batch)
+    
+    def _send_batch(self, batch):
+        # one request per partition, or per user when the producer picks the partition
+        messages = defaultdict(list)
+        for partition, name, dictMessage, enqueueTime in batch:
+            messages[(partition, name if partition is None else None)].append(dictMessage)
+        try:
+            for (partition, name), dictMessages in messages.iteritems():
+                if partition is None:
+                    self.producer.send(self.kafkaTopic, name, *self._encode(dictMessages))
+                else:
+                    self.producer.send_messages(self.kafkaTopic, partition, *self._encode(dictMessages))
+        except KafkaError as e:
+            logger.warning('Exception {}'.format(e))
+            logger.debug(traceback.format_exc())
+            self.reconnect(client=self.senderClient)
+            with self.statsLock:
+                self.dropped += len(batch)
+            return
+        except Exception as e:
+            logger.warning('Exception {}'.format(e))
+            logger.debug(traceback.format_exc())
+            with self.statsLock:
+                self.dropped += len(batch)
+            return
+        sentTime = time.time()
+        latencies = [sentTime - enqueueTime for partition, name, dictMessage, enqueueTime in batch]
+        with self.statsLock:
+            self.sent += len(batch)
+            self.latency += sum(latencies)
+            self.maxLatency = max(self.maxLatency, max(latencies))
+        
+    def producer_stats(self, reset=False):
+        """ Messages sent and dropped, and the average and max seconds 
+        spent in the send buffer"""
+        with self.statsLock:
+            result = {'sent':self.sent, 'dropped':self.dropped,
+                      'latency':self.latency / self.sent if self.sent else 0.0,
+                      'maxLatency':self.maxLatency,
+                      'buffered':self.sendQueue.qsize() if self.sendQueue else 0}
+            if reset:
+                self.sent = self.dropped = 0
+                self.latency = self.maxLatency = 0.0
+        return result
+        
     def echo(self, message=''):
         self.produce('Echo', 'testing', message=message)
         
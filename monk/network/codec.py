@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:02:37 2026
+Wire formats of the tasks sent through kafka
+@author: xm
+"""
+
+import logging
+import simplejson
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger('monk.network.codec')
+
+# the first byte of a binary message, json messages always start with '{'
+VERSION = '\x01'
+
+# op -> the ordered fields of the task, sent by position instead of by name
+schemas = {}
+
+def register_schema(op, fields):
+    fields = tuple(fields)
+    if schemas.get(op, fields) != fields:
+        logger.warning('schema of {} changed from {} to {}'.format(op, schemas[op], fields))
+    schemas[op] = fields
+
+class JsonCodec(object):
+    """ One task per message, as a json object """
+    name = 'json'
+    envelope = False
+
+    def encode(self, dictMessages):
+        if len(dictMessages) != 1:
+            raise ValueError('json carries one task per message')
+        return simplejson.dumps(dictMessages[0])
+
+    def decode(self, message):
+        generic = simplejson.loads(message)
+        if isinstance(generic, list):
+            return generic
+        return [generic]
+
+class BinaryCodec(object):
+    """ VERSION followed by a msgpack list of [op, name, values, extras] per task,
+    values are in the order of the registered schema of op (None without a schema)
+    and extras holds the fields out of the schema. One message can carry many tasks,
+    a task that does not match its schema is skipped without losing the others.
+    """
+    name = 'msgpack'
+    envelope = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('msgpack is not installed')
+
+    def encode(self, dictMessages):
+        tasks = []
+        for dictMessage in dictMessages:
+            extras = dict(dictMessage)
+            op = extras.pop('op')
+            name = extras.pop('name', None)
+            fields = schemas.get(op)
+            if fields:
+                values = [extras.pop(field, None) for field in fields]
+            else:
+                values = None
+            tasks.append([op, name, values, extras or None])
+        return VERSION + msgpack.packb(tasks, use_bin_type=True)
+
+    def decode(self, message):
+        dictMessages = []
+        for op, name, values, extras in msgpack.unpackb(message[1:], raw=False):
+            dictMessage = extras or {}
+            if values is not None:
+                fields = schemas.get(op, ())
+                if len(fields) != len(values):
+                    logger.warning('schema {} does not match values {} of {} for {}, task skipped'.format(
+                                   fields, values, op, name))
+                    continue
+                dictMessage.update((field, value) for field, value in zip(fields, values)
+                                   if value is not None)
+            dictMessage['op'] = op
+            dictMessage['name'] = name
+            dictMessages.append(dictMessage)
+        return dictMessages
+
+codecs = {'json':JsonCodec, 'msgpack':BinaryCodec}
+
+def create_codec(wireFormat=None):
+    try:
+        return codecs[wireFormat or 'json']()
+    except ImportError as e:
+        logger.warning('{}, falling back to json'.format(e))
+        return JsonCodec()
+
+_json = JsonCodec()
+_binary = BinaryCodec() if msgpack else None
+
+def decode(message):
+    """ Decodes the tasks in either format, binary messages are skipped without msgpack """
+    if message[:1] == VERSION:
+        if _binary is None:
+            logger.warning('msgpack is not installed, binary message skipped')
+            return []
+        return _binary.decode(message)
+    return _json.decode(message)
@@ -6,39 +6,106 @@ Created on Sun Oct  5 14:38:22 2014
 """
 
 import logging
+import time
+from bisect import bisect
+from hashlib import md5
 from kafka.partitioner.base import Partitioner
 import monk.core.api as monkapi
-from itertools import cycle
 
 logger = logging.getLogger('monk.network.partitioner')
 
+class ConsistentHash(object):
+    """
+    A hash ring of the partitions, a key keeps its partition when partitions are added or removed
+    unless it moves to the new one
+    """
+    def __init__(self, partitions, replicas=64):
+        ring = sorted((self._hash('{}-{}'.format(partition, i)), partition) 
+                      for partition in partitions for i in xrange(replicas))
+        self.hashes = [h for h, partition in ring]
+        self.partitions = [partition for h, partition in ring]
+    
+    def _hash(self, key):
+        return int(md5(str(key)).hexdigest()[:8], 16)
+    
+    def get(self, key):
+        if not self.hashes:
+            return 0
+        i = bisect(self.hashes, self._hash(key)) % len(self.hashes)
+        return self.partitions[i]
+    
+    def preference(self, key):
+        """ The distinct partitions met walking the ring from the key, 
+        the first one is get(key) """
+        n = len(self.hashes)
+        start = bisect(self.hashes, self._hash(key))
+        seen = set()
+        for j in xrange(n):
+            partition = self.partitions[(start + j) % n]
+            if partition not in seen:
+                seen.add(partition)
+                yield partition
+        
 class UserPartitioner(Partitioner):
     """
     With fixed partition output for the key (user)
     Assumption: monkapi is initialized first
     """
+    ROUTE_TTL = 600 # seconds before a cached route is looked up again
+    
     def __init__(self, partitions=[0]):
         """
         Initialize the partitioner
-        partitions - A list of available partitions to round robin when no partition found for the user
+        partitions - A list of available partitions to hash on when no partition found for the user
         """
-        self._set_partition(partitions)
+        self.routes = {}
+        self.warmed = False
+        self._set_partitions(partitions)
             
-    def _set_partition(self, partitions):
+    def _set_partitions(self, partitions):
         self.partitions = partitions
         if partitions:
-            self.iterpart = cycle(partitions)        
+            self.ring = ConsistentHash(partitions)
         else:
-            self.iterpart = cycle([0])
-            
+            self.ring = ConsistentHash([0])
+    
+    def warm_up(self):
+        """ Loads the routes of all users in one query """
+        expire = time.time() + self.ROUTE_TTL
+        try:
+            routes = {userName : (partition, expire) 
+                      for userName, partition in monkapi.load_user_partitions().iteritems()}
+            # the routes updated meanwhile are newer
+            routes.update(self.routes)
+            self.routes = routes
+            logger.info('{} user routes loaded'.format(len(self.routes)))
+        except Exception as e:
+            logger.warning('can not load user routes {}'.format(e))
+        self.warmed = True
+    
+    def update(self, key, partition=None):
+        """ Sets the route of the user, None invalidates it """
+        if partition is None:
+            self.routes.pop(key, None)
+        else:
+            self.routes[key] = (partition, time.time() + self.ROUTE_TTL)
+        
     def partition(self, key, partitions=None):
          # Refresh the partition list if necessary
         if partitions and self.partitions != partitions:
             self._set_partitions(partitions)
-        logger.debug('key {}'.format(key))
-        user = monkapi.load_user(key)
-        if not user:
-            return self.iterpart.next()
+        if not self.warmed:
+            self.warm_up()
+        route = self.routes.get(key)
+        if route is None or route[1] < time.time():
+            logger.debug('key {}'.format(key))
+            partition = monkapi.get_user_partition(key)
+            if partition is None:
+                partition = -1
+            self.update(key, partition)
         else:
-            return user.partition
-        
\ No newline at end of file
+            partition = route[0]
+        if partition < 0:
+            # unknown or unassigned user
+            return self.ring.get(key)
+        return partition
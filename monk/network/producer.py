@@ -34,8 +34,11 @@ class FixedProducer(Producer):
         self.partition = partition
         super(FixedProducer, self).__init__(client, async, req_acks, ack_timeout, codec, batch_send, batch_send_every_n, batch_send_every_t)
         
+    def partition_of(self, topic, name):
+        return self.partition
+    
     def send(self, topic, name, *msg):
-        logger.info('sending message {} at {}@{}'.format(msg, topic, self.partition))
+        logger.debug('sending message {} at {}@{}'.format(msg, topic, self.partition))
         return self.send_messages(topic, self.partition, *msg)
     
     def __repr__(self):
@@ -55,17 +58,47 @@ class UserProducer(Producer):
             batch_send - If True, messages are send in batches
             batch_send_every_n - If set, messages are send in batches of this size
             batch_send_every_t - If set, messages are send after this timeout
+            metadataClient - The client whose topic metadata routes the users, the client 
+                    by default, a client of the thread calling partition_of otherwise
     """
     def __init__(self, client, async=False, req_acks=Producer.ACK_AFTER_LOCAL_WRITE, ack_timeout=Producer.DEFAULT_ACK_TIMEOUT,
-             codec=None, batch_send=False, batch_send_every_n=BATCH_SEND_MSG_COUNT, batch_send_every_t=BATCH_SEND_DEFAULT_INTERVAL):
+             codec=None, batch_send=False, batch_send_every_n=BATCH_SEND_MSG_COUNT, batch_send_every_t=BATCH_SEND_DEFAULT_INTERVAL,
+             metadataClient=None):
         self.partitioner = UserPartitioner(None)
+        self.metadataClient = metadataClient or client
+        self.partitions = {} # topic -> (metadata of the client, partition ids)
         super(UserProducer, self).__init__(client, async, req_acks, ack_timeout, codec, batch_send, batch_send_every_n, batch_send_every_t)
         
+    def partition_of(self, topic, name):
+        # looks up the user route, call it where the stores may be used
+        return self.partitioner.partition(name, self._topic_partitions(topic))
+    
     def send(self, topic, name, *msg):
-        partition = self.partitioner.partition(name, None)
-        logger.info('sending message {} at {}@{}'.format(msg, topic, partition))
+        partition = self.partition_of(topic, name)
+        logger.debug('sending message {} at {}@{}'.format(msg, topic, partition))
         return self.send_messages(topic, partition, *msg)
     
+    def refresh_partitions(self, topic=None):
+        # forgets the partitions of topic, or of every topic, e.g. after a reconnect
+        if topic is None:
+            self.partitions = {}
+        else:
+            self.partitions.pop(topic, None)
+    
+    def _topic_partitions(self, topic):
+        # the partitions are read again only when the client reloads the metadata of topic
+        metadata = getattr(self.metadataClient, 'topic_partitions', {}).get(topic)
+        cached = self.partitions.get(topic)
+        if cached is not None and cached[0] is metadata:
+            return cached[1]
+        try:
+            partitions = self.metadataClient.get_partition_ids_for_topic(topic)
+        except AttributeError:
+            # older clients, unknown users go to partition 0
+            partitions = None
+        self.partitions[topic] = (metadata, partitions)
+        return partitions
+            
     def __repr__(self):
         return '<UserProducer batch=%s>' % self.async
     
\ No newline at end of file
@@ -6,7 +6,9 @@ Created on Fri Dec 12 07:01:01 2014
 """
 
 import monk.core.api as monkapi
-from Queue import PriorityQueue
+from monk.utils.utils import metricValue, flush_metrics
+from monk.utils.histogram import Histogram
+from Queue import PriorityQueue, Full
 import time
 import logging
 import platform
@@ -17,8 +19,11 @@ else:
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web 
-import simplejson
 import traceback
+import simplejson
+import codec
+from collections import OrderedDict, defaultdict
+from itertools import count
 
 logger = logging.getLogger('monk.network.server')
 
@@ -38,19 +43,33 @@ class TaskFactory(object):
         return [key for key in self.factory.iterkeys() if key.find(name) >= 0]
         
     def create(self, message):
+        tasks = self.create_all(message)
+        if tasks:
+            return tasks[0]
+        return None
+    
+    def create_all(self, message):
+        """ Creates the tasks carried by a json or binary message """
+        tasks = []
         try:
-            generic = simplejson.loads(message)
-            name = generic.get('op', None)
-            if not name:
-                logger.warning('no task defined in op')
-                return None
-            else:
-                return self.factory[name](generic)
+            generics = codec.decode(message)
         except Exception as e:
-            logger.debug('can not create tasks for {}'.format(message))
+            logger.debug('can not decode tasks from {}'.format(repr(message)))
             logger.debug('Exception {}'.format(e))
             logger.debug(traceback.format_exc())
-            return None
+            return tasks
+        for generic in generics:
+            try:
+                name = generic.get('op', None)
+                if not name:
+                    logger.warning('no task defined in op')
+                else:
+                    tasks.append(self.factory[name](generic))
+            except Exception as e:
+                logger.debug('can not create tasks for {}'.format(generic))
+                logger.debug('Exception {}'.format(e))
+                logger.debug(traceback.format_exc())
+        return tasks
 
 taskFactory = TaskFactory()
 
@@ -58,6 +77,8 @@ class Task(object):
     PRIORITY_HIGH = 1
     PRIORITY_LOW = 5
     FPRIORITY = 'priority'
+    COALESCE = False # only the latest pending task of the same coalesce_key runs
+    FIELDS = () # fields sent by position in the binary wire format
     
     def __init__(self, decodedMessage):
         self.decodedMessage = decodedMessage
@@ -67,7 +88,18 @@ class Task(object):
             self.name = tuple(self.name)
         self.turtleName = self.decodedMessage.get('turtleName')
         self.userName = self.name
+        self.enqueueTime = None
+        self.dequeueTime = None
     
+    def group(self):
+        # tasks of the same group run in their arrival order
+        return (self.turtleName, self.userName)
+    
+    def coalesce_key(self):
+        if self.COALESCE:
+            return (self.__class__.__name__,) + self.group()
+        return None
+        
     def info(self, logger, message):
         logger.info('{} for {}'.format(message, self.decodedMessage))
     
@@ -85,11 +117,48 @@ class Task(object):
 
 def taskT(TaskClass):
     taskFactory.register(TaskClass)
+    if TaskClass.FIELDS:
+        codec.register_schema(TaskClass.__name__, TaskClass.FIELDS)
     
 class Echo(Task):
     def act(self):
         logger.info('received message {}'.format(self.decodedMessage))
 taskT(Echo)
+
+class TaskStats(object):
+    """ Seconds tasks waited in the queue and ran, and how many succeeded or failed """
+    def __init__(self):
+        self.wait = Histogram()
+        self.run = Histogram()
+        self.succeeded = 0
+        self.failed = 0
+        
+    def record(self, task, runTime, succeeded):
+        if task.enqueueTime is not None and task.dequeueTime is not None:
+            self.wait.record(task.dequeueTime - task.enqueueTime)
+        self.run.record(runTime)
+        if succeeded:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+    
+    def summary(self, elapsed):
+        result = {'succeeded':self.succeeded, 'failed':self.failed,
+                  'throughput':(self.succeeded + self.failed) / elapsed if elapsed > 0 else 0.0}
+        for k, v in self.wait.summary().iteritems():
+            result['wait.' + k] = v
+        for k, v in self.run.summary().iteritems():
+            result['run.' + k] = v
+        return result
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """ The task statistics of the server since its last maintenance, in json """
+    def initialize(self, server):
+        self.server = server
+        
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(simplejson.dumps(self.server.task_stats()))
         
 class MonkServer(object):    
     EXIT_WAIT_TIME=3
@@ -97,12 +166,21 @@ class MonkServer(object):
     MAINTAIN_INTERVAL=10000
     POLL_INTERVAL=0.1
     EXECUTE_INTERVAL=0.1
+    FLUSH_INTERVAL=1
+    BATCH_SIZE=1
     
     def __init__(self, serverName='', config=None):
         if not config:
             self.ready = False
             return
         self.pq = PriorityQueue(self.MAX_QUEUE_SIZE)
+        self.sequence = count()
+        self.latest = {} # coalesce key -> sequence of the latest pending task
+        self.coalesced = 0
+        self.opStats = defaultdict(TaskStats)
+        self.turtleStats = defaultdict(TaskStats)
+        self.userStats = defaultdict(TaskStats)
+        self.statsSince = now()
         self.serverName = serverName
         self.lastMaintenance = now()
         self.ioLoop = tornado.ioloop.IOLoop.instance()        
@@ -131,6 +209,9 @@ class MonkServer(object):
         logger.info('onexit')
         self.onexit()
         
+        logger.info('flushing pending writes')
+        monkapi.flush()
+        
         logger.info('stopping ioloop')
         self.ioLoop.stop()
         for broker in self.brokers:
@@ -153,8 +234,15 @@ class MonkServer(object):
         #stop_loop()
         logger.info('exited')
         
+    def _flush(self):
+        monkapi.flush(force=False)
+        flush_metrics(force=False)
+        self.ioLoop.add_timeout(now() + self.FLUSH_INTERVAL, self._flush)
+        
     def _maintain(self):
+        self.report_queue()
         self.maintain()
+        self.report_tasks()
         self.ioLoop.add_timeout(now() + self.MAINTAIN_INTERVAL, self._maintain)
 
     def _poll(self):
@@ -166,11 +254,27 @@ class MonkServer(object):
             if not ready:
                 self._onexit()
                 return
-            taskScripts = filter(None, (broker.consume_one() for broker in self.brokers))
+            room = self.pq.maxsize - self.pq.qsize() if self.pq.maxsize > 0 else self.BATCH_SIZE
+            batchSize = max(1, min(self.BATCH_SIZE, room // len(self.brokers)))
+            if batchSize > 1:
+                taskScripts = [tscript for broker in self.brokers for tscript in broker.consume(batchSize)]
+            else:
+                taskScripts = filter(None, (broker.consume_one() for broker in self.brokers))
             for tscript in taskScripts:
-                t = taskFactory.create(tscript)
-                if t:
-                    self.pq.put((t.priority, t), block=False)
+                # a binary message may carry many tasks
+                for t in taskFactory.create_all(tscript):
+                    # the sequence keeps tasks of the same priority in arrival order
+                    sequence = next(self.sequence)
+                    t.enqueueTime = now()
+                    try:
+                        self.pq.put((t.priority, sequence, t), block=False)
+                    except Full:
+                        logger.warning('queue is full, task {} dropped'.format(t.decodedMessage))
+                        continue
+                    # only a queued task can supersede the earlier ones
+                    key = t.coalesce_key()
+                    if key is not None:
+                        self.latest[key] = sequence
             if taskScripts:
                 #logger.debug('processing next task')
                 self.ioLoop.add_callback(self._poll)
@@ -181,20 +285,79 @@ class MonkServer(object):
     def _execute(self):
         if self.pq.queue:
             try:
-                priority, task = self.pq.get()
-                task.act()
-                logger.debug('executing {}'.format(task.name))
-            except Exception as e:
-                logger.debug(e.message)
-                logger.debug(traceback.format_exc())
+                tasks = []
+                while self.pq.queue and len(tasks) < self.BATCH_SIZE:
+                    priority, sequence, task = self.pq.get()
+                    key = task.coalesce_key()
+                    if key is not None:
+                        if self.latest.get(key) != sequence:
+                            # superseded by a later task still in the queue
+                            self.coalesced += 1
+                            continue
+                        del self.latest[key]
+                    task.dequeueTime = now()
+                    tasks.append(task)
+                self.execute_batch(tasks)
             finally:
                 self.ioLoop.add_callback(self._execute)
         else:
             logger.debug('waiting for tasks {}'.format(now()))
             self.ioLoop.add_timeout(now() + self.EXECUTE_INTERVAL, self._execute)
 
-    def add_application(self, regx, handler):
-        self.webApps.append((regx, handler))
+    def report_queue(self):
+        metricValue('server.queueDepth', self.serverName, self.pq.qsize())
+        metricValue('server.coalesced', self.serverName, self.coalesced)
+        self.coalesced = 0
+    
+    def task_stats(self):
+        """ {'ops':{op:summary}, 'turtles':{turtleName:summary}, 'since':time} """
+        elapsed = now() - self.statsSince
+        return {'since':self.statsSince,
+                'ops':{op:stats.summary(elapsed) for op, stats in self.opStats.iteritems()},
+                'turtles':{str(turtleName):stats.summary(elapsed) 
+                           for turtleName, stats in self.turtleStats.iteritems()}}
+        
+    def report_tasks(self):
+        stats = self.task_stats()
+        for group in ['ops', 'turtles']:
+            for name, summary in stats[group].iteritems():
+                for k, v in summary.iteritems():
+                    metricValue('task.{0}.{1}'.format(name, k), self.serverName, v)
+        self.opStats.clear()
+        self.turtleStats.clear()
+        self.userStats.clear()
+        self.statsSince = now()
+        
+    def execute_batch(self, tasks):
+        """ Runs the tasks grouped by (turtleName, userName), so each turtle 
+        is loaded once per batch, and writes the stores once at the end"""
+        groups = OrderedDict()
+        for task in tasks:
+            groups.setdefault(task.group(), []).append(task)
+        for group in groups.itervalues():
+            for task in group:
+                start = now()
+                succeeded = True
+                try:
+                    task.act()
+                    logger.debug('executing {}'.format(task.name))
+                except Exception as e:
+                    succeeded = False
+                    task.warning(logger, 'failed with {}'.format(e))
+                    logger.debug(traceback.format_exc())
+                runTime = now() - start
+                self.opStats[task.__class__.__name__].record(task, runTime, succeeded)
+                if task.turtleName:
+                    self.turtleStats[task.turtleName].record(task, runTime, succeeded)
+                    self.userStats[task.userName].record(task, runTime, succeeded)
+        if len(tasks) > 1:
+            monkapi.flush()
+    
+    def add_application(self, regx, handler, **kwargs):
+        if kwargs:
+            self.webApps.append((regx, handler, kwargs))
+        else:
+            self.webApps.append((regx, handler))
             
     def init_brokers(self, argvs):
         raise Exception('not implemented yet')
@@ -213,6 +376,7 @@ class MonkServer(object):
         self.ioLoop.add_timeout(now() + self.MAINTAIN_INTERVAL, self._maintain)
         self.ioLoop.add_timeout(now() + self.POLL_INTERVAL, self._poll)
         self.ioLoop.add_timeout(now() + self.EXECUTE_INTERVAL, self._execute)
+        self.ioLoop.add_timeout(now() + self.FLUSH_INTERVAL, self._flush)
         
         if self.webApps:
             # fail immediately if http server can not run
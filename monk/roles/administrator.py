@@ -10,14 +10,16 @@ import monk.core.api as monkapi
 import logging
 from monk.network.broker import KafkaBroker
 from monk.network.server import taskT, Task, MonkServer
+from monk.network.partitioner import ConsistentHash
 from monk.roles.monitor import MonitorBroker
 from monk.core.user import User
 from monk.core.engine import Engine
 import monk.core.constants as cons
 import monk.utils.utils as ut
 import sys,os
+import time
 import datetime
-from itertools import cycle
+from collections import OrderedDict
 
 logger = logging.getLogger('monk.roles.administrator')
 
@@ -47,11 +49,31 @@ class AdminBroker(KafkaBroker):
 
     def unregister_worker(self, workerName, **kwargs):
         self.produce('UnregisterWorker', workerName, **kwargs)
+    
+    def take_over_partitions(self, workerName, partitions, **kwargs):
+        # the worker consumes exactly these partitions from their committed offsets
+        self.produce('TakeOverPartitions', workerName, partitions=partitions, **kwargs)
+    
+    def warm_up_users(self, workerName, users, **kwargs):
+        self.produce('WarmUpUsers', workerName, users=users, **kwargs)
+    
+    def update_route(self, userName, partition=None, **kwargs):
+        # broadcasts to the producers on the workers, None invalidates the route
+        self.produce('UpdateRoute', userName, partition=partition, **kwargs)
 
 
 class MonkAdmin(MonkServer):
     def init_brokers(self, config):
         self.workers = {}
+        self.userCosts = {} # userName -> the latest cost reported by its worker
+        self.migrations = OrderedDict() # userName -> partition it is planned to move to
+        self.costWeights = config.administratorCostWeights
+        self.loadSlack = config.administratorLoadSlack
+        self.maxMigrations = config.administratorMaxMigrations
+        self.maxMigrationBytes = config.administratorMaxMigrationBytes
+        self.heartbeats = {} # workerName -> time of the latest registration or update
+        self.heartbeatDeadline = config.administratorHeartbeatDeadline
+        self.warmUpBatch = config.administratorWarmUpBatch
         monkapi.initialize(config)
         self.MAINTAIN_INTERVAL = config.administratorMaintainInterval
         self.POLL_INTERVAL = config.administratorPollInterval
@@ -73,20 +95,256 @@ class MonkAdmin(MonkServer):
                                            producerPartitions=[0])
         ut.set_monitor(self.monitorBroker)
         return [self.adminBroker]
+    
+    def maintain(self):
+        self.detect_failures()
+        self.migrate()
+    
+    def heartbeat(self, workerName):
+        self.heartbeats[workerName] = time.time()
+        
+    def detect_failures(self):
+        """ Fails over the active workers silent for longer than heartbeatDeadline, 
+        and the inactive ones still holding partitions no live worker consumes """
+        t = time.time()
+        for workerName, engine in self.workers.items():
+            if engine.status != cons.STATUS_ACTIVE:
+                if self.orphaned(engine):
+                    # e.g. loaded inactive without having been failed over
+                    logger.warning('worker {} is inactive with unserved partitions'.format(workerName))
+                    self.fail_over(engine)
+                continue
+            if workerName not in self.heartbeats:
+                # known before the administrator started, the deadline runs from now
+                self.heartbeats[workerName] = t
+            elif t - self.heartbeats[workerName] > self.heartbeatDeadline:
+                logger.warning('worker {} missed its heartbeat deadline'.format(workerName))
+                self.fail_over(engine)
+    
+    def consumed_partitions(self):
+        """ The partitions consumed by the live workers """
+        partitions = set()
+        for engine in self.active_engines():
+            partitions.add(engine.partition)
+            partitions.update(engine.takenPartitions)
+        return partitions
+    
+    def orphaned(self, engine):
+        """ Whether the engine is inactive with partitions or users nobody serves """
+        if engine.is_active():
+            return False
+        return bool(engine.takenPartitions) or \
+               (bool(engine.users) and engine.partition not in self.consumed_partitions())
+    
+    def served_users(self, engine):
+        """ The users of the engine and of the partitions it took over """
+        users = list(engine.users)
+        for other in self.workers.itervalues():
+            if other is not engine and other.partition in engine.takenPartitions and not other.is_active():
+                users.extend(other.users)
+        return users
+    
+    def standby_engine(self, exclude=None):
+        """ An active engine without users, or the least loaded one """
+        engines = [engine for engine in self.active_engines() if engine is not exclude]
+        if not engines:
+            return None
+        return min(engines, key=lambda engine: (bool(self.served_users(engine)), self.engine_load(engine)))
+    
+    def fail_over(self, engine):
+        """ Marks the engine failed and moves its partitions to a standby or the least 
+        loaded worker, which consumes them from the committed offsets and warms up
+        the turtles of their users """
+        users = self.served_users(engine)
+        partitions = [engine.partition] + engine.takenPartitions
+        if engine.is_active():
+            engine._setattr(Engine.FSTATUS,  cons.STATUS_INACTIVE)
+            engine._setattr(Engine.FENDTIME, datetime.datetime.now())
+        engine.takenPartitions = []
+        engine.save()
+        taker = self.standby_engine(engine)
+        if taker is None:
+            logger.error('no live worker to take over partitions {}'.format(partitions))
+            return None
+        taker.takenPartitions.extend(p for p in partitions if p != taker.partition)
+        taker.save()
+        logger.warning('worker {} takes over partitions {}'.format(taker.name, partitions))
+        self.adminBroker.take_over_partitions(taker.name, [taker.partition] + taker.takenPartitions)
+        for i in xrange(0, len(users), self.warmUpBatch):
+            self.adminBroker.warm_up_users(taker.name, users[i:i + self.warmUpBatch])
+        return taker
+    
+    def held_partitions(self, exclude=None):
+        return set(engine.partition for engine in self.active_engines() if engine is not exclude)
+    
+    def next_partition(self, exclude=None):
+        """ The partition of the longest failed worker, or a new one """
+        held = self.held_partitions(exclude)
+        failed = [engine for engine in self.workers.itervalues()
+                  if engine is not exclude and not engine.is_active() and engine.partition not in held]
+        if failed:
+            return min(failed, key=lambda engine: engine.endtime).partition
+        used = set(engine.partition for engine in self.workers.itervalues())
+        for partition in xrange(self.maxNumWorkers):
+            if partition not in used:
+                return partition
+        logger.error('no partition left for more than {} workers'.format(self.maxNumWorkers))
+        return None
+    
+    def adopt_users(self, engine):
+        # the users of failed workers on the same partition are served by this one now
+        for other in self.workers.itervalues():
+            if other is not engine and other.partition == engine.partition and not other.is_active():
+                for userName in list(other.users):
+                    other.remove_user(userName)
+                    if userName not in engine.users:
+                        engine.add_user(userName)
+            
+    def reinstate(self, engine):
+        """ A worker declared failed is heard from again, it consumes its partition 
+        again, or a free one if another worker holds it now """
+        logger.warning('worker {} is back'.format(engine.name))
+        if engine.partition in self.held_partitions(engine):
+            partition = self.next_partition(engine)
+            if partition is None:
+                return False
+            engine._setattr(Engine.FPARTITION, partition)
+        engine._setattr(Engine.FSTATUS, cons.STATUS_ACTIVE)
+        engine.takenPartitions = []
+        engine.save()
+        self.adopt_users(engine)
+        self.release_partition(engine.partition)
+        self.adminBroker.take_over_partitions(engine.name, [engine.partition])
+        return True
+    
+    def release_partition(self, partition):
+        """ Stops the takeover of the partition, returns True if it was taken over """
+        released = False
+        for engine in self.workers.itervalues():
+            if partition in engine.takenPartitions:
+                engine.takenPartitions.remove(partition)
+                engine.save()
+                self.adminBroker.take_over_partitions(engine.name, [engine.partition] + engine.takenPartitions)
+                released = True
+        return released
+    
+    def user_cost(self, userName):
+        w = self.costWeights
+        cost = self.userCosts.get(userName, {})
+        return w.get('base', 1.0) + w.get('rate', 0) * cost.get('rate', 0) + \
+               w.get('time', 0) * cost.get('time', 0) + w.get('bytes', 0) * cost.get('bytes', 0)
+    
+    def engine_load(self, engine):
+        return sum(self.user_cost(userName) for userName in self.served_users(engine))
+    
+    def active_engines(self):
+        return [engine for engine in self.workers.itervalues() if engine.is_active()]
+    
+    def plan_rebalance(self):
+        """ Consistent hashing with bounded loads: users stay where they are unless
+        their engine is inactive or loaded beyond (1 + loadSlack) times the average,
+        moved users go to the first engine along their hash ring that has room.
+        Engines below (1 - loadSlack) times the average then take users from the
+        loaded engines, those hashed to them first """
+        engines = self.active_engines()
+        if not engines:
+            return OrderedDict()
+        partitions = set(engine.partition for engine in engines)
+        current = {}
+        for engine in self.workers.itervalues():
+            for userName in engine.users:
+                current[userName] = engine.partition
+        cost = {userName:self.user_cost(userName) for userName in current}
+        average = sum(cost.itervalues()) / len(engines)
+        capacity = (1 + self.loadSlack) * average
+        floor = (1 - self.loadSlack) * average
+        ring = ConsistentHash(sorted(partitions))
+        assigned = {userName:partition for userName, partition in current.iteritems() if partition in partitions}
+        homeless = [userName for userName in current if userName not in assigned]
+        loads = {partition:0.0 for partition in partitions}
+        for userName, partition in assigned.iteritems():
+            loads[partition] += cost[userName]
+        for partition in partitions:
+            # sheds the users hashed elsewhere first, the heaviest first for the fewest moves
+            users = sorted((userName for userName, p in assigned.iteritems() if p == partition),
+                           key=lambda userName: (ring.get(userName) == partition, -cost[userName]))
+            for userName in users:
+                if loads[partition] <= capacity:
+                    break
+                loads[partition] -= cost[userName]
+                del assigned[userName]
+                homeless.append(userName)
+        for userName in sorted(homeless, key=lambda userName: -cost[userName]):
+            for partition in ring.preference(userName):
+                if loads[partition] + cost[userName] <= capacity:
+                    break
+            else:
+                partition = min(loads, key=loads.get)
+            loads[partition] += cost[userName]
+            assigned[userName] = partition
+        for partition in sorted(partitions, key=loads.get):
+            if loads[partition] >= floor:
+                break
+            users = sorted((userName for userName, p in assigned.iteritems() if p != partition),
+                           key=lambda userName: (ring.get(userName) != partition, -loads[assigned[userName]]))
+            for userName in users:
+                if loads[partition] >= floor:
+                    break
+                source = assigned[userName]
+                if loads[source] - cost[userName] >= floor and loads[partition] + cost[userName] <= capacity:
+                    loads[source] -= cost[userName]
+                    loads[partition] += cost[userName]
+                    assigned[userName] = partition
+        plan = OrderedDict()
+        for userName in sorted(assigned, key=lambda userName: -cost[userName]):
+            if assigned[userName] != current[userName]:
+                plan[userName] = assigned[userName]
+        return plan
+        
+    def migrate(self):
+        """ Moves at most maxMigrations planned users, and at most maxMigrationBytes
+        of models to each engine, so that the caches of the receiving workers stay warm """
+        received = {}
+        moved = 0
+        for userName, partition in self.migrations.items():
+            if moved >= self.maxMigrations:
+                break
+            size = self.userCosts.get(userName, {}).get('bytes', 0)
+            if received.get(partition, 0) and received[partition] + size > self.maxMigrationBytes:
+                continue
+            del self.migrations[userName]
+            if self.move_user(userName, partition):
+                received[partition] = received.get(partition, 0) + size
+                moved += 1
+        if moved:
+            logger.info('{} users migrated, {} to go'.format(moved, len(self.migrations)))
+        
+    def move_user(self, userName, partition):
+        targets = [engine for engine in self.workers.itervalues()
+                   if engine.partition == partition and engine.is_active()]
+        user = monkapi.load_user(userName) if targets else None
+        if not user:
+            logger.warning('can not move user {} to partition {}'.format(userName, partition))
+            return False
+        target = targets[-1]
+        for engine in self.workers.itervalues():
+            if engine is not target and userName in engine.users:
+                engine.remove_user(userName)
+        user.partition = partition
+        user.save()
+        if userName not in target.users:
+            target.add_user(userName)
+        self.adminBroker.update_route(userName, partition)
+        return True
 
 admin = MonkAdmin()
 
 class AddUser(Task):
     def get_least_loaded_engine(self):
-        if len(admin.workers) == 0:
+        engines = admin.active_engines()
+        if not engines:
             return None
-        lengine = None
-        lload = sys.maxint
-        for engine in admin.workers.itervalues():
-            if engine.is_active() and len(engine.users) < lload:
-                lload = len(engine.users)
-                lengine = engine
-        return lengine
+        return min(engines, key=admin.engine_load)
         
     def act(self):
         userName = self.get(User.NAME,'')
@@ -110,6 +368,7 @@ class AddUser(Task):
                           User.FYEAR     : int(self.get(User.FYEAR, '1900'))}
             user = monkapi.create_user(userScript)
             leastLoadedEngine.add_user(userName)
+            admin.adminBroker.update_route(userName, user.partition)
             logger.debug('{} add user {}'.format(leastLoadedEngine.name, leastLoadedEngine.users))
 taskT(AddUser)
 
@@ -120,6 +379,11 @@ class DeleteUser(Task):
             logger.info('trying to delete non-existant user {}'.format(userName))
         else:
             logger.debug('{} deleted'.format(userName))
+            for engine in admin.workers.itervalues():
+                engine.remove_user(userName)
+            admin.userCosts.pop(userName, None)
+            admin.migrations.pop(userName, None)
+            admin.adminBroker.update_route(userName)
 taskT(DeleteUser)
 
 class UpdateUser(Task):
@@ -140,65 +404,57 @@ class UpdateUser(Task):
         user._setattr(User.FPART,     self.get(User.FPART))
         user._setattr(User.FYEAR,     self.get(User.FYEAR), lambda x: int(x))
         user.save()
+        admin.adminBroker.update_route(userName, user.partition)
         logger.debug('{} updated'.format(user.generic()))
 taskT(UpdateUser)
 
 class RebalanceUsers(Task):
     def act(self):
-        activeEngines = filter(lambda engine: engine.is_active(), admin.workers.itervalues())
-        def extend(x,y):
-            x.extend(y.users)
-            y.users = []
-            return x
-        activeUsers = reduce(extend, activeEngines, [])
-        iterEngine = cycle(activeEngines)
-        for userName in activeUsers:
-            engine = iterEngine.next()
-            user = monkapi.load_user(userName)
-            user.partition = engine.partition
-            user.save()
-            engine.add_user(userName)
+        # the moves are carried out gradually by admin.migrate
+        admin.migrations = admin.plan_rebalance()
+        logger.info('{} users planned to migrate'.format(len(admin.migrations)))
 taskT(RebalanceUsers)
     
 class RegisterWorker(Task):
-    def next_partition(self):
-        if len(admin.workers) < admin.maxNumWorkers:
-            return len(admin.workers)
-        else:
-            oldest = datetime.now()
-            oldestWorker = None
-            for worker in admin.workers:
-                if worker.lastModified < oldest:
-                    oldestWorker = worker
-                    oldest = worker.lastModified
-            return oldestWorker.partition
-            
     def act(self):
         workerName = self.get(cons.BASE_NAME, '')
         if not workerName:
             logger.error('empty worker name {}'.format(self.decodedMessage))
             return
         logger.info('worker {} registering'.format(workerName))
-        if workerName not in admin.workers:
-            engine = monkapi.load_engine(workerName)
-            if not engine:
-                engineScript = {Engine.NAME: workerName,\
-                                Engine.CREATOR: cons.DEFAULT_CREATOR,\
-                                Engine.FPARTITION: self.next_partition(),\
-                                Engine.FSTARTTIME: datetime.datetime.now(),\
-                                Engine.FPID: self.get(Engine.FPID),\
-                                Engine.FSTATUS: cons.STATUS_ACTIVE}
-                logger.info('creating worker {}'.format(engineScript))
-                engine = monkapi.create_engine(engineScript)
-            admin.workers[workerName] = engine
+        engine = admin.workers.get(workerName) or monkapi.load_engine(workerName)
+        if not engine:
+            partition = admin.next_partition()
+            if partition is None:
+                return
+            engineScript = {Engine.NAME: workerName,\
+                            Engine.CREATOR: cons.DEFAULT_CREATOR,\
+                            Engine.FPARTITION: partition,\
+                            Engine.FSTARTTIME: datetime.datetime.now(),\
+                            Engine.FPID: self.get(Engine.FPID),\
+                            Engine.FSTATUS: cons.STATUS_ACTIVE}
+            logger.info('creating worker {}'.format(engineScript))
+            engine = monkapi.create_engine(engineScript)
         else:
-            engine = admin.workers[workerName]
+            if engine.partition in admin.held_partitions(engine):
+                # its partition went to another worker while it was away
+                partition = admin.next_partition(engine)
+                if partition is None:
+                    return
+                engine._setattr(Engine.FPARTITION, partition)
             engine._setattr(Engine.FSTARTTIME, datetime.datetime.now())
             engine._setattr(Engine.FSTATUS, cons.STATUS_ACTIVE)
             engine._setattr(Engine.FADDRESS, self.get(Engine.FADDRESS))
             engine._setattr(Engine.FPID,     self.get(Engine.FPID))
+            engine.takenPartitions = []
             engine.save()
+        admin.workers[workerName] = engine
+        admin.heartbeat(workerName)
+        admin.adopt_users(engine)
         offsetSkip = self.get('offsetSkip', -1)
+        if admin.release_partition(engine.partition):
+            # continues where the worker that took it over stopped
+            offsetSkip = 0
         admin.adminBroker.acknowledge_registration(workerName, engine.partition, offsetSkip)
 taskT(RegisterWorker)
 
@@ -216,8 +472,14 @@ class UpdateWorker(Task):
             engine = admin.workers[workerName]
         engine._setattr(Engine.FADDRESS, self.get(Engine.FADDRESS))
         engine._setattr(Engine.FPID,     self.get(Engine.FPID))
-        engine._setattr(Engine.FSTATUS,  cons.STATUS_ACTIVE)
-        engine.save()
+        if engine.status != cons.STATUS_ACTIVE:
+            admin.reinstate(engine)
+        else:
+            engine.save()
+        admin.heartbeat(workerName)
+        costs = self.get('users')
+        if costs:
+            admin.userCosts.update(costs)
 taskT(UpdateWorker)
 
 class UnregisterWorker(Task):
@@ -228,10 +490,8 @@ class UnregisterWorker(Task):
             return
         logger.info('worker {} unregistering'.format(workerName))
         if workerName in admin.workers:
-            engine = admin.workers[workerName]
-            engine._setattr(Engine.FSTATUS,  cons.STATUS_INACTIVE)
-            engine._setattr(Engine.FENDTIME, datetime.datetime.now())
-            engine.save()
+            # hands its partitions over right away instead of waiting for the deadline
+            admin.fail_over(admin.workers[workerName])
 taskT(UnregisterWorker)
         
 def main():
@@ -29,6 +29,14 @@ class Configuration(object):
         self.sysDataBaseName       = 'MONKSysTest'
         self.engineCollectionName  = 'EngineStore'
         
+        # object cache per store, e.g. {'entity':{'policy':'lru', 'maxSize':100000, 'maxBytes':1 << 30}}
+        # policies are lru, lfu and ttl (with 'ttl' in seconds), stores without a policy are unbounded
+        self.cachePolicies = {}
+        # buffered writes to mongodb, coalesced per document and flushed in bulk 
+        # every maxPending documents or interval seconds, e.g. {'maxPending':1000, 'interval':1.0},
+        # None writes through; a crash loses the updates of up to the last interval seconds
+        self.writeBehind = None
+        
         self.kafkaConnectionString = 'localhost'
         
         self.workerGroup = 'monkTestWorker'
@@ -38,6 +46,8 @@ class Configuration(object):
         self.workerPollInterval = 0.1 #wait 0.1s if no message received
         self.workerExecuteInterval = 0.1 #wait 0.1s if no task to execute
         self.workerMaintainInterval = 60 #1 update per minute
+        self.workerBatchSize = 100 #tasks consumed and executed together
+        self.workerHttpPort = 8888 #serves the synchronous /predict
         
         self.administratorGroup = 'monkTestAdmin'
         self.administratorTopic = 'monkTestAdmin'
@@ -49,6 +59,13 @@ class Configuration(object):
         self.administratorMaintainInterval = 60 #1 update per minute
         self.administratorPollInterval = 0.1 #wait 0.1s if no message received
         self.administratorExecuteInterval = 0.1 #wait 0.1s if no task to execute
+        # the load of a user is base + rate * tasks/s + time * busy seconds/s + bytes * model bytes
+        self.administratorCostWeights = {'base':1.0, 'rate':1.0, 'time':100.0, 'bytes':1e-6}
+        self.administratorLoadSlack = 0.25 #engines are loaded up to 1.25 times the average
+        self.administratorMaxMigrations = 50 #users moved per maintenance
+        self.administratorMaxMigrationBytes = 1 << 28 #model bytes received per engine per maintenance
+        self.administratorHeartbeatDeadline = 180 #a worker silent for 3 minutes has failed
+        self.administratorWarmUpBatch = 100 #users warmed up per task on failover
         
         self.monitorGroup = 'monkTestMonitor'
         self.monitorTopic = 'monkTestMonitor'
@@ -58,8 +75,22 @@ class Configuration(object):
         self.monitorMaintainInterval = 60
         self.monitorPollInterval = 0.1
         self.monitorExecuteInterval = 0.1
+        # metrics summarized in the workers and sent every interval seconds, sampleRates
+        # keeps a fraction of the samples of a metric name or prefix, 
+        # e.g. {'interval':10, 'sampleRates':{}}, None sends every sample
+        self.metricAggregation = None
         
         self.brokerTimeout = 200
+        # buffered, batched and compressed sending of the task producers, None sends synchronously,
+        # e.g. {'bufferSize':10000, 'putTimeout':None, 'batchSize':100, 'batchInterval':0.05, 'codec':'gzip'}
+        # where putTimeout None blocks the sender on a full buffer instead of dropping the task
+        self.producerOptions = None
+        # the metrics to the monitor are buffered likewise, dropped when the buffer stays full
+        self.monitorProducerOptions = {'bufferSize':10000, 'putTimeout':0.01,
+                                       'batchSize':100, 'batchInterval':0.05, 'codec':'gzip'}
+        # json or msgpack, the binary format packs a batch of tasks per user in one message,
+        # switch to msgpack only once every consumer has msgpack and reads the binary format
+        self.wireFormat = 'json'
         
         self.roleName = roleName
         self.logFileDir = logFileDir
@@ -11,7 +11,7 @@ from monk.network.broker import KafkaBroker
 from monk.network.server import taskT, Task, MonkServer
 import sys
 import time
-from collections import deque
+import simplejson
 from tornado.web import RequestHandler
 from bokeh.resources import INLINE
 from bokeh.plotting import figure, file_html, decode_utf8
@@ -30,6 +30,12 @@ class MonitorBroker(KafkaBroker):
 
     def measure(self, name, value, label=1, user=DEFAULT_MONITOR_USER):
         self.produce('Measure', name, user=user, value=value, label=label)
+    
+    def track_summaries(self, source, summaries):
+        self.produce_many('TrackSummary', source, summaries)
+    
+    def measure_summaries(self, source, summaries):
+        self.produce_many('MeasureSummary', source, summaries)
         
     def reset_tracker(self, name):
         self.produce('ResetTracker', name)
@@ -70,35 +76,87 @@ class MonkMonitor(MonkServer):
 
 monitor = MonkMonitor()
 
-class Tracker(object):    
-    def __init__(self, retireTime=7200, resolution=1):
-        self.valuesTimed = dict()
-        self.numTimed = dict()
-        self.annotatorTimed = dict()
-        self.queue = deque()
+class RingSeries(object):
+    """ The sums and counts of the values of each user (column) in the latest
+    capacity buckets of resolution seconds, a bucket reuses the slot of the bucket
+    capacity before it """
+    def __init__(self, resolution, capacity, numUsers=4):
         self.resolution = resolution
-        self.retiredTime = int(retireTime / resolution)
+        self.capacity = capacity
+        self.buckets = np.full(capacity, -1, dtype=np.int64)
+        self.sums = np.zeros((capacity, numUsers), dtype=np.float32)
+        self.counts = np.zeros((capacity, numUsers), dtype=np.int32)
         
-    def add(self, t, value, user):
-        t = int(t / self.resolution)
-        firstTime = self.queue[0]
-        if t - firstTime > self.retiredTime:
-            if firstTime in self.valuesTimed:
-                del self.valuesTimed[firstTime]
-                del self.numTimed[firstTime]
-                del self.annotatorTimed[firstTime]
-            self.queue.popleft()
-        self.queue.append(t)
-        if t in self.valuesTimed:
-            if user in self.valuesTimed:
-                self.valuesTimed[t][user] += value
-                self.numTimed[t][user] += 1.0
-            else:
-                self.valuesTimed[t][user] = value
-                self.numTimed[t][user] = 1.0
-        else:
-            self.valuesTimed[t] = {user:value}
-            self.numTimed[t] = {user:1.0}
+    def grow(self, numUsers):
+        extra = numUsers - self.sums.shape[1]
+        if extra > 0:
+            self.sums = np.hstack((self.sums, np.zeros((self.capacity, extra), dtype=self.sums.dtype)))
+            self.counts = np.hstack((self.counts, np.zeros((self.capacity, extra), dtype=self.counts.dtype)))
+            
+    def add(self, t, value, column, count=1):
+        """ value is the sum of count samples """
+        bucket = int(t // self.resolution)
+        slot = bucket % self.capacity
+        if self.buckets[slot] != bucket:
+            if self.buckets[slot] > bucket:
+                # older than what is kept
+                return
+            self.buckets[slot] = bucket
+            self.sums[slot].fill(0)
+            self.counts[slot].fill(0)
+        self.sums[slot, column] += value
+        self.counts[slot, column] += count
+    
+    def retention(self):
+        return self.resolution * self.capacity
+    
+    def series(self, start, end):
+        """ [(time, column, average value)] of the buckets in [start, end] in time order """
+        slots = np.nonzero((self.buckets >= start // self.resolution) &
+                           (self.buckets <= end // self.resolution))[0]
+        slots = slots[np.argsort(self.buckets[slots])]
+        counts = self.counts[slots]
+        rows, columns = np.nonzero(counts)
+        values = self.sums[slots][rows, columns] / counts[rows, columns]
+        times = self.buckets[slots][rows] * self.resolution
+        return zip(times.tolist(), columns.tolist(), values.tolist())
+    
+    def clear(self):
+        self.buckets.fill(-1)
+        self.sums.fill(0)
+        self.counts.fill(0)
+        
+class Tracker(object):
+    """ Fixed size time series of each user at several resolutions, 
+    by default 10 minutes by the second, 1 day by the minute and 30 days by the hour """
+    RESOLUTIONS = ((1, 600), (60, 1440), (3600, 720))
+    
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.users = dict() # user -> column
+        self.names = []
+        self.rings = [RingSeries(resolution, capacity) for resolution, capacity in resolutions]
+        self.annotatorTimed = dict()
+        self.summaries = dict() # user -> the latest summary pre-aggregated by a worker
+        self.resolution = self.rings[0].resolution
+        
+    def column(self, user):
+        col = self.users.get(user)
+        if col is None:
+            col = self.users[user] = len(self.names)
+            self.names.append(user)
+            for ring in self.rings:
+                if col >= ring.sums.shape[1]:
+                    ring.grow(2 * ring.sums.shape[1])
+        return col
+        
+    def add(self, t, value, user, count=1):
+        col = self.column(user)
+        for ring in self.rings:
+            ring.add(t, value, col, count)
+    
+    def add_summary(self, t, user, summary):
+        self.add(t, summary['total'], user, summary['count'])
+        self.summaries[user] = summary
     
     def annotate(self, t, annotator):
         t = int(t / self.resolution)
@@ -107,13 +165,32 @@ class Tracker(object):
                 self.annotatorTimed[t], t * self.resolution))
         else:
             self.annotatorTimed[t] = annotator
+            # forgets the annotations beyond the longest retention
+            oldest = t - self.rings[-1].retention() / self.resolution
+            for old in [k for k in self.annotatorTimed if k < oldest]:
+                del self.annotatorTimed[old]
+    
+    def series(self, start, end=None, maxPoints=1000):
+        """ [(time, user, average value)] in [start, end] from the finest resolution
+        that still keeps start and has at most maxPoints buckets """
+        if end is None:
+            end = time.time()
+        for ring in self.rings:
+            if start >= end - ring.retention() and (end - start) / ring.resolution <= maxPoints:
+                break
+        return [(t, self.names[col], value) for t, col, value in ring.series(start, end)]
             
     def clear(self):
-        self.queue.clear()
-        self.valuesTimed.clear()
-        self.numTimed.clear()
+        self.users.clear()
+        del self.names[:]
+        self.annotatorTimed.clear()
+        self.summaries.clear()
+        for ring in self.rings:
+            ring.clear()
         
 class Track(Task):
+    FIELDS = ('user', 'value', 'time')
+    
     def act(self):
         key = self.name
         if not key:
@@ -134,7 +211,34 @@ class Track(Task):
             monitor.trackers[key] = Tracker()
         tracker = monitor.trackers[key]
         tracker.add(t, value, user)
+
+class TrackSummary(Task):
+    """ The samples of metric of user summarized by a worker (named by the task) """
+    FIELDS = ('metric', 'user', 'time', 'count', 'total', 'min', 'max', 'quantiles')
+    
+    def act(self):
+        key = self.get('metric')
+        if not key:
+            self.warning(logger, 'no valid tracking name set')
+            return
+        try:
+            t = float(self.get('time'))
+            count = int(self.get('count'))
+            total = float(self.get('total'))
+        except:
+            self.warning(logger, 'no valid time, count or total set')
+            return
+        if count <= 0:
+            return
+        quantiles = self.get('quantiles') or []
+        summary = {'count':count, 'total':total, 'min':self.get('min'), 'max':self.get('max'),
+                   'quantiles':quantiles, 'source':self.name}
+        user = self.get('user')
+        if key not in monitor.trackers:
+            monitor.trackers[key] = Tracker()
+        monitor.trackers[key].add_summary(t, user, summary)
 taskT(Track)
+taskT(TrackSummary)
         
 class ResetTracker(Task):
     def act(self):
@@ -206,6 +310,8 @@ class Aggregator(object):
             self.num[user] = 1.0
         
 class Aggregate(Task):
+    FIELDS = ('user', 'value')
+    
     def act(self):
         key = self.name
         if not key:
@@ -246,134 +352,119 @@ class RenameAggregator(Task):
 taskT(RenameAggregator)
 
 class Measurer(object):
+    """ Keeps a histogram of the scores (in [0, 1]) of the positive and the negative
+    examples of each user, the ROC and PRC curves are computed from the histograms """
+    SCORE_BINS = 1000
+    
     def __init__(self, resolution=0.01):
         self.resolution = resolution
-        self.scores = dict()
-        self.totalPos = dict()
-        self.totalNeg = dict()
+        self.users = dict() # user -> row in pos and neg
+        self.pos = np.zeros((16, self.SCORE_BINS), dtype=np.int32)
+        self.neg = np.zeros((16, self.SCORE_BINS), dtype=np.int32)
         self.PRCs = None
         self.ROCs = None
         self.invalid = True
         
     def clear(self):
-        self.scores.clear()
-        self.totalPos.clear()
-        self.totalNeg.clear()
+        self.users.clear()
+        self.pos.fill(0)
+        self.neg.fill(0)
         self.PRCs = None
         self.ROCs = None
         self.invalid = True
     
     def add(self, value, user, label):
-        if user not in self.scores:
-           self.scores[user] = []
-           self.totalNeg[user] = 0
-           self.totalPos[user] = 0
-        self.scores[user].append((value, label))
+        row = self.row(user)
+        b = min(max(int(value * self.SCORE_BINS), 0), self.SCORE_BINS - 1)
         if label > 0:
-            self.totalPos[user] += 1
+            self.pos[row, b] += 1
         else:
-            self.totalNeg[user] += 1
+            self.neg[row, b] += 1
+        self.invalid = True
+    
+    def row(self, user):
+        row = self.users.get(user)
+        if row is None:
+            row = self.users[user] = len(self.users)
+            if row == self.pos.shape[0]:
+                self.pos = np.vstack((self.pos, np.zeros_like(self.pos)))
+                self.neg = np.vstack((self.neg, np.zeros_like(self.neg)))
+        return row
+    
+    def add_bins(self, user, bins, pos, neg):
+        """ Adds the [bin, count] of the positives and the negatives out of bins 
+        score bins, pre-aggregated by a worker """
+        row = self.row(user)
+        for counts, hist in ((pos, self.pos), (neg, self.neg)):
+            if counts:
+                counts = np.asarray(counts, dtype=np.int64).reshape(-1, 2)
+                b = np.clip(counts[:, 0] * self.SCORE_BINS // bins, 0, self.SCORE_BINS - 1)
+                np.add.at(hist[row], b, counts[:, 1].astype(hist.dtype))
         self.invalid = True
     
     def intervals(self):
         num = int(1.0 /self.resolution) + 1
         return np.linspace(0.0, 1.0, num)
+    
+    def _curves(self, x, y, weights, num, fromLow):
+        # averages y over the buckets of x, a bucket without points takes the value
+        # of its neighbour at the lower x (fromLow) or at the higher x
+        m = x.shape[0]
+        buckets = np.minimum((x / self.resolution).astype(int), num - 1)
+        rows = np.repeat(np.arange(m), x.shape[1])
+        sums = np.zeros((m, num))
+        counts = np.zeros((m, num))
+        np.add.at(sums, (rows, buckets.ravel()), (y * weights).ravel())
+        np.add.at(counts, (rows, buckets.ravel()), weights.ravel())
+        curves = sums / np.maximum(counts, 1e-12)
+        if not fromLow:
+            curves = curves[:, ::-1]
+            counts = counts[:, ::-1]
+        last = np.where(counts > 0, np.arange(num), 0)
+        np.maximum.accumulate(last, axis=1, out=last)
+        curves = curves[np.arange(m)[:, None], last]
+        if not fromLow:
+            curves = curves[:, ::-1]
+        return curves
         
     def compute_metrics(self):
+        """ Curves of all users with both positive and negative examples, each 
+        bucket of the curves sorted across the users for the quantile bands """
         # the number of buckets for the curves
         num = int(1.0 /self.resolution) + 1
-        logger.debug('num = {}'.format(num))
         self.PRCs = None
         self.ROCs = None
-        PRCn = np.zeros(num, dtype=int)
-        ROCn = np.zeros(num, dtype=int)
-        for user in self.scores:
-            if user is DEFAULT_MONITOR_USER:
-                continue
-            # initialize basic metrics
-            tp = self.totalPos[user]
-            tn = 0
-            fp = self.totalNeg[user]
-            fn = 0
-            totalP = tp
-            totalN = fp
-            logger.debug('totalP={}, totalN={}'.format(totalP, totalN))
-            # ignore incomplete user
-            if totalP == 0 or totalN == 0:
-                continue
-            # sort the scores
-            score = self.scores[user]
-            logger.info('scores for {} : {}'.format(score, user))
-            score.sort()
-            logger.info('scores for {} : {}'.format(score, user))
-            # initialize PRC and ROC
-            PRC = np.zeros(num)
-            ROC = np.zeros(num)
-            PRCn.fill(0)
-            ROCn.fill(0)
-            # loop through scores
-            for s, label in score:
-                if label > 0: # positive example
-                    fn += 1
-                    tp -= 1
-                else:   # negative example
-                    tn += 1
-                    fp -= 1
-                recall = float(tp) / float(totalP)
-                # precision value
-                if tp + fp == 0:
-                    precision = 1
-                else:
-                    precision = float(tp) / float(tp + fp)
-                v = int(precision / self.resolution)
-                PRC[v] += recall
-                PRCn[v] += 1
-                # false positive rate value
-                fpr = float(fp) / float(totalN)
-                v = int(fpr / self.resolution)
-                ROC[v] += recall
-                ROCn[v] += 1
-            logger.info('PRC {}'.format(PRC))
-            logger.info('PRCn {}'.format(PRCn))
-            logger.info('ROC {}'.format(ROC))
-            logger.info('ROCn {}'.format(ROCn))
-            
-            # averaging ROC and PRC since multiple recalls might fall into the same bucket
-            # fill the missing buckets
-            for v in reversed(range(num-1)):
-                if PRCn[v] == 0:
-                    # fill the missing values from high precision
-                    # precision == 1 is assumed to exist all the time
-                    PRC[v] = PRC[v+1]
-                else:
-                    # average over all recalls at this precision
-                    PRC[v] /= PRCn[v]
-            for v in range(2,num):
-                if ROCn[v] == 0:
-                    # fill the missing values from low fpr
-                    # fpr == 0 is assumed to exist all the time
-                    ROC[v] = ROC[v-1]
-                else:
-                    # average over all recalls at this fpr
-                    ROC[v] /= ROCn[v]
-            if self.ROCs is None:
-                self.ROCs = ROC
-            else:
-                self.ROCs = np.vstack((self.ROCs, ROC))
-            if self.PRCs is None:
-                self.PRCs = PRC
-            else:
-                self.PRCs = np.vstack((self.PRCs, PRC))
-        self.ROCs.sort(axis=0)
-        self.PRCs.sort(axis=0)
-        logger.info('ROCs {}'.format(self.ROCs))
-        logger.info('PRCs {}'.format(self.PRCs))
+        rows = [row for user, row in self.users.iteritems() if user != DEFAULT_MONITOR_USER]
+        pos = self.pos[rows].astype(np.float64)
+        neg = self.neg[rows].astype(np.float64)
+        totalP = pos.sum(axis=1)
+        totalN = neg.sum(axis=1)
+        # ignore incomplete user
+        complete = (totalP > 0) & (totalN > 0)
+        pos, neg = pos[complete], neg[complete]
+        totalP, totalN = totalP[complete, None], totalN[complete, None]
+        if pos.shape[0]:
+            # the examples scored above each bin, i.e. those left after removing
+            # the examples of the bin and of the bins below
+            tp = totalP - pos.cumsum(axis=1)
+            fp = totalN - neg.cumsum(axis=1)
+            # each example removed gives a point of the curves
+            weights = pos + neg
+            recall = tp / totalP
+            precision = np.where(tp + fp > 0, tp / np.maximum(tp + fp, 1), 1.0)
+            fpr = fp / totalN
+            self.PRCs = self._curves(precision, recall, weights, num, False)
+            self.ROCs = self._curves(fpr, recall, weights, num, True)
+            self.ROCs.sort(axis=0)
+            self.PRCs.sort(axis=0)
         self.invalid = False
 
     def set_resolution(self, resolution):
         try:
-            self.resolution = float(resolution)
-            self.invalid = True
+            resolution = float(resolution)
+            if resolution != self.resolution:
+                self.resolution = resolution
+                self.invalid = True
         except:
             logger.warning('resolution can not be converted to a float {}'.format(resolution))
         
@@ -388,8 +479,10 @@ class Measurer(object):
         return self.PRCs
         
 class Measure(Task):
+    FIELDS = ('user', 'value', 'label')
+    
     def act(self):
-        logger.info('measure {}'.format(self.decodedMessage))
+        logger.debug('measure {}'.format(self.decodedMessage))
         key = self.name
         if not key:
             self.warning(logger, 'no valid measurer name set')
@@ -411,6 +504,26 @@ class Measure(Task):
         measurer.add(value, user, pos)
 taskT(Measure)
 
+class MeasureSummary(Task):
+    """ The score bins of measurer metric of user counted by a worker (named by the task) """
+    FIELDS = ('metric', 'user', 'bins', 'pos', 'neg')
+    
+    def act(self):
+        key = self.get('metric')
+        if not key:
+            self.warning(logger, 'no valid measurer name set')
+            return
+        try:
+            bins = int(self.get('bins'))
+        except:
+            self.warning(logger, 'no valid bins set')
+            return
+        user = self.get('user')
+        if key not in monitor.measurers:
+            monitor.measurers[key] = Measurer()
+        monitor.measurers[key].add_bins(user, bins, self.get('pos'), self.get('neg'))
+taskT(MeasureSummary)
+
 class ResetMeasurer(Task):
     def act(self):
         key = self.name
@@ -433,7 +546,40 @@ class RenameMeasurer(Task):
             del monitor.measurers[key]
 taskT(RenameMeasurer)
 
-# TODO: TrackerHandler
+class TrackerUsersHandler(RequestHandler):
+    """ [{userId, name, summary}] of the tracker metricName, for monitor.js, summary 
+    is the latest pre-aggregated by a worker or null """
+    def get(self):
+        name = self.get_argument('metricName', None)
+        tracker = monitor.trackers.get(name)
+        users = [{'userId':col, 'name':user, 'summary':tracker.summaries.get(user)}
+                 for col, user in enumerate(tracker.names)] if tracker else []
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Access-Control-Allow-Origin', '*')
+        self.write(simplejson.dumps(users))
+        
+class TrackerHandler(RequestHandler):
+    """ [{time, userId, value}] of the tracker metricName since start (seconds 
+    since epoch, negative for seconds ago, 0 for all that is kept), downsampled
+    to at most maxPoints time buckets, for monitor.js """
+    def get(self):
+        name = self.get_argument('metricName', None)
+        start = float(self.get_argument('start', 0))
+        maxPoints = int(self.get_argument('maxPoints', 1000))
+        tracker = monitor.trackers.get(name)
+        metrics = []
+        if tracker:
+            end = time.time()
+            if start < 0:
+                start += end
+            elif start == 0:
+                start = end - tracker.rings[-1].retention()
+            metrics = [{'time':t, 'userId':tracker.users[user], 'value':value}
+                       for t, user, value in tracker.series(start, end, maxPoints)]
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Access-Control-Allow-Origin', '*')
+        self.write(simplejson.dumps(metrics))
+        
 # TODO: AggregatorHandler
             
 class AccuracyHandler(RequestHandler):
@@ -494,6 +640,8 @@ def main():
     config = get_config(sys.argv[1:], myname, 'monkmonitor.py')
     monitor = MonkMonitor(myname, config)
     monitor.add_application(r'/accuracy', AccuracyHandler)
+    monitor.add_application(r'/users', TrackerUsersHandler)
+    monitor.add_application(r'/metrics', TrackerHandler)
     monitor.run()
 
 if __name__=='__main__':
@@ -10,8 +10,13 @@ from monk.roles.monitor import MonitorBroker
 import monk.core.api as monkapi
 import logging
 import sys
+import time
+import simplejson
+from collections import defaultdict
+from tornado.web import RequestHandler
 from monk.network.broker import KafkaBroker
-from monk.network.server import MonkServer, taskT, Task
+from monk.network.server import MonkServer, MetricsHandler, taskT, Task
+from monk.utils.histogram import Histogram
 import monk.utils.utils as ut
 
 logger = logging.getLogger("monk.roles.worker")
@@ -32,6 +37,9 @@ class WorkerBroker(KafkaBroker):
     def add_data(self, userName, turtleName, ent, **kwargs):
         self.produce('AddData', userName, turtleName=turtleName, entity=ent, **kwargs)
     
+    def add_data_many(self, userName, turtleName, ents, **kwargs):
+        self.produce_many('AddData', userName, [dict(kwargs, turtleName=turtleName, entity=ent) for ent in ents])
+    
     def save_turtle(self, userName, turtleName, **kwargs):
         self.produce('SaveTurtle', userName, turtleName=turtleName, **kwargs)
     
@@ -42,7 +50,7 @@ class WorkerBroker(KafkaBroker):
         self.produce('Train', userName, turtleName=turtleName, **kwargs)
 
     def predict(self, userName, turtleName, ent, **kwargs):
-        self.produce('Predict', userName, turtleNmae=turtleName, entity=ent, **kwargs)
+        self.produce('Predict', userName, turtleName=turtleName, entity=ent, **kwargs)
 
     def reset(self, userName, turtleName, **kwargs):
         self.produce('Reset', userName, turtleName=turtleName, **kwargs)
@@ -58,13 +66,46 @@ class WorkerBroker(KafkaBroker):
     
     def monk_reload(self, **kwargs):
         self.produce('MonkReload', None, **kwargs)
+    
+    def update_route(self, userName, partition=None):
+        try:
+            self.producer.partitioner.update(userName, partition)
+        except AttributeError:
+            logger.warning('producer {} does not route users'.format(self.producer))
 
 class MonkWorker(MonkServer):
+    def user_costs(self):
+        """ {userName:{'rate':tasks per second, 'time':seconds spent per second, 
+        'bytes':bytes of the cached models}} since the last maintenance """
+        elapsed = max(time.time() - self.statsSince, 1e-3)
+        modelBytes = monkapi.user_model_bytes()
+        costs = {}
+        for userName in set(self.userStats).union(modelBytes):
+            if not isinstance(userName, basestring):
+                continue
+            stats = self.userStats.get(userName)
+            if stats:
+                costs[userName] = {'rate':(stats.succeeded + stats.failed) / elapsed,
+                                   'time':stats.run.total / elapsed,
+                                   'bytes':modelBytes.get(userName, 0)}
+            else:
+                costs[userName] = {'rate':0.0, 'time':0.0, 'bytes':modelBytes.get(userName, 0)}
+        return costs
+        
     def maintain(self):
-        self.adminBroker.update_worker(self.serverName)
+        self.adminBroker.update_worker(self.serverName, users=self.user_costs())
+        monkapi.report_cache(self.serverName)
+        for broker in [self.workerBroker, self.monitorBroker]:
+            for k, v in broker.producer_stats(reset=True).iteritems():
+                ut.metricValue('producer.{0}.{1}'.format(broker.kafkaTopic, k), self.serverName, v)
+        for turtleName, p50, p99 in PredictHandler.latency_percentiles(reset=True):
+            ut.metricValue('predict.{}.p50'.format(turtleName), self.serverName, p50)
+            ut.metricValue('predict.{}.p99'.format(turtleName), self.serverName, p99)
     
     def onexit(self):
         self.adminBroker.unregister_worker(self.serverName)
+        ut.flush_metrics(force=True)
+        self.monitorBroker.close()
     
     def init_brokers(self, config):
         monkapi.initialize(config)
@@ -79,18 +120,24 @@ class MonkWorker(MonkServer):
                                          config.workerGroup,
                                          config.workerTopic,
                                          consumerType=KafkaBroker.SIMPLE_CONSUMER,
-                                         producerType=KafkaBroker.USER_PRODUCER)
+                                         producerType=KafkaBroker.USER_PRODUCER,
+                                         producerOptions=config.producerOptions,
+                                         wireFormat=config.wireFormat)
         self.monitorBroker = MonitorBroker(config.kafkaConnectionString,
                                            config.monitorGroup,
                                            config.monitorTopic,
                                            producerType=KafkaBroker.FIXED_PRODUCER,
-                                           producerPartitions=[0])
-        ut.set_monitor(self.monitorBroker)
+                                           producerPartitions=[0],
+                                           producerOptions=config.monitorProducerOptions,
+                                           wireFormat=config.wireFormat)
+        ut.set_monitor(self.monitorBroker, self.serverName, config.metricAggregation)
         
         self.MAINTAIN_INTERVAL = config.workerMaintainInterval
         self.POLL_INTERVAL = config.workerPollInterval
         self.EXECUTE_INTERVAL = config.workerExecuteInterval
         self.MAX_QUEUE_SIZE = config.workerMaxQueueSize
+        self.BATCH_SIZE = config.workerBatchSize
+        self.port = config.workerHttpPort
         
         self.adminBroker.register_worker(self.serverName, offsetSkip=config.workerConsumerOffsetSkip)
         return [self.adminBroker, self.workerBroker]
@@ -98,6 +145,9 @@ class MonkWorker(MonkServer):
 worker = MonkWorker()
 
 class Train(Task):
+    COALESCE = True
+    FIELDS = ('turtleName',)
+    
     def act(self):
         monkapi.train(self.turtleName, self.userName)
         #leader = monkapi.get_leader(self.turtleName, self.userName)
@@ -105,6 +155,8 @@ class Train(Task):
 taskT(Train)
 
 class Merge(Task):
+    FIELDS = ('turtleName', 'follower')
+    
     def act(self):
         follower = self.get('follower')
         monkapi.merge(self.turtleName, self.userName, follower)
@@ -120,6 +172,9 @@ class Reset(Task):
 taskT(Reset)
 
 class SaveTurtle(Task):
+    COALESCE = True
+    FIELDS = ('turtleName',)
+    
     def act(self):
         monkapi.save_turtle(self.turtleName, self.userName)
 taskT(SaveTurtle)
@@ -131,11 +186,23 @@ class ResetAllData(Task):
 taskT(ResetAllData)
 
 class OffsetCommit(Task):
+    COALESCE = True
+    
+    def coalesce_key(self):
+        # commits the consumer offsets of the whole worker
+        return (self.__class__.__name__,)
+        
     def act(self):
         worker.workerBroker.commit()
 taskT(OffsetCommit)
 
 class SetMantisParameter(Task):
+    COALESCE = True
+    FIELDS = ('turtleName', 'para', 'value')
+    
+    def coalesce_key(self):
+        return (self.__class__.__name__, self.get('para', '')) + self.group()
+        
     def act(self):
         para = self.get('para', '')
         value = self.get('value', 0)
@@ -185,6 +252,8 @@ class RemoveClone(Task):
 taskT(RemoveClone)
 
 class AddData(Task):
+    FIELDS = ('turtleName', 'entity')
+    
     def act(self):
         entity = self.get('entity')
         if entity:
@@ -192,6 +261,8 @@ class AddData(Task):
 taskT(AddData)
 
 class Predict(Task):
+    FIELDS = ('turtleName', 'entity')
+    
     def act(self):
         logger.debug('test on data from {}'.format(self.userName))
         entity = self.get('entity')
@@ -216,11 +287,92 @@ class AcknowledgeRegistration(Task):
                 logger.warning(e.message)
 taskT(AcknowledgeRegistration)
 
+class TakeOverPartitions(Task):
+    def act(self):
+        workerName = self.get('name')
+        partitions = self.get('partitions')
+        if workerName == worker.serverName and partitions:
+            logger.warning('{} consumes partitions {}'.format(workerName, partitions))
+            # the new consumer starts from the offsets committed by the group
+            worker.workerBroker.set_consumer_partition(partitions)
+taskT(TakeOverPartitions)
+
+class WarmUpUsers(Task):
+    def act(self):
+        workerName = self.get('name')
+        if workerName == worker.serverName:
+            users = self.get('users') or []
+            numTurtles = sum(monkapi.warm_up_user(userName) for userName in users)
+            logger.info('{} turtles of {} users warmed up'.format(numTurtles, len(users)))
+taskT(WarmUpUsers)
+
+class UpdateRoute(Task):
+    def act(self):
+        partition = self.get('partition')
+        logger.debug('route of {} is updated to {}'.format(self.userName, partition))
+        worker.workerBroker.update_route(self.userName, partition)
+taskT(UpdateRoute)
+
+class PredictHandler(RequestHandler):
+    """ Synchronous predictions, runs on the ioloop between tasks without going
+    through kafka. POST a json request
+        {"userName":..., "turtleName":..., "entities":[id or {"_features":[[index, value], ...]}, ...]}
+    or a list of such requests, and receive {"predictions":[...]} for each request
+    """
+    latencies = defaultdict(Histogram)
+    
+    @classmethod
+    def latency_percentiles(cls, reset=False):
+        """ (turtleName, p50, p99) in milliseconds of the predictions since the last reset """
+        result = [(turtleName, h.percentile(50) * 1000, h.percentile(99) * 1000)
+                  for turtleName, h in cls.latencies.iteritems() if h.count]
+        if reset:
+            cls.latencies.clear()
+        return result
+        
+    def predict(self, request):
+        start = time.time()
+        turtleName = request.get('turtleName')
+        userName = request.get('userName')
+        entities = request.get('entities')
+        if entities is None:
+            entities = [request.get('entity')]
+        try:
+            predictions = monkapi.predict_all(turtleName, userName, entities, request.get('fields'))
+        except Exception as e:
+            logger.warning('predicting {} failed {}'.format(request, e))
+            return {'error':str(e)}
+        if predictions is None:
+            return {'error':'turtle {}@{} not found'.format(userName, turtleName)}
+        self.latencies[turtleName].record(time.time() - start)
+        return {'predictions':predictions}
+        
+    def post(self):
+        try:
+            request = simplejson.loads(self.request.body)
+        except Exception as e:
+            self.set_status(400)
+            self.write({'error':'invalid json {}'.format(e)})
+            return
+        requests = request if isinstance(request, list) else [request]
+        if not all(isinstance(r, dict) for r in requests):
+            self.set_status(400)
+            self.write({'error':'a request is a json object or a list of them'})
+            return
+        if isinstance(request, list):
+            response = [self.predict(r) for r in request]
+        else:
+            response = self.predict(request)
+        self.set_header('Content-Type', 'application/json')
+        self.write(simplejson.dumps(response, default=str))
+        
 def main():
     global worker
     myname = '_'.join([sys.argv[1], str(ut.get_mac())])
     config = get_config(sys.argv[2:], myname, 'monkworker.py name')
     worker = MonkWorker(myname, config)
+    worker.add_application(r'/predict', PredictHandler)
+    worker.add_application(r'/metrics', MetricsHandler, server=worker)
     worker.run()
     
 if __name__=='__main__':
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:12:08 2026
+Pre-aggregates the metrics of a worker before they go to the monitor
+@author: xm
+"""
+
+import random
+import threading
+import time
+import logging
+from monk.utils.histogram import Histogram
+
+logger = logging.getLogger('monk.utils.aggregator')
+
+class MetricAggregator(object):
+    """ Summarizes the samples of each (metric name, user) by count, sum, min, max
+    and a histogram for the quantiles, and the scores of each measurer by score bins,
+    and sends them to the monitor broker in one batch every interval seconds.
+
+    sampleRates maps a metric name or a name prefix to the fraction of the samples
+    kept, the longest matching entry wins. Counts and sums are scaled back by the
+    rate, so only the spread of the summaries suffers from sampling.
+    """
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, monitorBroker, source, interval=10, sampleRates=None, bins=1000,
+                 unit=1e-6, precision=6):
+        self.monitorBroker = monitorBroker
+        self.source = source
+        self.interval = interval
+        self.sampleRates = sampleRates or {}
+        self.bins = bins
+        self.unit = unit
+        self.precision = precision
+        self.rates = {} # name -> resolved sample rate
+        self.lock = threading.Lock()
+        self.tracks = {} # (name, user) -> Histogram
+        self.measures = {} # (name, user) -> [{bin:count} of positives, {bin:count} of negatives]
+        self.lastFlush = time.time()
+
+    def rate(self, name):
+        r = self.rates.get(name)
+        if r is None:
+            matched = [p for p in self.sampleRates if name.startswith(p)]
+            if matched:
+                r = min(max(float(self.sampleRates[max(matched, key=len)]), 0.0), 1.0)
+            else:
+                r = 1.0
+            self.rates[name] = r
+        return r
+
+    def sampled(self, name):
+        r = self.rate(name)
+        return r >= 1.0 or random.random() < r
+
+    def track(self, name, value, user):
+        """ records a sample kept by sampled(name) """
+        key = (name, user)
+        with self.lock:
+            h = self.tracks.get(key)
+            if h is None:
+                h = self.tracks[key] = Histogram(self.unit, self.precision)
+            h.record(value)
+
+    def measure(self, name, value, label, user):
+        """ records a score kept by sampled(name) """
+        key = (name, user)
+        b = min(max(int(value * self.bins), 0), self.bins - 1)
+        with self.lock:
+            m = self.measures.get(key)
+            if m is None:
+                m = self.measures[key] = [{}, {}]
+            counts = m[0] if label > 0 else m[1]
+            counts[b] = counts.get(b, 0) + 1
+
+    def flush(self, force=False):
+        t = time.time()
+        if not force and t - self.lastFlush < self.interval:
+            return
+        self.lastFlush = t
+        with self.lock:
+            tracks, self.tracks = self.tracks, {}
+            measures, self.measures = self.measures, {}
+
+        if tracks:
+            summaries = []
+            for (name, user), h in tracks.iteritems():
+                scale = 1.0 / self.rate(name)
+                summaries.append({'metric':name, 'user':user, 'time':t,
+                                  'count':int(round(h.count * scale)),
+                                  'total':h.total * scale,
+                                  'min':h.min, 'max':h.max,
+                                  'quantiles':[h.percentile(p) for p in self.PERCENTILES]})
+            self.monitorBroker.track_summaries(self.source, summaries)
+
+        if measures:
+            summaries = []
+            for (name, user), (pos, neg) in measures.iteritems():
+                scale = 1.0 / self.rate(name)
+                summaries.append({'metric':name, 'user':user, 'bins':self.bins,
+                                  'pos':[[b, int(round(n * scale))] for b, n in pos.iteritems()],
+                                  'neg':[[b, int(round(n * scale))] for b, n in neg.iteritems()]})
+            self.monitorBroker.measure_summaries(self.source, summaries)
+        logger.debug('flushed {} tracks and {} measures'.format(len(tracks), len(measures)))
@@ -7,6 +7,7 @@ Created on Thu Feb 27 09:19:09 2014
 
 import collections
 import functools
+import time
 from itertools import ifilterfalse
 from heapq import nsmallest
 from operator import itemgetter
@@ -143,6 +144,189 @@ def lfu_cache(maxsize=100):
     return decorating_function
 
 
+class ObjectCache(object):
+
+    '''Bounded mapping of keys to objects, the base of the cache policies.
+
+    The cache is bounded by the number of objects (maxsize) and by the 
+    estimated bytes (maxbytes) given by sizeof, 0 means no bound.
+    Evicted objects are handed to onEvict(key, obj) before being dropped.
+    Statistics are in hits, misses and evictions.
+
+    '''
+    def __init__(self, maxsize=0, maxbytes=0, sizeof=None, onEvict=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.onEvict = onEvict
+        self.cache = collections.OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def __len__(self):
+        return len(self.cache)
+
+    def keys(self):
+        return self.cache.keys()
+
+    def items(self):
+        return self.cache.items()
+
+    def get(self, key):
+        try:
+            obj = self.cache[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(key)
+        return obj
+
+    def put(self, key, obj):
+        if key in self.cache:
+            self._remove(key)
+        self.cache[key] = obj
+        if self.sizeof and self.maxbytes:
+            size = self.sizeof(obj)
+            self.sizes[key] = size
+            self.bytes += size
+        self._added(key)
+        self._purge(key)
+
+    def erase(self, key):
+        if key in self.cache:
+            self._remove(key)
+
+    def resize(self, key):
+        '''Re-estimate the size of an object that grew in place'''
+        if key in self.cache and self.sizeof and self.maxbytes:
+            size = self.sizeof(self.cache[key])
+            self.bytes += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+            self._purge(key)
+
+    def clear(self):
+        for key in list(self.cache):
+            self._remove(key)
+
+    def stats(self, reset=False):
+        result = {'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions,
+                  'size':len(self.cache), 'bytes':self.bytes}
+        if reset:
+            self.hits = self.misses = self.evictions = 0
+        return result
+
+    def _full(self):
+        return (self.maxsize and len(self.cache) > self.maxsize) or \
+               (self.maxbytes and self.bytes > self.maxbytes)
+
+    def _purge(self, keep):
+        # never evicts the object just put
+        while self._full() and len(self.cache) > 1:
+            for key in self._victims():
+                if key != keep:
+                    self.evict(key)
+                    break
+
+    def evict(self, key):
+        obj = self.cache[key]
+        self._remove(key)
+        self.evictions += 1
+        if self.onEvict:
+            self.onEvict(key, obj)
+
+    def _remove(self, key):
+        del self.cache[key]
+        self.bytes -= self.sizes.pop(key, 0)
+        self._removed(key)
+
+    # policy hooks
+    def _touch(self, key):
+        pass
+
+    def _added(self, key):
+        pass
+
+    def _removed(self, key):
+        pass
+
+    def _victims(self):
+        return iter(self.cache)
+
+
+class LRUObjectCache(ObjectCache):
+
+    '''Evicts the least recently used object'''
+
+    def _touch(self, key):
+        self.cache[key] = self.cache.pop(key)
+
+
+class LFUObjectCache(ObjectCache):
+
+    '''Evicts the least frequently used object'''
+
+    def __init__(self, *args, **kwargs):
+        super(LFUObjectCache, self).__init__(*args, **kwargs)
+        self.use_count = Counter()
+
+    def _touch(self, key):
+        self.use_count[key] += 1
+
+    def _added(self, key):
+        self.use_count[key] = 1
+
+    def _removed(self, key):
+        del self.use_count[key]
+
+    def _victims(self):
+        return (key for key, _ in nsmallest(2, self.use_count.iteritems(), key=itemgetter(1)))
+
+
+class TTLObjectCache(LRUObjectCache):
+
+    '''Least recently used with objects expiring ttl seconds after being put'''
+
+    def __init__(self, ttl=3600, *args, **kwargs):
+        super(TTLObjectCache, self).__init__(*args, **kwargs)
+        self.ttl = ttl
+        self.expires = {}
+
+    def get(self, key):
+        if key in self.expires and self.expires[key] < time.time():
+            self.evict(key)
+        return super(TTLObjectCache, self).get(key)
+
+    def _added(self, key):
+        self.expires[key] = time.time() + self.ttl
+
+    def _removed(self, key):
+        del self.expires[key]
+
+
+cachePolicies = {'lru':LRUObjectCache, 'lfu':LFUObjectCache, 'ttl':TTLObjectCache}
+
+
+def create_cache(policy=None, sizeof=None, onEvict=None):
+    '''Create an object cache from a policy dict like
+    {'policy':'lru', 'maxSize':10000, 'maxBytes':1 << 30, 'ttl':3600},
+    no policy means an unbounded cache'''
+    if not policy:
+        return ObjectCache(onEvict=onEvict)
+    policy = dict(policy)
+    Cache = cachePolicies[policy.get('policy', 'lru')]
+    kwargs = {'maxsize':policy.get('maxSize', 0),
+              'maxbytes':policy.get('maxBytes', 0),
+              'sizeof':sizeof, 'onEvict':onEvict}
+    if Cache is TTLObjectCache:
+        kwargs['ttl'] = policy.get('ttl', 3600)
+    return Cache(**kwargs)
+
+
 if __name__ == '__main__':
 
     @lru_cache(maxsize=20)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:05:43 2026
+
+@author: xm
+"""
+
+
+class Histogram(object):
+    """ A log-linear histogram in the spirit of HdrHistogram. Values are counted
+    in units of unit, each power of two is split in 2^(precision-1) buckets, so
+    any recorded value is reported within 2^(1-precision) of its true value
+    (about 3% for the default precision), in constant memory and time.
+    """
+
+    def __init__(self, unit=1e-6, precision=6):
+        self.unit = unit
+        self.precision = precision
+        self.linear = 1 << precision
+        self.half = 1 << (precision - 1)
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, v):
+        if v < self.linear:
+            return v
+        e = v.bit_length() - self.precision
+        return e * self.half + (v >> e)
+
+    def _lower(self, index):
+        if index < self.linear:
+            return index
+        e = index // self.half - 1
+        return (index - e * self.half) << e
+
+    def _upper(self, index):
+        if index < self.linear:
+            return index + 1
+        e = index // self.half - 1
+        return self._lower(index) + (1 << e)
+
+    def record(self, value, n=1):
+        v = max(0, int(value / self.unit))
+        index = self._index(v)
+        self.counts[index] = self.counts.get(index, 0) + n
+        self.count += n
+        self.total += value * n
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.unit != self.unit or other.precision != self.precision:
+            raise ValueError('histograms of different units or precisions can not merge')
+        for index, n in other.counts.iteritems():
+            self.counts[index] = self.counts.get(index, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, p):
+        """ The value at percentile p (0 - 100), the middle of its bucket """
+        if not self.count:
+            return 0.0
+        rank = max(1, int(round(self.count * p / 100.0)))
+        if rank >= self.count:
+            return self.max
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                value = (self._lower(index) + self._upper(index)) * 0.5 * self.unit
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self, percentiles=(50, 90, 99)):
+        result = {'count':self.count, 'mean':self.mean(),
+                  'min':self.min or 0.0, 'max':self.max or 0.0}
+        for p in percentiles:
+            result['p{}'.format(p)] = self.percentile(p)
+        return result
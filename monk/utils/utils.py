@@ -14,7 +14,8 @@ from uuid import getnode
 from IPython.core.display import Image
 import logging
 from monk.core.constants import EPS
-from monk.math.flexible_vector import difference
+from monk.math.flexible_vector import relativeResidual
+from monk.utils.aggregator import MetricAggregator
 from numpy import sqrt
 import importlib
 from simplejson import encoder
@@ -72,13 +73,39 @@ def class_from(moduleName, className):
     return c
 
 monitorLogger = None
+metricAggregator = None
 
 def get_monitor():
     return monitorLogger
     
-def set_monitor(monitorBroker):
-    global monitorLogger
+def set_monitor(monitorBroker, source=None, aggregation=None):
+    """ aggregation holds the options of MetricAggregator, the samples are then 
+    summarized locally and sent in batches, otherwise each sample is sent """
+    global monitorLogger, metricAggregator
     monitorLogger = monitorBroker
+    if monitorBroker and aggregation:
+        metricAggregator = MetricAggregator(monitorBroker, source, **aggregation)
+    else:
+        metricAggregator = None
+
+def monitoring(name=None):
+    """ whether a sample of name would be sent, so that the metrics costly 
+    to compute are skipped when nobody listens """
+    if not monitorLogger:
+        return False
+    if metricAggregator and name:
+        return metricAggregator.sampled(name)
+    return True
+
+def flush_metrics(force=False):
+    if metricAggregator:
+        metricAggregator.flush(force)
+
+def _track(name, v, user):
+    if metricAggregator:
+        metricAggregator.track(name, v, user)
+    else:
+        monitorLogger.track(name, v, user)
     
 class DateTimeEncoder(simplejson.JSONEncoder):
     def default(self, obj):
@@ -96,22 +123,29 @@ def currentTimeMillisecond():
     return time.mktime(t.timetuple()) * 1e3 + t.microsecond / 1e3
 
 def metricValue(name, user, v):
-    if monitorLogger:
-        monitorLogger.track(name, v, user)
+    if monitoring(name):
+        _track(name, v, user)
     
 def metricAbs(name, user, v):
-    if monitorLogger:
-        monitorLogger.track(name, v.norm(), user)
+    if monitoring(name):
+        _track(name, v.norm(), user)
     
 def metricRelAbs(name, user, v1, v2):
-    if monitorLogger:
-        dv = difference(v1, v2)
-        v = sqrt((dv.norm2() + EPS) / (v1.norm() * v2.norm() + EPS))
-        monitorLogger.track(name, v, user)
-        del dv
+    if monitoring(name):
+        _track(name, relativeResidual(v1, v2, EPS), user)
+
+def metricRelNorms(name, user, dist2, norm2a, norm2b):
+    # the same as metricRelAbs from precomputed squared norms
+    if monitoring(name):
+        v = sqrt((dist2 + EPS) / (sqrt(norm2a * norm2b) + EPS))
+        _track(name, v, user)
 
 def monitor_accuracy(name, v, pos, user):
-    if monitorLogger:
+    if not monitoring(name):
+        return
+    if metricAggregator:
+        metricAggregator.measure(name, v, pos, user)
+    else:
         monitorLogger.measure(name, v, pos, user)
     
 def binary2decimal(a):
@@ -67,7 +67,7 @@ setup(
     # project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/technical.html#install-requires-vs-requirements-files
-    install_requires=['peppercorn','nltk','pymongo','simplejson','bokeh==0.7.0','pubnub==3.5.2'],
+    install_requires=['peppercorn','nltk','pymongo','simplejson','msgpack','bokeh==0.7.0','pubnub==3.5.2'],
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 13:20:05 2026
+
+@author: xm
+"""
+
+import datetime
+import time
+import unittest
+from collections import OrderedDict
+import monk.core.api as monkapi
+import monk.core.constants as cons
+import monk.roles.administrator as administrator
+from monk.roles.administrator import MonkAdmin
+
+
+class FakeEngine(object):
+    def __init__(self, name, partition, users=(), active=True):
+        self.name = name
+        self.partition = partition
+        self.users = list(users)
+        self.takenPartitions = []
+        self.status = cons.STATUS_ACTIVE if active else cons.STATUS_INACTIVE
+        self.endtime = datetime.datetime.now()
+        self.saved = 0
+
+    def is_active(self):
+        return self.status == cons.STATUS_ACTIVE
+
+    def _setattr(self, field, value):
+        setattr(self, field, value)
+
+    def save(self):
+        self.saved += 1
+
+    def add_user(self, userName):
+        self.users.append(userName)
+
+    def remove_user(self, userName):
+        if userName in self.users:
+            self.users.remove(userName)
+
+
+class FakeUser(object):
+    def __init__(self, name):
+        self.name = name
+        self.partition = None
+
+    def save(self):
+        pass
+
+
+class FakeAdminBroker(object):
+    def __init__(self):
+        self.takeOvers = []
+        self.warmUps = []
+        self.routes = []
+
+    def take_over_partitions(self, workerName, partitions, **kwargs):
+        self.takeOvers.append((workerName, partitions))
+
+    def warm_up_users(self, workerName, users, **kwargs):
+        self.warmUps.append((workerName, users))
+
+    def update_route(self, userName, partition=None, **kwargs):
+        self.routes.append((userName, partition))
+
+
+class MonkAdminTests(unittest.TestCase):
+
+    def setUp(self):
+        self.load_user = monkapi.load_user
+        self.users = {}
+        monkapi.load_user = self.users.get
+        self.admin = MonkAdmin()
+        self.admin.workers = {}
+        self.admin.userCosts = {}
+        self.admin.migrations = OrderedDict()
+        self.admin.costWeights = {'base':1.0}
+        self.admin.loadSlack = 0.25
+        self.admin.maxMigrations = 100
+        self.admin.maxMigrationBytes = 1000
+        self.admin.heartbeats = {}
+        self.admin.heartbeatDeadline = 60
+        self.admin.warmUpBatch = 2
+        self.admin.maxNumWorkers = 4
+        self.admin.adminBroker = FakeAdminBroker()
+
+    def tearDown(self):
+        monkapi.load_user = self.load_user
+
+    def add_engines(self, *engines):
+        for engine in engines:
+            self.admin.workers[engine.name] = engine
+        for engine in engines:
+            for userName in engine.users:
+                self.users[userName] = FakeUser(userName)
+
+    def test_plan_rebalance(self):
+        self.add_engines(FakeEngine('w0', 0, ['u{}'.format(i) for i in xrange(12)]),
+                         FakeEngine('w1', 1), FakeEngine('w2', 2))
+        plan = self.admin.plan_rebalance()
+        loads = {0:12 - len(plan), 1:0, 2:0}
+        for userName, partition in plan.iteritems():
+            loads[partition] += 1
+        # within the slack of the average, moving only what is needed
+        self.assertTrue(all(3 <= load <= 5 for load in loads.itervalues()))
+        self.assertEqual(len(plan), 12 - loads[0])
+        # a balanced cluster stays as it is
+        for userName, partition in plan.iteritems():
+            self.admin.move_user(userName, partition)
+        self.assertEqual(self.admin.plan_rebalance(), {})
+
+    def test_plan_rebalance_inactive(self):
+        self.add_engines(FakeEngine('w0', 0, ['a', 'b']), FakeEngine('w1', 1, ['c'], active=False))
+        self.assertEqual(self.admin.plan_rebalance(), {'c':0})
+
+    def test_move_user(self):
+        self.add_engines(FakeEngine('w0', 0, ['a']), FakeEngine('w1', 1), FakeEngine('w2', 2, active=False))
+        # nothing changes without a live target or a known user
+        self.assertFalse(self.admin.move_user('a', 2))
+        self.assertFalse(self.admin.move_user('x', 1))
+        self.assertEqual(self.admin.workers['w0'].users, ['a'])
+        self.assertTrue(self.admin.move_user('a', 1))
+        self.assertEqual(self.admin.workers['w0'].users, [])
+        self.assertEqual(self.admin.workers['w1'].users, ['a'])
+        self.assertEqual(self.users['a'].partition, 1)
+        self.assertEqual(self.admin.adminBroker.routes, [('a', 1)])
+
+    def test_migrate(self):
+        self.add_engines(FakeEngine('w0', 0, ['a', 'b', 'c']), FakeEngine('w1', 1))
+        self.admin.userCosts = {'a':{'bytes':600}, 'b':{'bytes':600}, 'c':{'bytes':300}}
+        self.admin.migrations = OrderedDict([('a', 1), ('b', 1), ('c', 1)])
+        # b does not fit in the bytes received by w1 this round
+        self.admin.migrate()
+        self.assertEqual(self.admin.workers['w1'].users, ['a', 'c'])
+        self.assertEqual(self.admin.migrations.keys(), ['b'])
+        self.admin.migrate()
+        self.assertEqual(self.admin.workers['w1'].users, ['a', 'c', 'b'])
+        self.assertEqual(self.admin.migrations.keys(), [])
+
+    def test_fail_over(self):
+        w0, w1, w2 = FakeEngine('w0', 0, ['a', 'b', 'c']), FakeEngine('w1', 1, ['d']), FakeEngine('w2', 2)
+        self.add_engines(w0, w1, w2)
+        # the standby worker without users takes over
+        self.assertIs(self.admin.fail_over(w0), w2)
+        self.assertFalse(w0.is_active())
+        self.assertEqual(w2.takenPartitions, [0])
+        self.assertEqual(self.admin.adminBroker.takeOvers, [('w2', [2, 0])])
+        self.assertEqual(self.admin.adminBroker.warmUps, [('w2', ['a', 'b']), ('w2', ['c'])])
+        self.assertEqual(sorted(self.admin.served_users(w2)), ['a', 'b', 'c'])
+        # and its partitions move on when it fails too
+        self.assertIs(self.admin.fail_over(w2), w1)
+        self.assertEqual(w1.takenPartitions, [2, 0])
+        self.assertEqual(w2.takenPartitions, [])
+        self.assertIsNone(self.admin.fail_over(w1))
+
+    def test_reinstate(self):
+        w0, w1 = FakeEngine('w0', 0, ['a']), FakeEngine('w1', 1)
+        self.add_engines(w0, w1)
+        self.admin.fail_over(w0)
+        del self.admin.adminBroker.takeOvers[:]
+        # its partition is free, it is released by the taker
+        self.assertTrue(self.admin.reinstate(w0))
+        self.assertTrue(w0.is_active())
+        self.assertEqual(w0.partition, 0)
+        self.assertEqual(w1.takenPartitions, [])
+        self.assertEqual(self.admin.adminBroker.takeOvers, [('w1', [1]), ('w0', [0])])
+        # a worker back on a partition held by another one gets a free partition
+        w2 = FakeEngine('w2', 2, ['b'])
+        self.add_engines(w2)
+        self.admin.fail_over(w2)
+        self.add_engines(FakeEngine('w3', 2))
+        self.assertTrue(self.admin.reinstate(w2))
+        self.assertEqual(w2.partition, 3)
+        self.assertTrue(w2.is_active())
+        self.assertEqual(self.admin.adminBroker.takeOvers[-1], ('w2', [3]))
+        # and none when all are held
+        w4 = FakeEngine('w4', 3, active=False)
+        self.add_engines(w4)
+        self.assertFalse(self.admin.reinstate(w4))
+        self.assertFalse(w4.is_active())
+
+    def test_detect_failures(self):
+        w0, w1, w2, w3 = FakeEngine('w0', 0, ['a']), FakeEngine('w1', 1), FakeEngine('w2', 2), \
+                         FakeEngine('w3', 3, active=False)
+        self.add_engines(w0, w1, w2, w3)
+        t = time.time()
+        self.admin.heartbeats = {'w0':t - 61, 'w1':t - 59, 'w3':t - 3600}
+        self.admin.detect_failures()
+        # only the active worker past the deadline fails, unknown ones start their deadline now
+        self.assertFalse(w0.is_active())
+        self.assertTrue(w1.is_active() and w2.is_active())
+        self.assertEqual(w2.takenPartitions, [0])
+        self.assertGreaterEqual(self.admin.heartbeats['w2'], t)
+        self.assertEqual(self.admin.adminBroker.takeOvers, [('w2', [2, 0])])
+        self.admin.detect_failures()
+        self.assertEqual(len(self.admin.adminBroker.takeOvers), 1)
+
+    def test_detect_orphaned(self):
+        w0, w1, w2, w3 = FakeEngine('w0', 0), FakeEngine('w1', 1, ['b'], active=False), \
+                         FakeEngine('w2', 2, ['c'], active=False), FakeEngine('w3', 3, active=False)
+        w0.takenPartitions = [2]
+        w3.takenPartitions = [4]
+        self.add_engines(w0, w1, w2, w3)
+        endtime = w1.endtime
+        self.admin.detect_failures()
+        # the inactive workers never failed over hand their partitions to a live one
+        self.assertEqual(sorted(w0.takenPartitions), [1, 2, 3, 4])
+        self.assertEqual(w1.endtime, endtime)
+        self.assertEqual(w3.takenPartitions, [])
+        # w2 is served by w0 already
+        self.assertEqual(self.admin.adminBroker.warmUps, [('w0', ['b'])])
+        takeOvers = len(self.admin.adminBroker.takeOvers)
+        self.admin.detect_failures()
+        self.assertEqual(len(self.admin.adminBroker.takeOvers), takeOvers)
+
+    def test_heartbeat_reinstates(self):
+        w0, w1 = FakeEngine('w0', 0, ['a']), FakeEngine('w1', 1)
+        self.add_engines(w0, w1)
+        self.admin.heartbeats = {'w0':time.time() - 61}
+        self.admin.detect_failures()
+        self.assertEqual(w1.takenPartitions, [0])
+        admin, administrator.admin = administrator.admin, self.admin
+        try:
+            administrator.UpdateWorker({'name':'w0', 'users':{'a':{'rate':1.0}}}).act()
+        finally:
+            administrator.admin = admin
+        # a worker heard from again is back on its partition
+        self.assertTrue(w0.is_active())
+        self.assertEqual(w1.takenPartitions, [])
+        self.assertEqual(self.admin.userCosts, {'a':{'rate':1.0}})
+        self.admin.detect_failures()
+        self.assertTrue(w0.is_active())
+
+
+if __name__ == '__main__':
+    unittest.main()
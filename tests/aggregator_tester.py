@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:40:16 2026
+
+@author: xm
+"""
+
+import unittest
+from monk.utils.aggregator import MetricAggregator
+
+
+class FakeMonitorBroker(object):
+    def __init__(self):
+        self.tracks = []
+        self.measures = []
+
+    def track_summaries(self, source, summaries):
+        self.tracks.append((source, summaries))
+
+    def measure_summaries(self, source, summaries):
+        self.measures.append((source, summaries))
+
+
+class MetricAggregatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = FakeMonitorBroker()
+        self.aggregator = MetricAggregator(self.broker, 'worker', interval=60,
+                                           sampleRates={'x.':0.0, 'x.y':1.0})
+
+    def test_track(self):
+        for i in xrange(100):
+            self.aggregator.track('loss', i + 1.0, 'u1')
+        self.aggregator.track('loss', 5.0, 'u2')
+        self.aggregator.flush()
+        self.assertEqual(self.broker.tracks, [])
+        self.aggregator.flush(force=True)
+        self.assertEqual(len(self.broker.tracks), 1)
+        source, summaries = self.broker.tracks[0]
+        self.assertEqual(source, 'worker')
+        summaries = {s['user']:s for s in summaries}
+        self.assertEqual(summaries['u1']['count'], 100)
+        self.assertEqual(summaries['u1']['total'], 5050.0)
+        self.assertEqual(summaries['u1']['min'], 1.0)
+        self.assertEqual(summaries['u1']['max'], 100.0)
+        self.assertAlmostEqual(summaries['u1']['quantiles'][0], 50.0, delta=2.0)
+        self.assertEqual(summaries['u2']['count'], 1)
+        self.aggregator.flush(force=True)
+        self.assertEqual(len(self.broker.tracks), 1)
+
+    def test_measure(self):
+        self.aggregator.measure('panda', 0.25, 1, 'u1')
+        self.aggregator.measure('panda', 0.25, 1, 'u1')
+        self.aggregator.measure('panda', 0.75, 0, 'u1')
+        self.aggregator.flush(force=True)
+        summary = self.broker.measures[0][1][0]
+        self.assertEqual(summary['pos'], [[250, 2]])
+        self.assertEqual(summary['neg'], [[750, 1]])
+
+    def test_sample_rates(self):
+        self.assertEqual(self.aggregator.rate('x.y.z'), 1.0)
+        self.assertEqual(self.aggregator.rate('loss'), 1.0)
+        self.assertTrue(self.aggregator.sampled('x.y'))
+        self.assertFalse(any(self.aggregator.sampled('x.z') for i in xrange(100)))
+
+
+if __name__ == '__main__':
+    unittest.main()
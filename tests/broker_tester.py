@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 11:05:42 2026
+
+@author: xm
+"""
+
+import threading
+import unittest
+from Queue import Queue
+from kafka.common import KafkaError
+from monk.network.broker import KafkaBroker
+from monk.network.codec import JsonCodec
+
+
+class FakeProducer(object):
+    """ Routes u1 to 1 and the others to 0, records the threads of the lookups """
+    def __init__(self):
+        self.lookups = []
+        self.sent = []
+        self.failures = 0
+
+    def partition_of(self, topic, name):
+        self.lookups.append((name, threading.current_thread()))
+        return 1 if name == 'u1' else 0
+
+    def send(self, topic, name, *msg):
+        raise AssertionError('the partitions are known')
+
+    def send_messages(self, topic, partition, *msg):
+        if self.failures:
+            self.failures -= 1
+            raise KafkaError('leader not available')
+        self.sent.append((partition, len(msg), threading.current_thread()))
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.reinits = []
+
+    def reinit(self):
+        self.reinits.append(threading.current_thread())
+
+
+class KafkaBrokerTests(unittest.TestCase):
+
+    def setUp(self):
+        # a buffered broker without kafka
+        self.broker = KafkaBroker.__new__(KafkaBroker)
+        self.broker.kafkaTopic = 'topic'
+        self.broker.codec = JsonCodec()
+        self.broker.producer = FakeProducer()
+        self.broker.producerOptions = {'batchSize':10, 'batchInterval':5}
+        self.broker.sendQueue = Queue(100)
+        self.broker.kafkaClient = FakeClient()
+        self.broker.senderClient = FakeClient()
+        self.broker.statsLock = threading.Lock()
+        self.broker.sent = self.broker.dropped = 0
+        self.broker.latency = self.broker.maxLatency = 0.0
+        self.broker.sender = threading.Thread(target=self.broker._send_loop)
+        self.broker.sender.start()
+
+    def tearDown(self):
+        if self.broker.sender:
+            self.broker.sendQueue.put(None)
+            self.broker.sender.join()
+
+    def test_partition_on_caller(self):
+        self.broker.produce_many('AddData', 'u1', [{'i':1}, {'i':2}])
+        self.broker.produce('AddData', 'u2', i=3)
+        self.broker.produce('AddData', 'u3', i=4)
+        self.broker.sendQueue.put(None)
+        self.broker.sender.join()
+        sender, self.broker.sender = self.broker.sender, None
+        main = threading.current_thread()
+        producer = self.broker.producer
+        self.assertEqual([name for name, thread in producer.lookups], ['u1', 'u2', 'u3'])
+        self.assertTrue(all(thread is main for name, thread in producer.lookups))
+        # one request per partition, sent by the sender thread
+        self.assertEqual(sorted((partition, n) for partition, n, thread in producer.sent), [(0, 2), (1, 2)])
+        self.assertTrue(all(thread is sender for partition, n, thread in producer.sent))
+        self.assertEqual(self.broker.producer_stats()['sent'], 4)
+
+    def test_sender_reconnect(self):
+        self.broker.producer.failures = 1
+        self.broker.produce('AddData', 'u1', i=1)
+        self.broker.produce('AddData', 'u2', i=2)
+        self.broker.sendQueue.put(None)
+        self.broker.sender.join()
+        sender, self.broker.sender = self.broker.sender, None
+        # only the connections of the sender are reset, by the sender
+        self.assertEqual(self.broker.senderClient.reinits, [sender])
+        self.assertEqual(self.broker.kafkaClient.reinits, [])
+        stats = self.broker.producer_stats(reset=True)
+        self.assertEqual((stats['sent'], stats['dropped']), (0, 2))
+        self.assertEqual(self.broker.producer_stats()['dropped'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:20:11 2026
+
+@author: xm
+"""
+
+import time
+import unittest
+from monk.utils.cache import create_cache, ObjectCache
+
+
+class ObjectCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.evicted = []
+
+    def on_evict(self, key, obj):
+        self.evicted.append(key)
+
+    def test_unbounded(self):
+        c = create_cache(onEvict=self.on_evict)
+        self.assertIsInstance(c, ObjectCache)
+        [c.put(i, i) for i in xrange(1000)]
+        self.assertEqual(len(c), 1000)
+        self.assertEqual(self.evicted, [])
+
+    def test_lru(self):
+        c = create_cache({'policy':'lru', 'maxSize':3}, onEvict=self.on_evict)
+        [c.put(i, i) for i in xrange(3)]
+        c.get(0)
+        c.put(3, 3)
+        self.assertEqual(self.evicted, [1])
+        self.assertIsNone(c.get(1))
+        self.assertEqual(c.stats(), {'hits':1, 'misses':1, 'evictions':1, 'size':3, 'bytes':0})
+
+    def test_lfu(self):
+        c = create_cache({'policy':'lfu', 'maxSize':3}, onEvict=self.on_evict)
+        [c.put(i, i) for i in xrange(3)]
+        c.get(0)
+        c.get(2)
+        c.put(3, 3)
+        self.assertEqual(self.evicted, [1])
+
+    def test_bytes(self):
+        c = create_cache({'policy':'lru', 'maxBytes':10}, sizeof=lambda obj: obj, onEvict=self.on_evict)
+        c.put('a', 4)
+        c.put('b', 4)
+        c.put('c', 4)
+        self.assertEqual(self.evicted, ['a'])
+        self.assertEqual(c.bytes, 8)
+
+    def test_ttl(self):
+        c = create_cache({'policy':'ttl', 'ttl':0.01}, onEvict=self.on_evict)
+        c.put('a', 1)
+        self.assertEqual(c.get('a'), 1)
+        time.sleep(0.02)
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(self.evicted, ['a'])
+
+if __name__ == '__main__':
+    unittest.main()
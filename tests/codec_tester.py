@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:40:52 2026
+
+@author: xm
+"""
+
+import unittest
+import simplejson
+from monk.network import codec
+
+
+class CodecTests(unittest.TestCase):
+
+    def setUp(self):
+        codec.register_schema('AddData', ('turtleName', 'entity'))
+
+    def tearDown(self):
+        codec.schemas.pop('Changing', None)
+
+    def test_json(self):
+        message = {'op':'AddData', 'name':'u1', 'turtleName':'t', 'entity':{'_id':'e1'}}
+        self.assertEqual(codec.decode(simplejson.dumps(message)), [message])
+        self.assertEqual(codec.decode(codec.JsonCodec().encode([message])), [message])
+
+    def test_binary_schema(self):
+        c = codec.BinaryCodec()
+        messages = [{'op':'AddData', 'name':'u1', 'turtleName':'t', 'entity':{'_id':'e%d' % i}, 'priority':1}
+                    for i in xrange(10)]
+        encoded = c.encode(messages)
+        self.assertEqual(encoded[0], codec.VERSION)
+        self.assertLess(len(encoded), len(simplejson.dumps(messages)))
+        self.assertEqual(codec.decode(encoded), messages)
+
+    def test_binary_without_schema(self):
+        c = codec.BinaryCodec()
+        messages = [{'op':'NoSchema', 'name':'u1', 'value':1.5},
+                    {'op':'AddData', 'name':'u2', 'turtleName':'t'}]
+        self.assertEqual(codec.decode(c.encode(messages)), messages)
+
+    def test_schema_mismatch(self):
+        c = codec.BinaryCodec()
+        codec.register_schema('Changing', ('a',))
+        encoded = c.encode([{'op':'Changing', 'name':'u1', 'a':1},
+                            {'op':'AddData', 'name':'u2', 'turtleName':'t'}])
+        codec.schemas['Changing'] = ('a', 'b')
+        # only the task out of its schema is lost
+        self.assertEqual(codec.decode(encoded), [{'op':'AddData', 'name':'u2', 'turtleName':'t'}])
+
+    def test_binary_without_msgpack(self):
+        encoded = codec.BinaryCodec().encode([{'op':'AddData', 'name':'u1', 'turtleName':'t'}])
+        binary, codec._binary = codec._binary, None
+        try:
+            self.assertEqual(codec.decode(encoded), [])
+        finally:
+            codec._binary = binary
+
+
+if __name__ == '__main__':
+    unittest.main()
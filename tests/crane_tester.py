@@ -5,12 +5,194 @@ Created on Sat Jan 25 22:45:25 2014
 @author: xm
 """
 
+import collections
+import threading
 import unittest
+from pymongo.errors import BulkWriteError
 import monk.core.crane as crane
 
 
+class FakeObj(object):
+    def __init__(self, _id):
+        self._id = _id
+
+
+class SavingObj(FakeObj):
+    def __init__(self, _id, store):
+        self._id = _id
+        self.store = store
+
+    def save(self):
+        self.store.save_one(self)
+
+    def generic(self):
+        return {'x':self._id}
+
+
+class FakeCollection(object):
+    """ Records the bulk writes, fails them on demand """
+    def __init__(self, name, database):
+        self.name = name
+        self.database = database
+
+    def bulk_write(self, requests, ordered=True):
+        if self.database.failures:
+            raise self.database.failures.pop(0)
+        self.database.writes.append((self.name, [(r._filter['_id'], r._doc, r._upsert) for r in requests]))
+
+    def find_one(self, query, *args):
+        return None
+
+
+class FakeDatabase(object):
+    def __init__(self):
+        self.writes = []
+        self.failures = []
+
+    def __getitem__(self, name):
+        return FakeCollection(name, self)
+
+
 class CraneTests(unittest.TestCase):
-    pass
+
+    def setUp(self):
+        self.database = FakeDatabase()
+        self.crane = self.create_crane(writeBehind=True)
+
+    def create_crane(self, writeBehind):
+        # Crane() skips the connection, the fields are set here instead
+        c = crane.Crane()
+        c._defaultCollectionName = c._currentCollectionName = 'pandas'
+        c._database = self.database
+        c._coll = self.database['pandas']
+        c._writeBehind = writeBehind
+        c._maxPending = 3
+        c._flushInterval = 3600
+        c._pending = collections.OrderedDict()
+        c._upserts = set()
+        c._oldest = 0
+        c._lock = threading.RLock()
+        c._dirty = {}
+        c._identities = {}
+        c._identityKeys = {}
+        c._missing = collections.OrderedDict()
+        return c
+
+    def test_coalesce(self):
+        a = FakeObj(1)
+        self.crane.update_one_in_fields(a, {'x':1})
+        self.crane.update_one_in_fields(a, {'y':2, 'x':3})
+        self.crane.push_one_in_fields(a, {'l':5})
+        self.crane.push_one_in_fields(a, {'l':{'$each':[6, 7]}})
+        self.assertEqual(self.database.writes, [])
+        self.assertTrue(self.crane.flush())
+        self.assertEqual(self.database.writes,
+                         [('pandas', [(1, {'$set':{'x':3, 'y':2}, '$push':{'l':{'$each':[5, 6, 7]}}}, True)])])
+        self.assertEqual(self.crane._pending, {})
+        self.assertEqual(self.crane._upserts, set())
+
+    def test_conflicts(self):
+        a = FakeObj(1)
+        self.crane.push_one_in_fields(a, {'l':5})
+        self.crane.pull_one_in_fields(a, {'l':5})
+        # the $pull waits for the $push to be written
+        self.assertEqual(self.database.writes, [('pandas', [(1, {'$push':{'l':{'$each':[5]}}}, False)])])
+        self.crane.pull_one_in_fields(a, {'l':6})
+        self.assertEqual(len(self.database.writes), 2)
+        self.crane.update_one_in_fields(a, {'l.0':1})
+        self.assertEqual(self.database.writes[-1], ('pandas', [(1, {'$pull':{'l':6}}, False)]))
+        self.crane.flush()
+        self.assertEqual(self.database.writes[-1], ('pandas', [(1, {'$set':{'l.0':1}}, True)]))
+
+    def test_flush_threshold(self):
+        self.crane.update_one_in_fields(FakeObj(1), {'x':1})
+        self.crane.update_one_in_fields(FakeObj(2), {'x':1})
+        self.assertEqual(self.database.writes, [])
+        self.crane.update_one_in_fields(FakeObj(3), {'x':1})
+        self.assertEqual([w[0] for w in self.database.writes[0][1]], [1, 2, 3])
+        self.crane._flushInterval = 0
+        self.crane.update_one_in_fields(FakeObj(4), {'x':1})
+        self.assertEqual(len(self.database.writes), 2)
+        # without write-behind, every update is written at once
+        c = self.create_crane(writeBehind=False)
+        c.update_one_in_fields(FakeObj(5), {'x':1})
+        self.assertEqual(len(self.database.writes), 3)
+
+    def test_collection_switch(self):
+        self.crane.update_one_in_fields(FakeObj(1), {'x':1})
+        self.crane.set_collection_name('pandas')
+        self.crane.set_collection_name('users')
+        self.crane.update_one_in_fields(FakeObj(1), {'x':2})
+        self.crane.reset_collection_name()
+        self.assertEqual(self.database.writes, [])
+        self.assertEqual(self.crane._currentCollectionName, 'pandas')
+        self.crane.flush()
+        self.assertEqual(self.database.writes, [('pandas', [(1, {'$set':{'x':1}}, True)]),
+                                                ('users', [(1, {'$set':{'x':2}}, True)])])
+
+    def test_read_flush(self):
+        self.crane._maxPending = 10
+        self.crane.update_one_in_fields(FakeObj(1), {'x':1})
+        self.crane.update_one_in_fields(FakeObj(2), {'x':2})
+        self.crane.set_collection_name('users')
+        self.crane.update_one_in_fields(FakeObj(1), {'x':3})
+        self.crane.reset_collection_name()
+        # a read by _id writes the pending update of that document only
+        self.crane.load_one_in_fields(FakeObj(1), ['x'])
+        self.assertEqual(self.database.writes, [('pandas', [(1, {'$set':{'x':1}}, True)])])
+        self.crane.load_one_in_fields(FakeObj(3), ['x'])
+        self.assertEqual(len(self.database.writes), 1)
+        # a query writes those of its collection
+        self.crane.has_name_user('a', 'u1')
+        self.assertEqual(self.database.writes[-1], ('pandas', [(2, {'$set':{'x':2}}, True)]))
+        self.assertEqual(self.crane._pending.keys(), [('users', 1)])
+
+    def test_evict_dirty(self):
+        self.crane.set_collection_name('users')
+        self.crane._dirty[1] = 'users'
+        self.crane.set_collection_name('pandas')
+        # written back to the collection it was changed in
+        self.crane._Crane__on_evict(1, SavingObj(1, self.crane))
+        self.assertEqual(self.crane._pending.keys(), [('users', 1)])
+        self.assertEqual(self.crane._currentCollectionName, 'pandas')
+        self.assertEqual(self.crane._dirty, {})
+        # clean objects are not written
+        self.crane._Crane__on_evict(2, SavingObj(2, self.crane))
+        self.assertEqual(len(self.crane._pending), 1)
+
+    def test_failed_flush(self):
+        self.crane.update_one_in_fields(FakeObj(1), {'x':1})
+        self.crane.push_one_in_fields(FakeObj(2), {'l':1})
+        # a transient failure keeps the updates for the next flush
+        self.database.failures.append(Exception('network'))
+        self.assertFalse(self.crane.flush())
+        self.assertEqual(self.crane._upserts, set([('pandas', 1)]))
+        self.assertTrue(self.crane.flush())
+        self.assertEqual(self.database.writes, [('pandas', [(1, {'$set':{'x':1}}, True),
+                                                            (2, {'$push':{'l':{'$each':[1]}}}, False)])])
+        # the updates rejected by mongodb are dropped
+        self.crane.update_one_in_fields(FakeObj(3), {'x':1})
+        self.database.failures.append(BulkWriteError({'writeErrors':[{'index':0}]}))
+        self.assertFalse(self.crane.flush())
+        self.assertEqual(self.crane._pending, {})
+
+    def test_identities(self):
+        # the identities of evicted objects are forgotten
+        self.crane._Crane__index_identity(('pandas', 'a', 'u1'), 1)
+        self.crane._Crane__index_identity(('pandas', 'b', 'u1'), 2)
+        self.crane._Crane__on_evict(1, FakeObj(1))
+        self.assertEqual(self.crane._identities, {('pandas', 'b', 'u1'):2})
+        self.assertEqual(self.crane._identityKeys, {2:('pandas', 'b', 'u1')})
+        # the misses are capped, the oldest go first
+        self.crane.MAX_MISSING = 3
+        for i in xrange(5):
+            self.assertIsNone(self.crane.load_or_create({'name':'m{0}'.format(i)}))
+        self.assertEqual([key[1] for key in self.crane._missing], ['m2', 'm3', 'm4'])
+        # and the expired ones are purged
+        for key in self.crane._missing:
+            self.crane._missing[key] -= self.crane.MISSING_TTL + 1
+        self.crane.load_or_create({'name':'m5'})
+        self.assertEqual([key[1] for key in self.crane._missing], ['m5'])
 
 
 if __name__ == '__main__':
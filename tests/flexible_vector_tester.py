@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 20:12:41 2026
+
+@author: xm
+"""
+
+import unittest
+import numpy as np
+import monk.math
+from monk.math.flexible_vector import FlexibleVector, FlexibleMatrix
+from monk.math.flexible_vector import axpbypcz, dualUpdate, primalUpdate
+from monk.math.flexible_vector import difference, distance2, cosine, relativeResidual, norms2
+
+
+class FlexibleVectorTests(unittest.TestCase):
+
+    def test_from_arrays(self):
+        a = FlexibleVector.from_arrays([1, 2, 3, 7, 8, 20], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(a.generic(), [(1, 1), (2, 2), (3, 3), (7, 4), (8, 5), (20, 6)])
+        self.assertEqual(a._numOfNodes(), 3)
+        self.assertRaises(ValueError, FlexibleVector.from_arrays, [2, 1], [1, 1])
+        self.assertRaises(ValueError, FlexibleVector.from_arrays, [1, 2], [1])
+
+    def test_to_arrays(self):
+        a = FlexibleVector.from_arrays([1, 2, 5], [1, 2, 3])
+        indices, values = a.to_arrays()
+        self.assertEqual(indices.dtype, np.int64)
+        self.assertEqual(values.dtype, np.float32)
+        self.assertEqual(list(indices), [1, 2, 5])
+        self.assertEqual(list(values), [1, 2, 3])
+
+    def test_to_arrays_view(self):
+        a = FlexibleVector.from_arrays(np.arange(4), np.ones(4))
+        indices, values = a.to_arrays(copy=False)
+        self.assertFalse(values.flags.writeable)
+        a[2] = 9
+        self.assertEqual(values[2], 9)
+        indices, values = a.to_arrays()
+        values[1] = 9
+        self.assertEqual(a[1], 1)
+
+    def test_generic_roundtrip(self):
+        a = FlexibleVector(generic=[[1, 1.0], [3, 2.0], [4, 3.0]])
+        self.assertEqual(a._numOfNodes(), 2)
+        a[2] = 2
+        self.assertEqual(a.generic(), [(1, 1), (2, 2), (3, 2), (4, 3)])
+        b = FlexibleVector(generic=[[3, 1.0], [1, 2.0]])
+        self.assertEqual(b.generic(), [(1, 2), (3, 1)])
+
+    def test_encode_roundtrip(self):
+        a = FlexibleVector(generic=[(1, 1.5), (2, -2.0), (3, 0), (700, 0.25), (2 ** 40, 5.0)])
+        b = FlexibleVector(generic=a.encode())
+        self.assertEqual(b.generic(), a.generic())
+        c = FlexibleVector(generic=[(2, 1.0), (5, 1.0)])
+        c.update(a.encode())
+        self.assertEqual(c.generic(), [(1, 1.5), (2, -2.0), (5, 1.0), (700, 0.25), (2 ** 40, 5.0)])
+        self.assertEqual(FlexibleVector(generic=FlexibleVector().encode()).generic(), [])
+
+    def test_decode_errors(self):
+        self.assertRaises(ValueError, FlexibleVector, generic=b'\x02\x00')
+        self.assertRaises(ValueError, FlexibleVector, generic=b'\x01\x05\x01')
+
+    def test_add_merge(self):
+        a = FlexibleVector(generic=[(1, 1.0), (2, 1.0), (6, 1.0), (9, 1.0)])
+        b = FlexibleVector(generic=[(0, 1.0), (3, 2.0), (4, 2.0), (9, 1.0), (12, 1.0)])
+        a.add(b, 2)
+        self.assertEqual(a.generic(), [(0, 2), (1, 1), (2, 1), (3, 4), (4, 4), (6, 1), (9, 3), (12, 2)])
+        self.assertEqual(a._numOfNodes(), 4)
+        a.add(a, 1)
+        self.assertEqual(a[3], 8)
+
+    def test_copy_update_and_clone(self):
+        a = FlexibleVector(generic=[(1, 1.0), (5, 1.0)])
+        b = FlexibleVector(generic=[(2, 2.0), (3, 3.0)])
+        a.copyUpdate(b)
+        self.assertEqual(a.getKeys(), [1, 2, 3, 5])
+        self.assertEqual(a.generic(), [(2, 2), (3, 3)])
+        c = a.clone()
+        c[2] = 7
+        self.assertEqual(c.getKeys(), a.getKeys())
+        self.assertEqual(a[2], 2)
+
+    def test_axpbypcz(self):
+        x = FlexibleVector(generic=[(1, 1.0), (2, 1.0)])
+        y = FlexibleVector(generic=[(2, 1.0), (5, 2.0)])
+        z = FlexibleVector(generic=[(7, 4.0)])
+        out = FlexibleVector(generic=[(0, 3.0)])
+        axpbypcz(out, 2, x, -1, y, 0.5, z)
+        self.assertEqual(out.generic(), [(1, 2), (2, 1), (5, -2), (7, 2)])
+
+    def test_admm_updates(self):
+        mu = FlexibleVector(generic=[(1, 1.0)])
+        dq = FlexibleVector()
+        q = FlexibleVector(generic=[(1, 2.0), (2, 2.0)])
+        z = FlexibleVector(generic=[(2, 1.0), (3, 1.0)])
+        w = FlexibleVector(generic=[(1, 1.0), (3, 1.0)])
+        self.assertEqual(dualUpdate(mu, dq, q, z), (6, 8, 2, 11))
+        self.assertEqual(dq.generic(), [(1, 2), (2, 1), (3, -1)])
+        self.assertEqual(mu.generic(), [(1, 3), (2, 1), (3, -1)])
+        self.assertEqual(primalUpdate(q, dq, z, w, mu, 0.5), (4.25, 3.25, 2))
+        self.assertEqual(q.generic(), [(1, -1), (3, 1.5)])
+        self.assertEqual(dq.generic(), [(1, -1), (2, -1), (3, 0.5)])
+
+    def test_arena(self):
+        a = FlexibleVector(generic=[(i * 2, 1.0) for i in xrange(100)])
+        stats = a._memorySize(stats=True)
+        self.assertEqual(stats['total'], a._memorySize())
+        self.assertEqual(stats['total'], stats['reserved'] + stats['values'])
+        self.assertGreater(stats['slabs'], 1)
+        for i in xrange(100):
+            a[i * 2 + 1] = 1.0
+        stats = a._memorySize(stats=True)
+        self.assertGreater(stats['free'], 0)
+        self.assertEqual(a._numOfNodes(), 1)
+        for i in xrange(50):
+            del a[i * 4 + 1]
+        self.assertGreater(a._memorySize(stats=True)['recycled'], 0)
+        self.assertEqual(len(a.generic()), 150)
+        del a[200]
+        self.assertEqual(len(a.generic()), 150)
+
+    def test_distances(self):
+        a = FlexibleVector(generic=[(1, 1.0), (2, 2.0), (3, 3.0), (9, 1.0)])
+        b = FlexibleVector(generic=[(0, 1.0), (2, 1.0), (3, 1.0), (4, 2.0), (20, 2.0)])
+        self.assertEqual(norms2(a, b), (16, 15, 11, 5))
+        self.assertEqual(distance2(a, b), difference(a, b).norm2())
+        self.assertEqual(distance2(a, FlexibleVector()), 15)
+        self.assertAlmostEqual(cosine(a, b), 5 / np.sqrt(15 * 11))
+        self.assertEqual(cosine(a, FlexibleVector()), 0)
+        self.assertAlmostEqual(relativeResidual(a, a), 0, delta=1e-3)
+        self.assertAlmostEqual(relativeResidual(a, b, 0), np.sqrt(16 / np.sqrt(15 * 11)))
+
+
+class FlexibleMatrixTests(unittest.TestCase):
+
+    def test_dot(self):
+        rows = [FlexibleVector(generic=[(1, 1.0), (2, 2.0), (9, 3.0)]),
+                FlexibleVector(),
+                FlexibleVector(generic=[(2, -1.0), (3, 1.0), (4, 1.0), (10, 2.0)])]
+        x = FlexibleVector(generic=[(2, 1.0), (3, 2.0), (9, 1.0), (10, 0.5), (11, 7.0)])
+        m = FlexibleMatrix(rows)
+        self.assertEqual(len(m), 3)
+        self.assertEqual(list(m.dot(x)), [row.dot(x) for row in rows])
+        self.assertEqual(list(FlexibleMatrix().dot(x)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
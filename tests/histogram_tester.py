@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:31:08 2026
+
+@author: xm
+"""
+
+import random
+import unittest
+from monk.utils.histogram import Histogram
+
+
+class HistogramTests(unittest.TestCase):
+
+    def test_percentiles(self):
+        h = Histogram()
+        values = [random.expovariate(100.0) for i in xrange(10000)]
+        for v in values:
+            h.record(v)
+        values.sort()
+        self.assertEqual(h.count, 10000)
+        for p in [50, 90, 99]:
+            expected = values[int(len(values) * p / 100.0) - 1]
+            self.assertAlmostEqual(h.percentile(p) / expected, 1.0, delta=0.05)
+        self.assertEqual(h.max, values[-1])
+        self.assertEqual(h.percentile(100), values[-1])
+
+    def test_merge(self):
+        h1 = Histogram()
+        h2 = Histogram()
+        [h1.record(0.001) for i in xrange(10)]
+        [h2.record(0.1) for i in xrange(10)]
+        h1.merge(h2)
+        self.assertEqual(h1.count, 20)
+        self.assertEqual(h1.min, 0.001)
+        self.assertEqual(h1.max, 0.1)
+        self.assertAlmostEqual(h1.mean(), 0.0505)
+        self.assertRaises(ValueError, h1.merge, Histogram(precision=3))
+
+    def test_empty(self):
+        h = Histogram()
+        self.assertEqual(h.percentile(99), 0.0)
+        self.assertEqual(h.summary()['count'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 16:05:44 2026
+
+@author: xm
+"""
+
+import unittest
+import numpy as np
+from monk.roles.monitor import Measurer
+
+
+def exact_curves(scores, resolution):
+    """ ROC and PRC from every score, one point per example removed from the
+    lowest score up, as before the scores were binned """
+    num = int(1.0 / resolution) + 1
+    totalP = sum(1 for s, label in scores if label > 0)
+    totalN = len(scores) - totalP
+    tp, fp = totalP, totalN
+    PRC, PRCn = np.zeros(num), np.zeros(num)
+    ROC, ROCn = np.zeros(num), np.zeros(num)
+    for s, label in sorted(scores):
+        if label > 0:
+            tp -= 1
+        else:
+            fp -= 1
+        recall = float(tp) / totalP
+        precision = float(tp) / (tp + fp) if tp + fp else 1.0
+        fpr = float(fp) / totalN
+        v = min(int(precision / resolution), num - 1)
+        PRC[v] += recall
+        PRCn[v] += 1
+        v = min(int(fpr / resolution), num - 1)
+        ROC[v] += recall
+        ROCn[v] += 1
+    PRC /= np.maximum(PRCn, 1)
+    ROC /= np.maximum(ROCn, 1)
+    # the missing buckets take the value at the higher precision or the lower fpr
+    for v in reversed(xrange(num - 1)):
+        if PRCn[v] == 0:
+            PRC[v] = PRC[v + 1]
+    for v in xrange(1, num):
+        if ROCn[v] == 0:
+            ROC[v] = ROC[v - 1]
+    return ROC, PRC
+
+
+class MeasurerTests(unittest.TestCase):
+
+    def test_curves(self):
+        for seed in xrange(5):
+            rng = np.random.RandomState(seed)
+            measurer = Measurer()
+            ROCs, PRCs = [], []
+            for user in ['u1', 'u2', 'u3']:
+                labels = (rng.rand(2000) < 0.4).astype(int)
+                values = np.clip(rng.normal(0.35 + 0.3 * labels, 0.2), 0, 1)
+                scores = zip(values.tolist(), labels.tolist())
+                for value, label in scores:
+                    measurer.add(value, user, label)
+                ROC, PRC = exact_curves(scores, measurer.resolution)
+                ROCs.append(ROC)
+                PRCs.append(PRC)
+            ROCs = np.sort(ROCs, axis=0)
+            PRCs = np.sort(PRCs, axis=0)
+            # the examples of a score bin leave together, recall moves by at most
+            # the fullest bin over the fewest positives
+            rows = measurer.users.values()
+            tolerance = float((measurer.pos[rows] + measurer.neg[rows]).max()) / \
+                        measurer.pos[rows].sum(axis=1).min()
+            self.assertEqual(measurer.get_ROCs().shape, ROCs.shape)
+            self.assertLessEqual(np.abs(measurer.get_ROCs() - ROCs).max(), tolerance)
+            self.assertLessEqual(np.abs(measurer.get_PRCs() - PRCs).max(), tolerance)
+            self.assertLess(np.abs(measurer.get_ROCs() - ROCs).mean(), 0.005)
+            self.assertLess(np.abs(measurer.get_PRCs() - PRCs).mean(), 0.005)
+
+    def test_bins(self):
+        # pre-aggregated bins give the same curves as the scores
+        rng = np.random.RandomState(0)
+        measurer, binned = Measurer(), Measurer()
+        labels = (rng.rand(500) < 0.5).astype(int)
+        values = np.clip(rng.normal(0.35 + 0.3 * labels, 0.2), 0, 1)
+        counts = [{}, {}]
+        for value, label in zip(values, labels):
+            measurer.add(value, 'u1', label)
+            b = min(int(value * 1000), 999)
+            counts[1 - label][b] = counts[1 - label].get(b, 0) + 1
+        binned.add_bins('u1', 1000, counts[0].items(), counts[1].items())
+        np.testing.assert_array_equal(measurer.get_ROCs(), binned.get_ROCs())
+        np.testing.assert_array_equal(measurer.get_PRCs(), binned.get_PRCs())
+        # users without both labels are left out
+        binned.add_bins('u2', 1000, [[10, 3]], [])
+        self.assertEqual(binned.get_ROCs().shape[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
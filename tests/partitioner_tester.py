@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 14:40:17 2026
+
+@author: xm
+"""
+
+import unittest
+import monk.core.api as monkapi
+import monk.roles.worker as worker
+from monk.network.partitioner import ConsistentHash, UserPartitioner
+from monk.network.producer import UserProducer
+
+
+class FakeProducer(object):
+    def __init__(self, partitioner):
+        self.partitioner = partitioner
+
+
+class FakeMetadataClient(object):
+    def __init__(self):
+        self.topic_partitions = {'topic':{0:None, 1:None, 2:None}}
+        self.lookups = 0
+
+    def get_partition_ids_for_topic(self, topic):
+        self.lookups += 1
+        return sorted(self.topic_partitions[topic])
+
+
+class UserPartitionerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.apis = monkapi.get_user_partition, monkapi.load_user_partitions
+        self.partitions = {'u1':1, 'u2':2}
+        self.lookups = []
+        def get_user_partition(userName):
+            self.lookups.append(userName)
+            return self.partitions.get(userName)
+        monkapi.get_user_partition = get_user_partition
+        monkapi.load_user_partitions = lambda: dict(self.partitions)
+        self.partitioner = UserPartitioner([0, 1, 2])
+
+    def tearDown(self):
+        monkapi.get_user_partition, monkapi.load_user_partitions = self.apis
+
+    def test_routes(self):
+        # the warm up loads the known users at once
+        self.assertEqual(self.partitioner.partition('u1'), 1)
+        self.assertEqual(self.partitioner.partition('u2'), 2)
+        self.assertEqual(self.lookups, [])
+        self.partitions['u1'] = 0
+        self.assertEqual(self.partitioner.partition('u1'), 1)
+        # until the route expires
+        self.partitioner.routes['u1'] = (1, 0)
+        self.assertEqual(self.partitioner.partition('u1'), 0)
+        self.assertEqual(self.lookups, ['u1'])
+
+    def test_update(self):
+        self.partitioner.update('u1', 2)
+        self.assertEqual(self.partitioner.partition('u1'), 2)
+        self.partitioner.update('u1')
+        self.assertEqual(self.partitioner.partition('u1'), 1)
+        self.assertEqual(self.lookups, ['u1'])
+
+    def test_fallback(self):
+        ring = ConsistentHash([0, 1, 2])
+        names = ['x{}'.format(i) for i in xrange(20)]
+        self.assertEqual([self.partitioner.partition(name) for name in names],
+                         [ring.get(name) for name in names])
+        self.assertEqual(len(set(ring.get(name) for name in names)), 3)
+        # unknown users are not looked up again until their route expires
+        self.partitioner.partition('x0')
+        self.assertEqual(self.lookups, names)
+        # a new partition only takes keys from the others
+        more = ConsistentHash([0, 1, 2, 3])
+        self.assertTrue(all(more.get(name) in (ring.get(name), 3) for name in names))
+        self.assertEqual(self.partitioner.partition('x0', [0, 1, 2, 3]), more.get('x0'))
+
+    def test_producer_partitions(self):
+        producer = UserProducer.__new__(UserProducer)
+        producer.partitioner = self.partitioner
+        producer.metadataClient = FakeMetadataClient()
+        producer.partitions = {}
+        self.assertEqual([producer.partition_of('topic', name) for name in ['u1', 'u2', 'x0']],
+                         [1, 2, ConsistentHash([0, 1, 2]).get('x0')])
+        self.assertEqual(producer.metadataClient.lookups, 1)
+        # read again once the client reloads the metadata, or on a refresh
+        producer.metadataClient.topic_partitions['topic'] = {0:None, 1:None, 2:None, 3:None}
+        self.assertEqual(producer.partition_of('topic', 'x1'), ConsistentHash([0, 1, 2, 3]).get('x1'))
+        self.assertEqual(producer.metadataClient.lookups, 2)
+        producer.refresh_partitions()
+        producer.partition_of('topic', 'u1')
+        self.assertEqual(producer.metadataClient.lookups, 3)
+
+    def test_update_route_task(self):
+        broker = worker.WorkerBroker.__new__(worker.WorkerBroker)
+        broker.producer = FakeProducer(self.partitioner)
+        workerBroker = getattr(worker.worker, 'workerBroker', None)
+        worker.worker.workerBroker = broker
+        try:
+            worker.UpdateRoute({'name':'u1', 'partition':2}).act()
+            self.assertEqual(self.partitioner.partition('u1'), 2)
+            worker.UpdateRoute({'name':'u1'}).act()
+            self.assertEqual(self.partitioner.partition('u1'), 1)
+            self.assertEqual(self.lookups, ['u1'])
+        finally:
+            worker.worker.workerBroker = workerBroker
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 14:02:51 2026
+
+@author: xm
+"""
+
+import simplejson
+import unittest
+from collections import defaultdict
+import monk.core.api as monkapi
+from monk.network.server import MonkServer, Task, TaskStats
+import monk.roles.worker as worker
+
+
+class StubBroker(object):
+    """ Hands out the queued messages, one per consume_one """
+    def __init__(self):
+        self.messages = []
+
+    def is_consumer_ready(self):
+        return True
+
+    def consume(self, batchSize):
+        messages, self.messages = self.messages[:batchSize], self.messages[batchSize:]
+        return messages
+
+    def consume_one(self):
+        if self.messages:
+            return self.messages.pop(0)
+        return None
+
+
+class RecordingTask(Task):
+    def act(self):
+        self.get('log').append(self.get('i'))
+        if self.get('fails'):
+            raise ValueError('failed')
+
+
+class RecordingServer(MonkServer):
+    BATCH_SIZE = 100
+
+    def init_brokers(self, config):
+        self.broker = StubBroker()
+        self.batches = []
+        return [self.broker]
+
+    def execute_batch(self, tasks):
+        self.batches.append(tasks)
+
+
+class ServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RecordingServer('tester', config=True)
+
+    def send(self, op, name, **kwargs):
+        kwargs['op'] = op
+        kwargs['name'] = name
+        self.server.broker.messages.append(simplejson.dumps(kwargs))
+
+    def executed(self):
+        self.server._poll()
+        self.server._execute()
+        return [(task.__class__.__name__, task.name, task.get('para'), task.get('value'))
+                for task in self.server.batches[-1]]
+
+    def test_coalesce(self):
+        self.send('SetMantisParameter', 'u1', turtleName='t', para='rho', value=1)
+        self.send('SaveTurtle', 'u1', turtleName='t')
+        self.send('SetMantisParameter', 'u1', turtleName='t', para='gamma', value=2)
+        self.send('AddData', 'u1', turtleName='t', entity={})
+        self.send('SetMantisParameter', 'u1', turtleName='t', para='rho', value=3)
+        self.send('SaveTurtle', 'u2', turtleName='t')
+        self.send('SaveTurtle', 'u1', turtleName='t')
+        self.send('AddData', 'u1', turtleName='t', entity={})
+        # the superseded tasks are dropped, each parameter keeps its latest value
+        self.assertEqual(self.executed(), [('SetMantisParameter', 'u1', 'gamma', 2),
+                                           ('AddData', 'u1', None, None),
+                                           ('SetMantisParameter', 'u1', 'rho', 3),
+                                           ('SaveTurtle', 'u2', None, None),
+                                           ('SaveTurtle', 'u1', None, None),
+                                           ('AddData', 'u1', None, None)])
+        self.assertEqual(self.server.coalesced, 2)
+        self.assertEqual(self.server.latest, {})
+
+    def test_coalesce_keys(self):
+        tasks = [worker.SetMantisParameter({'name':'u1', 'turtleName':'t', 'para':'rho'}),
+                 worker.SetMantisParameter({'name':'u1', 'turtleName':'t', 'para':'gamma'}),
+                 worker.OffsetCommit({'name':'w1'}),
+                 worker.OffsetCommit({'name':'w2'}),
+                 worker.AddData({'name':'u1', 'turtleName':'t'})]
+        self.assertEqual([task.coalesce_key() for task in tasks],
+                         [('SetMantisParameter', 'rho', 't', 'u1'),
+                          ('SetMantisParameter', 'gamma', 't', 'u1'),
+                          ('OffsetCommit',), ('OffsetCommit',), None])
+
+    def test_coalesce_counter(self):
+        for i in xrange(5):
+            self.send('OffsetCommit', 'w{}'.format(i))
+        self.assertEqual(self.executed(), [('OffsetCommit', 'w4', None, None)])
+        self.assertEqual(self.server.coalesced, 4)
+        # a task arriving after the latest one ran is not superseded
+        self.send('OffsetCommit', 'w5')
+        self.assertEqual(self.executed(), [('OffsetCommit', 'w5', None, None)])
+        self.assertEqual(self.server.coalesced, 4)
+
+
+class ExecuteBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.flush = monkapi.flush
+        self.flushes = []
+        monkapi.flush = lambda: self.flushes.append(True)
+        self.server = MonkServer('tester', config=None)
+        # without a config the server is not started
+        self.server.opStats = defaultdict(TaskStats)
+        self.server.turtleStats = defaultdict(TaskStats)
+        self.server.userStats = defaultdict(TaskStats)
+
+    def tearDown(self):
+        monkapi.flush = self.flush
+
+    def test_grouping_order(self):
+        log = []
+        groups = [('t1', 'u1'), ('t2', 'u1'), ('t1', 'u1'), ('t1', 'u2'), ('t2', 'u1'), ('t1', 'u1')]
+        tasks = [RecordingTask({'name':userName, 'turtleName':turtleName, 'i':i, 'log':log, 'fails':i == 2})
+                 for i, (turtleName, userName) in enumerate(groups)]
+        self.server.execute_batch(tasks)
+        # groups in the order of their first task, tasks in arrival order within a group
+        self.assertEqual(log, [0, 2, 5, 1, 4, 3])
+        self.assertEqual(self.flushes, [True])
+        stats = self.server.opStats['RecordingTask']
+        self.assertEqual((stats.succeeded, stats.failed), (5, 1))
+        self.assertEqual(self.server.turtleStats['t1'].succeeded, 3)
+        self.assertEqual(self.server.userStats['u1'].failed, 1)
+        # a single task is written by the store as it goes
+        self.server.execute_batch(tasks[:1])
+        self.assertEqual(self.flushes, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:05:37 2026
+
+@author: xm
+"""
+
+import unittest
+import numpy as np
+import monk.math
+from monk.math.flexible_vector import FlexibleVector
+from monk.math.svm_solver_dual import SVMDual
+
+
+class SVMDualTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.xs = []
+        self.ys = []
+        for j in xrange(50):
+            indices = np.unique(rng.randint(0, 40, 8))
+            values = rng.rand(len(indices))
+            self.xs.append(FlexibleVector.from_arrays(indices, values))
+            self.ys.append(1 if values.dot(np.cos(indices)) > 0 else -1)
+        self.z = FlexibleVector.from_arrays([0, 3, 6, 9], [0.1, -0.1, 0.2, 0.05])
+        self.mu = FlexibleVector.from_arrays([3, 9], [0.01, -0.02])
+
+    def solver(self, w):
+        s = SVMDual(w, 1e-5, 1.0, 1.0, 1000, len(self.xs))
+        for j, (x, y) in enumerate(zip(self.xs, self.ys)):
+            s.setData(x, y, 1.0, j)
+        s.num_instances = len(self.xs)
+        s.setModel0(self.z, self.mu)
+        return s
+
+    def test_train_matches_alphas(self):
+        # w only holds the even keys, the odd ones are dropped as in addFast
+        w = FlexibleVector.from_arrays(np.arange(0, 40, 2), np.zeros(20))
+        s = self.solver(w)
+        s.trainModel()
+        trained = w.to_arrays(copy=True)
+        self.assertLess(s.status(), len(self.xs))
+        s.setModel(self.z, self.mu)
+        rebuilt = w.to_arrays(copy=True)
+        self.assertEqual(list(trained[0]), list(rebuilt[0]))
+        np.testing.assert_allclose(trained[1], rebuilt[1], atol=1e-4)
+
+    def test_warm_start(self):
+        w = FlexibleVector.from_arrays(np.arange(40), np.zeros(40))
+        s = self.solver(w)
+        cold = s.trainModel()
+        alphas = s.getAlphas()
+        self.assertEqual(len(alphas), len(self.xs))
+        s.setAlphas(np.zeros(len(alphas)))
+        self.assertEqual(s.getAlphas().sum(), 0)
+        s.setAlphas(alphas)
+        s.setModel(self.z, self.mu)
+        self.assertLessEqual(s.trainModel(), cold)
+
+    def test_train_without_instances(self):
+        w = FlexibleVector.from_arrays([0, 1], [1, 2])
+        s = SVMDual(w, 1e-5, 1.0, 1.0, 10, 5)
+        s.trainModel()
+        self.assertEqual(w.generic(), [(0, 1), (1, 2)])
+
+if __name__ == '__main__':
+    unittest.main()
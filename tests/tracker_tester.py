@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 16:38:09 2026
+
+@author: xm
+"""
+
+import simplejson
+import time
+import unittest
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase
+import monk.roles.monitor as monitor
+from monk.roles.monitor import RingSeries, Tracker, TrackerHandler, TrackerUsersHandler
+
+
+class RingSeriesTests(unittest.TestCase):
+
+    def test_wraparound(self):
+        ring = RingSeries(1, 4, numUsers=1)
+        for t in xrange(10):
+            ring.add(t + 0.5, t, 0)
+        ring.add(9.9, 1.0, 0)
+        # only the latest capacity buckets are kept, averaged
+        self.assertEqual(ring.series(0, 10), [(6, 0, 6.0), (7, 0, 7.0), (8, 0, 8.0), (9, 0, 5.0)])
+        # older samples are ignored
+        ring.add(2.5, 100.0, 0)
+        self.assertEqual(ring.series(0, 10)[0], (6, 0, 6.0))
+        self.assertEqual(ring.series(7, 8), [(7, 0, 7.0), (8, 0, 8.0)])
+        self.assertEqual(ring.retention(), 4)
+
+    def test_users(self):
+        ring = RingSeries(10, 3, numUsers=1)
+        ring.add(1, 2.0, 0)
+        ring.grow(3)
+        ring.add(5, 6.0, 2, count=3)
+        self.assertEqual(ring.series(0, 9), [(0, 0, 2.0), (0, 2, 2.0)])
+        ring.clear()
+        self.assertEqual(ring.series(0, 9), [])
+
+
+class TrackerTests(unittest.TestCase):
+
+    def test_rollups(self):
+        tracker = Tracker()
+        end = 7200 * 3600.0
+        start = end - 2 * 3600
+        for t in xrange(int(start), int(end), 10):
+            tracker.add(t, t % 60, 'u1')
+        for user in ['u{}'.format(i) for i in xrange(2, 10)]:
+            tracker.add(end - 1, 1.0, user)
+        self.assertEqual(tracker.names[:2], ['u1', 'u2'])
+        # by the second within 10 minutes and 1000 points
+        series = tracker.series(end - 300, end)
+        self.assertEqual([(t, v) for t, user, v in series if user == 'u1'][:2],
+                         [(end - 300, 0.0), (end - 290, 10.0)])
+        # by the minute beyond, the buckets average the seconds
+        series = [(t, v) for t, user, v in tracker.series(end - 3600, end) if user == 'u1']
+        self.assertEqual(len(series), 60)
+        self.assertEqual(series[0], (end - 3600, 25.0))
+        # by the hour beyond 1000 points
+        series = [(t, v) for t, user, v in tracker.series(start, end, maxPoints=100) if user == 'u1']
+        self.assertEqual(series, [(start, 25.0), (start + 3600, 25.0)])
+        # by the hour beyond the day kept by the minute
+        self.assertEqual(len(tracker.series(end - 2 * 86400, end)), 2 + 8)
+
+    def test_summary(self):
+        tracker = Tracker()
+        tracker.add_summary(60.0, 'u1', {'count':4, 'total':10.0})
+        tracker.add(60.5, 5.0, 'u1')
+        self.assertEqual(tracker.series(0, 61), [(60, 'u1', 3.0)])
+        self.assertEqual(tracker.summaries['u1']['count'], 4)
+
+
+class TrackerHandlerTests(AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.trackers = getattr(monitor.monitor, 'trackers', None)
+        tracker = Tracker()
+        t = time.time()
+        tracker.add(t - 30, 1.0, 'u1')
+        tracker.add(t - 30, 3.0, 'u2')
+        tracker.add(t - 1200, 3.0, 'u2')
+        tracker.add_summary(t - 30, 'u2', {'count':2, 'total':6.0})
+        monitor.monitor.trackers = {'loss':tracker}
+        super(TrackerHandlerTests, self).setUp()
+
+    def tearDown(self):
+        monitor.monitor.trackers = self.trackers
+        super(TrackerHandlerTests, self).tearDown()
+
+    def get_app(self):
+        return tornado.web.Application([(r'/tracker', TrackerHandler),
+                                        (r'/trackerUsers', TrackerUsersHandler)])
+
+    def get_json(self, url):
+        response = self.fetch(url)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'], '*')
+        return simplejson.loads(response.body)
+
+    def test_users(self):
+        self.assertEqual(self.get_json('/trackerUsers?metricName=loss'),
+                         [{'userId':0, 'name':'u1', 'summary':None},
+                          {'userId':1, 'name':'u2', 'summary':{'count':2, 'total':6.0}}])
+        self.assertEqual(self.get_json('/trackerUsers?metricName=none'), [])
+
+    def test_series(self):
+        # the last minute by the second
+        metrics = self.get_json('/tracker?metricName=loss&start=-60')
+        self.assertEqual(sorted((m['userId'], m['value']) for m in metrics), [(0, 1.0), (1, 3.0)])
+        # everything kept, by the hour
+        metrics = self.get_json('/tracker?metricName=loss&start=0&maxPoints=1000')
+        self.assertEqual([m['value'] for m in metrics if m['userId'] == 0], [1.0])
+        self.assertIn(len(metrics), (2, 3))
+        self.assertTrue(all(m['value'] == 3.0 for m in metrics if m['userId'] == 1))
+        self.assertTrue(all(m['time'] % 3600 == 0 for m in metrics))
+        self.assertEqual(self.get_json('/tracker?metricName=none'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
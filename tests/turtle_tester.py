@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:12:30 2026
+
+@author: xm
+"""
+
+import threading
+import time
+import unittest
+import monk.core.crane as crane
+from monk.core.panda import LinearPanda
+from monk.core.turtle import Turtle
+
+
+class RecordingStore(object):
+    """ Records the calls and the threads they come from """
+    def __init__(self):
+        self.calls = []
+
+    def record(self, *args):
+        self.calls.append((threading.current_thread(),) + args)
+
+    def load_or_create_all(self, objs):
+        return objs
+
+    def load_or_create(self, obj, *args):
+        return obj
+
+    def update_one_in_fields(self, obj, fields):
+        self.record('update_one_in_fields', obj, fields)
+
+    def update_all_in_fields(self, objs, fields):
+        self.record('update_all_in_fields', list(objs), list(fields))
+
+
+class FakeMantis(object):
+    def __init__(self, panda, store):
+        self.panda = panda
+        self.store = store
+        self.trainThreads = []
+
+    def consensus(self, leader):
+        self.store.record('consensus', self.panda.name)
+        return self.panda.name + '.z'
+
+    def train(self, leader, tosave=True, z=None):
+        assert not tosave and z == self.panda.name + '.z'
+        self.trainThreads.append(threading.current_thread())
+        time.sleep(0.01)
+        return self.panda.name != 'idle'
+
+    def commit_fields(self):
+        return {'mantis':self.panda.name}
+
+
+class FakePanda(LinearPanda):
+    def __init__(self, name, store):
+        self.name = name
+        self.mantis = FakeMantis(self, store)
+        self.store = store
+
+    def load_mantis(self):
+        self.store.record('load_mantis', self.name)
+
+    def weights_fields(self):
+        return {'weights':self.name}
+
+
+class TurtleTrainTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stores = crane.pandaStore, crane.mantisStore, crane.tigressStore
+        self.store = RecordingStore()
+        crane.pandaStore = crane.mantisStore = crane.tigressStore = self.store
+        self.turtle = Turtle()
+        self.turtle.store = self.store
+        self.turtle.pandas = [FakePanda(name, self.store) for name in ['a', 'idle', 'b', 'c']]
+        self.turtle.pTrainWorkers = 4
+        del self.store.calls[:]
+
+    def tearDown(self):
+        crane.pandaStore, crane.mantisStore, crane.tigressStore = self.stores
+
+    def test_parallel_train(self):
+        self.turtle.train()
+        main = threading.current_thread()
+        # the stores are only used on the calling thread
+        self.assertTrue(all(call[0] is main for call in self.store.calls))
+        # the pandas train on the pool
+        trainThreads = [t for panda in self.turtle.pandas for t in panda.mantis.trainThreads]
+        self.assertEqual(len(trainThreads), 4)
+        self.assertTrue(all(t is not main for t in trainThreads))
+        # one bulk write per store, for the pandas that trained
+        updates = [call[1:] for call in self.store.calls if call[1] == 'update_all_in_fields']
+        self.assertEqual(len(updates), 2)
+        names = ['a', 'b', 'c']
+        self.assertEqual([panda.name for panda in updates[0][1]], names)
+        self.assertEqual(updates[0][2], [{'weights':name} for name in names])
+        self.assertEqual([mantis.panda.name for mantis in updates[1][1]], names)
+        self.assertEqual(updates[1][2], [{'mantis':name} for name in names])
+        self.assertEqual(self.turtle.pTrainClock, 1)
+        self.assertIsNone(self.turtle.weightMatrix)
+
+
+if __name__ == '__main__':
+    unittest.main()
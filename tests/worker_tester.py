@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 15:11:36 2026
+
+@author: xm
+"""
+
+import simplejson
+import unittest
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase
+import monk.core.api as monkapi
+from monk.roles.worker import PredictHandler
+
+
+class PredictHandlerTests(AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.predict_all = monkapi.predict_all
+        self.calls = []
+        def predict_all(turtleName, userName, entities, fields=None):
+            self.calls.append((turtleName, userName, entities, fields))
+            if turtleName == 'missing':
+                return None
+            if turtleName == 'broken':
+                raise ValueError('broken turtle')
+            return [len(str(ent)) for ent in entities]
+        monkapi.predict_all = predict_all
+        PredictHandler.latencies.clear()
+        super(PredictHandlerTests, self).setUp()
+
+    def tearDown(self):
+        monkapi.predict_all = self.predict_all
+        super(PredictHandlerTests, self).tearDown()
+
+    def get_app(self):
+        return tornado.web.Application([(r'/predict', PredictHandler)])
+
+    def post(self, body):
+        response = self.fetch('/predict', method='POST', body=body)
+        return response.code, response.body
+
+    def test_predict(self):
+        features = {'_features':[[1, 0.5]]}
+        code, body = self.post(simplejson.dumps({'userName':'u1', 'turtleName':'t',
+                                                 'entities':['e1', features], 'fields':['f']}))
+        self.assertEqual(code, 200)
+        self.assertEqual(simplejson.loads(body), {'predictions':[2, len(str(features))]})
+        self.assertEqual(self.calls, [('t', 'u1', ['e1', features], ['f'])])
+        # a single entity
+        code, body = self.post(simplejson.dumps({'userName':'u1', 'turtleName':'t', 'entity':'e22'}))
+        self.assertEqual(simplejson.loads(body), {'predictions':[3]})
+        self.assertEqual([turtleName for turtleName, p50, p99 in PredictHandler.latency_percentiles(True)], ['t'])
+        self.assertEqual(PredictHandler.latency_percentiles(), [])
+
+    def test_batch(self):
+        requests = [{'userName':'u1', 'turtleName':'t', 'entities':['e1']},
+                    {'userName':'u1', 'turtleName':'missing', 'entities':['e1']},
+                    {'userName':'u1', 'turtleName':'broken', 'entities':['e1']}]
+        code, body = self.post(simplejson.dumps(requests))
+        self.assertEqual(code, 200)
+        self.assertEqual(simplejson.loads(body), [{'predictions':[2]},
+                                                  {'error':'turtle u1@missing not found'},
+                                                  {'error':'broken turtle'}])
+        self.assertEqual(PredictHandler.latencies.keys(), ['t'])
+
+    def test_invalid(self):
+        code, body = self.post('{not json')
+        self.assertEqual(code, 400)
+        self.assertTrue(simplejson.loads(body)['error'].startswith('invalid json'))
+        # json that is not a request
+        for body in ['3', '"x"', 'null', '[{"userName":"u1"}, 3]']:
+            code, body = self.post(body)
+            self.assertEqual(code, 400)
+            self.assertIn('error', simplejson.loads(body))
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
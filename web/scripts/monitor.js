@@ -67,9 +67,12 @@ var svg = d3.select(".g-main-chart").select("svg")
 	.append("g")
 	.attr("transform", "translate(" + margin.left + "," + margin.top + ")");
 	
+// the monk monitor serving /users and /metrics of its trackers
+var host = typeof window.monitorHost !== "undefined" ? window.monitorHost : "http://monkzookeeper.cloudapp.net";
+
 queue()
-    .defer(d3.json, "http://monkzookeeper.cloudapp.net/users?topic="+topic+"&metricName="+metricName)
-    .defer(d3.json, "http://monkzookeeper.cloudapp.net/metrics?topic="+topic+"&metricName="+metricName+"&start="+metricStartPosition)
+    .defer(d3.json, host+"/users?topic="+topic+"&metricName="+metricName)
+    .defer(d3.json, host+"/metrics?topic="+topic+"&metricName="+metricName+"&start="+metricStartPosition)
     .await(ready)
 
 function ready(err, users, metrics) {